@@ -8,8 +8,80 @@ import sys
 import os
 import json
 import time
+import socket
+import threading
 from datetime import datetime
 
+
+def start_echo_server():
+    """Локальный upstream для тестов прокси: возвращает эхом всё полученное"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(64)
+    
+    def handle(conn):
+        with conn:
+            try:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    conn.sendall(data)
+            except OSError:
+                pass
+    
+    def accept_loop():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                break
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return server
+
+def recv_until(sock, marker=b'\r\n\r\n'):
+    """Чтение из сокета до появления marker (ответ может прийти частями)"""
+    data = b''
+    while marker not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class SegmentCapture:
+    """Loopback-приёмник, записывающий границы пришедших сегментов
+    
+    Каждый recv() фиксируется отдельно. Если отправитель выдерживает паузу
+    между сегментами (split_delay), один recv соответствует одному сегменту.
+    """
+    
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.chunks = []
+        self.done = threading.Event()
+        threading.Thread(target=self._capture, daemon=True).start()
+    
+    def _capture(self):
+        conn, _ = self.server.accept()
+        with conn:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                self.chunks.append(chunk)
+        self.done.set()
+    
+    def close(self):
+        self.server.close()
+
+
 class TestZapretAndroid(unittest.TestCase):
     
     def setUp(self):
@@ -155,6 +227,1843 @@ class TestZapretAndroid(unittest.TestCase):
         os.remove(proxy_script)
         
         print("[✓] Прокси-скрипт создан корректно")
+    
+    def test_08_async_proxy_mode(self):
+        """Тест asyncio-режима DPI прокси"""
+        from dpi_bypass import DPIBypass, DPIStrategy, ProxyMode
+        
+        upstream = start_echo_server()
+        upstream_port = upstream.getsockname()[1]
+        
+        bypass = DPIBypass()
+        proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port,
+                                           DPIStrategy.HOST_FAKE_SPLIT,
+                                           mode=ProxyMode.ASYNCIO)
+        thread = threading.Thread(target=proxy.start,
+                                  args=(0, '127.0.0.1', upstream_port), daemon=True)
+        thread.start()
+        self.assertTrue(proxy.ready.wait(5))
+        
+        try:
+            request = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+            for _ in range(3):
+                with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as client:
+                    client.sendall(request)
+                    response = recv_until(client)
+                
+                # Upstream получил ровно те байты, что отправил клиент
+                self.assertEqual(response, request)
+            
+            stats = proxy.get_stats()
+            self.assertEqual(stats['connections'], 3)
+            self.assertEqual(stats['desynced'], 3)
+        finally:
+            proxy.stop()
+            thread.join(5)
+            upstream.close()
+        
+        self.assertFalse(thread.is_alive())
+        
+        print("[✓] asyncio-прокси обрабатывает соединения")
+    
+    def test_09_downstream_relay(self):
+        """Тест перекачки server→client через splice и recv_into"""
+        from dpi_bypass import DPIBypass, DPIStrategy
+        
+        payload = os.urandom(1024 * 1024)
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream.bind(('127.0.0.1', 0))
+        upstream.listen(8)
+        
+        def serve_blob():
+            while True:
+                try:
+                    conn, _ = upstream.accept()
+                except OSError:
+                    break
+                with conn:
+                    request = b''
+                    while b'\r\n\r\n' not in request:
+                        request += conn.recv(65536)
+                    conn.sendall(payload)
+        
+        threading.Thread(target=serve_blob, daemon=True).start()
+        upstream_port = upstream.getsockname()[1]
+        
+        try:
+            for zero_copy in (True, False):
+                bypass = DPIBypass()
+                proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port,
+                                                   DPIStrategy.HOST_FAKE_SPLIT,
+                                                   zero_copy=zero_copy)
+                thread = threading.Thread(target=proxy.start,
+                                          args=(0, '127.0.0.1', upstream_port), daemon=True)
+                thread.start()
+                self.assertTrue(proxy.ready.wait(5))
+                
+                with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as client:
+                    client.sendall(b'GET /video HTTP/1.1\r\nHost: googlevideo.com\r\n\r\n')
+                    received = bytearray()
+                    while True:
+                        chunk = client.recv(65536)
+                        if not chunk:
+                            break
+                        received += chunk
+                
+                self.assertEqual(bytes(received), payload)
+                proxy.stop()
+                thread.join(5)
+        finally:
+            upstream.close()
+        
+        print("[✓] Поток server→client передаётся без искажений")
+    
+    def test_10_buffer_pool(self):
+        """Тест пула буферов прокси"""
+        from dpi_bypass import BufferPool, DPIBypass, DPIStrategy
+        
+        pool = BufferPool(buffer_size=1024, capacity=2)
+        first, second = pool.acquire(), pool.acquire()
+        extra = pool.acquire()
+        
+        for buffer in (first, second, extra):
+            pool.release(buffer)
+        
+        stats = pool.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertEqual((stats['returned'], stats['dropped']), (2, 1))
+        self.assertEqual(stats['available'], 2)
+        
+        # Прокси берёт буферы из пула и возвращает их после соединения
+        upstream = start_echo_server()
+        upstream_port = upstream.getsockname()[1]
+        bypass = DPIBypass()
+        proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port,
+                                           DPIStrategy.HOST_FAKE_SPLIT,
+                                           zero_copy=False, buffer_size=16384,
+                                           buffer_pool_capacity=4)
+        thread = threading.Thread(target=proxy.start,
+                                  args=(0, '127.0.0.1', upstream_port), daemon=True)
+        thread.start()
+        self.assertTrue(proxy.ready.wait(5))
+        
+        try:
+            with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as client:
+                client.sendall(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+                self.assertTrue(recv_until(client))
+            
+            deadline = time.time() + 5
+            while proxy.get_stats()['active'] and time.time() < deadline:
+                time.sleep(0.01)
+            
+            pool_stats = proxy.get_stats()['buffer_pool']
+            self.assertEqual(pool_stats['hits'], 2)
+            self.assertEqual(pool_stats['misses'], 0)
+            self.assertEqual(pool_stats['available'], 4)
+        finally:
+            proxy.stop()
+            thread.join(5)
+            upstream.close()
+        
+        print("[✓] Пул буферов переиспользует память")
+    
+    def test_11_first_flight_desync(self):
+        """Тест применения стратегии только к первому полёту"""
+        from dpi_bypass import (DPIBypass, DPIStrategy, ConnectionDesync,
+                                parse_desync_cutoff, flatten_segments)
+        
+        self.assertEqual(parse_desync_cutoff('n2'), ('n', 2))
+        self.assertEqual(parse_desync_cutoff('s4096'), ('s', 4096))
+        with self.assertRaises(ValueError):
+            parse_desync_cutoff('nx')
+        
+        bypass = DPIBypass()
+        chunk = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        
+        def joined(segments):
+            return b''.join(flatten_segments(segments))
+        
+        # Первый полёт режется по Host; байты потока не меняются
+        desync = ConnectionDesync(bypass, DPIStrategy.HOST_FAKE_SPLIT, 'n3')
+        segments = desync.process(chunk)
+        self.assertGreater(len(segments), 1)
+        self.assertEqual(joined(segments), chunk)
+        self.assertEqual(joined(desync.process(chunk)), chunk)
+        self.assertTrue(desync.passthrough)
+        segments = desync.process(chunk)
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(joined(segments), chunk)
+        
+        desync = ConnectionDesync(bypass, DPIStrategy.HOST_FAKE_SPLIT, 's10')
+        self.assertGreater(len(desync.process(chunk)), 1)
+        self.assertTrue(desync.passthrough)
+        
+        # В прокси после первого полёта данные идут без изменений
+        upstream = start_echo_server()
+        upstream_port = upstream.getsockname()[1]
+        proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port,
+                                           DPIStrategy.HOST_FAKE_SPLIT)
+        thread = threading.Thread(target=proxy.start,
+                                  args=(0, '127.0.0.1', upstream_port), daemon=True)
+        thread.start()
+        self.assertTrue(proxy.ready.wait(5))
+        
+        try:
+            with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as client:
+                client.sendall(chunk)
+                self.assertEqual(recv_until(client), chunk)
+                
+                upload = os.urandom(200000)
+                client.sendall(upload)
+                echoed = bytearray()
+                while len(echoed) < len(upload):
+                    echoed += client.recv(65536)
+                self.assertEqual(bytes(echoed), upload)
+        finally:
+            proxy.stop()
+            thread.join(5)
+            upstream.close()
+        
+        print("[✓] Стратегия применяется только к первому полёту")
+    
+    def test_12_fake_template_cache(self):
+        """Тест кэша фейковых шаблонов"""
+        from dpi_bypass import DPIBypass, FakeTemplateCache, TLS_RANDOM_FIELDS
+        
+        bypass = DPIBypass()
+        template = bypass.templates['tls_clienthello_www_google_com']('example.com')
+        
+        first = bypass.templates.get('tls_clienthello_www_google_com', 'example.com', 3)
+        second = bypass.templates.get('tls_clienthello_www_google_com', 'example.com', 3)
+        
+        self.assertEqual(len(first), len(template) * 3)
+        # Совпадает всё, кроме 32-байтного random
+        self.assertEqual(first[:11], template[:11])
+        self.assertEqual(first[43:len(template)], template[43:])
+        self.assertNotEqual(first[11:43], second[11:43])
+        self.assertEqual(first[11:43], first[len(template) + 11:len(template) + 43])
+        
+        stats = bypass.templates.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        
+        # LRU вытесняет самый старый ключ
+        cache = FakeTemplateCache({'tls': bypass._generate_tls_client_hello},
+                                  {'tls': TLS_RANDOM_FIELDS}, max_entries=2)
+        for sni in ('a.com', 'b.com', 'a.com', 'c.com', 'a.com'):
+            cache.get('tls', sni)
+        
+        stats = cache.get_stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual((stats['hits'], stats['misses']), (2, 3))
+        
+        print("[✓] Кэш шаблонов отдаёт готовые фейки")
+    
+    def test_13_segment_output(self):
+        """Тест вывода стратегий списком сегментов"""
+        from dpi_bypass import DPIBypass, DPIStrategy, send_buffers, flatten_segments
+        
+        bypass = DPIBypass()
+        data = os.urandom(5000)
+        
+        buffers = flatten_segments(
+            bypass.apply_strategy_segments(data, DPIStrategy.MULTISPLIT)
+        )
+        # Части ссылаются на исходные данные, а не копируют их
+        self.assertTrue(any(isinstance(buffer, memoryview) for buffer in buffers))
+        self.assertEqual(b''.join(buffers),
+                         bypass.apply_strategy(data, DPIStrategy.MULTISPLIT))
+        
+        # sendmsg передаёт сегменты без склейки, включая частичные отправки
+        sender, receiver = socket.socketpair()
+        big = [os.urandom(7000) for _ in range(300)]
+        received = bytearray()
+        
+        def read_all():
+            while True:
+                chunk = receiver.recv(65536)
+                if not chunk:
+                    break
+                received.extend(chunk)
+        
+        reader = threading.Thread(target=read_all)
+        reader.start()
+        send_buffers(sender, big)
+        sender.shutdown(socket.SHUT_WR)
+        reader.join(5)
+        sender.close()
+        receiver.close()
+        
+        self.assertEqual(bytes(received), b''.join(big))
+        
+        print("[✓] Стратегии отдают сегменты для sendmsg")
+    
+    def test_14_wire_segments(self):
+        """Тест разбиения split-стратегий на отдельные TCP-сегменты"""
+        from dpi_bypass import DPIBypass, DPIStrategy, send_segments
+        
+        bypass = DPIBypass()
+        data = os.urandom(2000)
+        for strategy in (DPIStrategy.MULTISPLIT, DPIStrategy.MULTIDISORDER):
+            bypass.strategy_configs[strategy] = {'split_pos': [1362, 681, 5000],
+                                                 'split_delay': 0.05}
+            segments = bypass.apply_strategy_segments(data, strategy)
+            
+            capture = SegmentCapture()
+            try:
+                with socket.create_connection(('127.0.0.1', capture.port)) as sender:
+                    send_segments(sender, segments)
+                self.assertTrue(capture.done.wait(5))
+            finally:
+                capture.close()
+            
+            # Каждая часть пришла отдельным сегментом, по порядку и без добавок
+            self.assertEqual([len(chunk) for chunk in capture.chunks], [681, 681, 638], strategy)
+            self.assertEqual(b''.join(capture.chunks), data, strategy)
+        
+        # Позиция по умолчанию: 1 для MULTISPLIT
+        bypass = DPIBypass()
+        segments = bypass.apply_strategy_segments(data, DPIStrategy.MULTISPLIT)
+        self.assertEqual([len(b''.join(segment.buffers)) for segment in segments], [1, 1999])
+        
+        print("[✓] Части MULTISPLIT уходят отдельными сегментами")
+    
+    def test_15_upstream_pool(self):
+        """Тест переиспользования upstream-соединений для HTTP"""
+        from dpi_bypass import DPIBypass, DPIStrategy, ProxyMode, UpstreamPool, HttpExchange
+        
+        # Разбор границ HTTP: HEAD без тела, chunked, 100 Continue, конвейер
+        exchange = HttpExchange()
+        exchange.feed_request(b'HEAD / HTTP/1.1\r\nHost: a\r\n\r\nGET /x HTTP/1.1\r\n')
+        self.assertFalse(exchange.idle)
+        exchange.feed_request(b'Host: a\r\n\r\n')
+        exchange.feed_response(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n')
+        exchange.feed_response(b'HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\n'
+                               b'Transfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n')
+        self.assertFalse(exchange.idle)
+        exchange.feed_response(b'0\r\n\r\n')
+        self.assertTrue(exchange.idle)
+        # Ответ до закрытия соединения в пул не попадает
+        exchange.feed_request(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        exchange.feed_response(b'HTTP/1.1 200 OK\r\n\r\nbody')
+        self.assertFalse(exchange.idle)
+        
+        def start_http_server():
+            """Keep-alive HTTP-сервер; /slow отдаёт тело с паузой, не-HTTP - эхо"""
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('127.0.0.1', 0))
+            server.listen(64)
+            
+            def handle(conn):
+                with conn:
+                    try:
+                        pending = b''
+                        while True:
+                            data = conn.recv(65536)
+                            if not data:
+                                break
+                            pending += data
+                            if not pending.startswith(b'GET'):
+                                conn.sendall(pending)
+                                pending = b''
+                                continue
+                            while b'\r\n\r\n' in pending:
+                                head, pending = pending.split(b'\r\n\r\n', 1)
+                                path = head.split()[1]
+                                if path == b'/chunked':
+                                    conn.sendall(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked'
+                                                 b'\r\n\r\n2\r\nok\r\n0\r\n\r\n')
+                                elif path == b'/slow':
+                                    conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 4'
+                                                 b'\r\n\r\nok')
+                                    time.sleep(0.3)
+                                    conn.sendall(b'ok')
+                                else:
+                                    conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2'
+                                                 b'\r\n\r\nok')
+                    except OSError:
+                        pass
+            
+            def accept_loop():
+                while True:
+                    try:
+                        conn, _ = server.accept()
+                    except OSError:
+                        break
+                    threading.Thread(target=handle, args=(conn,), daemon=True).start()
+            
+            threading.Thread(target=accept_loop, daemon=True).start()
+            return server
+        
+        upstream = start_http_server()
+        upstream_port = upstream.getsockname()[1]
+        request = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        chunked = b'GET /chunked HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        slow = b'GET /slow HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        tls = b'\x16\x03\x01' + os.urandom(64)
+        # Запрос и конец ответа, после которого клиент закрывает соединение
+        exchanges = [(request, b'\r\n\r\nok'), (chunked, b'0\r\n\r\n'),
+                     (request, b'\r\n\r\nok'), (tls, None),
+                     (slow, b'\r\n\r\nok'), (request, b'\r\n\r\nok')]
+        
+        try:
+            for mode in ProxyMode:
+                bypass = DPIBypass()
+                proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port,
+                                                   DPIStrategy.HOST_FAKE_SPLIT, mode=mode,
+                                                   upstream_pool=UpstreamPool(max_per_host=2))
+                thread = threading.Thread(target=proxy.start,
+                                          args=(0, '127.0.0.1', upstream_port), daemon=True)
+                thread.start()
+                self.assertTrue(proxy.ready.wait(5))
+                
+                for payload, marker in exchanges:
+                    with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as client:
+                        client.sendall(payload)
+                        self.assertTrue(recv_until(client, marker) if marker else client.recv(65536))
+                    
+                    deadline = time.time() + 5
+                    while proxy.get_stats()['active'] and time.time() < deadline:
+                        time.sleep(0.01)
+                
+                stats = proxy.get_stats()['upstream_pool']
+                proxy.stop()
+                thread.join(5)
+                
+                # TLS идёт мимо пула. Соединение с недочитанным ответом /slow
+                # в пул не вернулось, последнему запросу открыто новое
+                self.assertEqual(stats['created'], 2, mode)
+                self.assertEqual(stats['reused'], 3, mode)
+                self.assertAlmostEqual(stats['reuse_ratio'], 3 / 5)
+                self.assertEqual(stats['idle'], 1)
+        finally:
+            upstream.close()
+        
+        print("[✓] Upstream-соединения HTTP переиспользуются")
+    
+    def test_16_admission_limits(self):
+        """Тест ограничения одновременных соединений, очереди и сброса"""
+        from dpi_bypass import DPIBypass, DPIStrategy, ProxyMode
+        
+        upstream = start_echo_server()
+        upstream_port = upstream.getsockname()[1]
+        request = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        
+        def wait_for(proxy, key, value):
+            deadline = time.time() + 5
+            while proxy.get_stats()[key] != value and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(proxy.get_stats()[key], value)
+        
+        try:
+            for mode in ProxyMode:
+                bypass = DPIBypass()
+                proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port,
+                                                   DPIStrategy.AUTO, mode=mode, backlog=16,
+                                                   max_connections=1, max_queued=1)
+                thread = threading.Thread(target=proxy.start,
+                                          args=(0, '127.0.0.1', upstream_port), daemon=True)
+                thread.start()
+                self.assertTrue(proxy.ready.wait(5))
+                
+                # Первое соединение занимает единственный слот
+                first = socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5)
+                first.sendall(request)
+                self.assertTrue(recv_until(first))
+                
+                # Второе ждёт в очереди, третье сбрасывается
+                second = socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5)
+                second.sendall(request)
+                wait_for(proxy, 'waiting', 1)
+                
+                # RST может прийти ещё до возврата из connect()
+                try:
+                    with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as third:
+                        self.assertEqual(third.recv(65536), b'')
+                except ConnectionResetError:
+                    pass
+                wait_for(proxy, 'rejected', 1)
+                
+                # После закрытия первого очередь обслуживается
+                first.close()
+                self.assertTrue(recv_until(second), mode)
+                second.close()
+                wait_for(proxy, 'active', 0)
+                
+                stats = proxy.get_stats()
+                proxy.stop()
+                thread.join(5)
+                
+                self.assertEqual(stats['accepted'], 2, mode)
+                self.assertEqual(stats['queued'], 1, mode)
+                self.assertEqual(stats['rejected'], 1, mode)
+                self.assertEqual(stats['waiting'], 0, mode)
+            
+            # Пачка соединений, принятых за один проход цикла событий
+            bypass = DPIBypass()
+            proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port, DPIStrategy.AUTO,
+                                               mode=ProxyMode.ASYNCIO, backlog=64,
+                                               max_connections=1, max_queued=2)
+            thread = threading.Thread(target=proxy.start,
+                                      args=(0, '127.0.0.1', upstream_port), daemon=True)
+            thread.start()
+            self.assertTrue(proxy.ready.wait(5))
+            # Цикл занят, пока соединения копятся в очереди listen()
+            proxy.loop.call_soon_threadsafe(time.sleep, 0.3)
+            clients = [socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5)
+                       for _ in range(10)]
+            try:
+                wait_for(proxy, 'rejected', 7)
+                stats = proxy.get_stats()
+                self.assertEqual(stats['queued'], 2)
+                self.assertEqual(stats['accepted'], 1)
+                self.assertEqual(stats['waiting'], 2)
+            finally:
+                for client in clients:
+                    client.close()
+                proxy.stop()
+                thread.join(5)
+        finally:
+            upstream.close()
+        
+        print("[✓] Лимит соединений, очередь и сброс при перегрузке работают")
+    
+    def test_17_proxy_workers(self):
+        """Тест воркеров прокси на общем порту и их перезапуска"""
+        import signal
+        from dpi_bypass import DPIStrategy
+        from proxy_workers import ProxyWorkerSupervisor
+        
+        upstream = start_echo_server()
+        upstream_port = upstream.getsockname()[1]
+        request = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        supervisor = ProxyWorkerSupervisor(0, '127.0.0.1', upstream_port, DPIStrategy.AUTO,
+                                           workers=2, stats_interval=0.05, check_interval=0.05)
+        
+        def wait_for(condition):
+            deadline = time.time() + 30
+            while not condition(supervisor.get_stats()) and time.time() < deadline:
+                time.sleep(0.05)
+            return supervisor.get_stats()
+        
+        def make_requests(count):
+            for _ in range(count):
+                with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+                    client.sendall(request)
+                    self.assertTrue(recv_until(client))
+        
+        try:
+            port = supervisor.start()
+            self.assertTrue(supervisor.wait_ready(30))
+            make_requests(20)
+            stats = wait_for(lambda stats: stats['connections'] == 20 and not stats['active'])
+            self.assertEqual(stats['connections'], 20)
+            self.assertEqual(stats['alive'], 2)
+            
+            # Упавший воркер перезапускается, его счётчики сохраняются
+            os.kill(supervisor._processes[0].pid, signal.SIGKILL)
+            stats = wait_for(lambda stats: stats['restarts'] == 1 and
+                             all(stats['per_worker']))
+            self.assertEqual(stats['restarts'], 1)
+            self.assertEqual(stats['alive'], 2)
+            
+            make_requests(5)
+            stats = wait_for(lambda stats: stats['connections'] == 25 and not stats['active'])
+            self.assertEqual(stats['connections'], 25)
+        finally:
+            supervisor.stop()
+            upstream.close()
+        
+        # Воркер, падающий сразу после запуска, перезапускается с задержкой
+        # и после max_fast_failures падений подряд бросается
+        supervisor = ProxyWorkerSupervisor(0, '127.0.0.1', upstream_port, DPIStrategy.AUTO,
+                                           workers=1, check_interval=0.02,
+                                           restart_delay=0.05, max_fast_failures=3,
+                                           backlog='invalid')
+        try:
+            supervisor.start()
+            started = time.time()
+            self.assertFalse(supervisor.wait_ready(30))
+            self.assertLess(time.time() - started, 20)
+            stats = supervisor.get_stats()
+            self.assertEqual(stats['restarts'], 2)
+            self.assertEqual(stats['abandoned'], 1)
+            self.assertEqual(stats['alive'], 0)
+        finally:
+            supervisor.stop()
+        
+        print("[✓] Воркеры прокси делят порт и перезапускаются")
+    
+    def test_18_flight_classifier(self):
+        """Тест потокового разбора первого полёта: SNI, Host, QUIC"""
+        import ssl
+        from dpi_bypass import DPIBypass, DPIStrategy, flatten_segments
+        from protocol_classifier import FirstFlightClassifier, Protocol
+        
+        # Настоящий ClientHello из ssl через MemoryBIO
+        incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+        tls = ssl.create_default_context().wrap_bio(incoming, outgoing,
+                                                    server_hostname='Discord.com')
+        with self.assertRaises(ssl.SSLWantReadError):
+            tls.do_handshake()
+        hello = outgoing.read()
+        
+        # Запись разрезана посреди заголовка и посреди расширений
+        classifier = FirstFlightClassifier()
+        self.assertFalse(classifier.feed(hello[:3]).complete)
+        self.assertFalse(classifier.feed(hello[3:100]).complete)
+        info = classifier.feed(hello[100:])
+        self.assertEqual(info.protocol, Protocol.TLS)
+        self.assertTrue(info.complete)
+        self.assertEqual(info.sni, 'discord.com')
+        # Готовый результат кэшируется, следующие порции не разбираются
+        self.assertIs(classifier.feed(b'\x17\x03\x03'), info)
+        
+        # ClientHello, разбитый на две TLS-записи
+        body = hello[5:]
+        records = (hello[:3] + len(body[:50]).to_bytes(2, 'big') + body[:50] +
+                   hello[:3] + len(body[50:]).to_bytes(2, 'big') + body[50:])
+        self.assertEqual(FirstFlightClassifier().feed(records).sni, 'discord.com')
+        
+        # QUIC Initial: версия из длинного заголовка
+        info = FirstFlightClassifier().feed(b'\xc0\x00\x00\x00\x01' + bytes(32))
+        self.assertEqual(info.protocol, Protocol.QUIC)
+        self.assertEqual(info.quic_version, 1)
+        
+        # Заголовок Host во второй порции: разрез по смещениям от начала потока
+        bypass = DPIBypass()
+        desync = bypass.create_connection_desync(DPIStrategy.HOST_FAKE_SPLIT, 'n3')
+        first = b'GET /video HTTP/1.1\r\nUser-Agent: test\r\n'
+        second = b'Host: youtube.com:80\r\nAccept: */*\r\n\r\n'
+        # Host ещё не пришёл: данные уходят без разреза
+        self.assertEqual(flatten_segments(desync.process(first)), [first])
+        self.assertEqual(desync.flight.protocol, Protocol.HTTP)
+        self.assertIsNone(desync.flight.host)
+        
+        segments = desync.process(second)
+        self.assertEqual(desync.flight.host, 'youtube.com')
+        self.assertEqual(desync.flight.host_span, (len(first), len(first) + 20))
+        self.assertEqual([bytes(b) for b in flatten_segments(segments)],
+                         [b'Host: youtube.com:80', b'\r\nAccept: */*\r\n\r\n'])
+        
+        print("[✓] Первый полёт разбирается потоково: SNI, Host, QUIC")
+    
+    def test_19_strategy_dispatch(self):
+        """Тест выбора стратегии по фильтрам для каждого соединения"""
+        import tempfile
+        from dpi_bypass import DPIBypass, DPIStrategy, ProxyMode
+        from strategy_rules import StrategyDispatcher, parse_filter
+        
+        rule = parse_filter('--filter-tcp=2053,2083,50000-50100 --hostlist-domains=discord.media '
+                            '--dpi-desync=fake,multidisorder --dpi-desync-repeats=11')
+        self.assertEqual(rule.strategy, DPIStrategy.MULTIDISORDER)
+        self.assertEqual(rule.params, {'repeats': 11})
+        self.assertTrue(rule.matches_port(50050))
+        self.assertFalse(rule.matches_port(443))
+        self.assertEqual(parse_filter('--filter-udp=443 --dpi-desync=fake').strategy,
+                         DPIStrategy.FAKE_QUIC)
+        
+        with tempfile.TemporaryDirectory() as base_dir:
+            os.makedirs(os.path.join(base_dir, 'lists'))
+            with open(os.path.join(base_dir, 'lists', 'list-general.txt'), 'w') as f:
+                f.write('# видео\nyoutube.com\nexample.com\n')
+            
+            upstream = start_echo_server()
+            upstream_port = upstream.getsockname()[1]
+            params = {'params': [
+                '--filter-udp=443 --hostlist="lists/list-general.txt" --dpi-desync=fake',
+                '--filter-tcp=2053 --hostlist-domains=discord.media --dpi-desync=multidisorder',
+                f'--filter-tcp=443,{upstream_port} --hostlist="lists/list-general.txt" '
+                '--dpi-desync=hostfakesplit --dpi-desync-repeats=4',
+            ]}
+            dispatcher = StrategyDispatcher.from_strategy_params(params, base_dir)
+            
+            self.assertIs(dispatcher.match(443, 'www.YouTube.com'), dispatcher.rules[2])
+            self.assertIs(dispatcher.match(443, 'youtube.com', transport='udp'),
+                          dispatcher.rules[0])
+            self.assertIs(dispatcher.match(2053, 'cdn.discord.media'), dispatcher.rules[1])
+            self.assertIsNone(dispatcher.match(443, 'notyoutube.com'))
+            self.assertIsNone(dispatcher.match(8443, 'youtube.com'))
+            self.assertIsNone(dispatcher.match(443, None))
+            
+            listed = b'GET / HTTP/1.1\r\nHost: www.example.com\r\n\r\n'
+            unlisted = b'GET / HTTP/1.1\r\nHost: example.org\r\n\r\n'
+            try:
+                for mode in ProxyMode:
+                    dispatcher = StrategyDispatcher.from_strategy_params(params, base_dir)
+                    bypass = DPIBypass()
+                    proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port,
+                                                       DPIStrategy.MULTISPLIT, mode=mode,
+                                                       dispatcher=dispatcher)
+                    thread = threading.Thread(target=proxy.start,
+                                              args=(0, '127.0.0.1', upstream_port), daemon=True)
+                    thread.start()
+                    self.assertTrue(proxy.ready.wait(5))
+                    
+                    # Хост из списка: запрос придержан до конца заголовков и
+                    # разрезан, но сервер получает его без изменений
+                    with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as client:
+                        client.sendall(listed[:20])
+                        time.sleep(0.05)
+                        client.sendall(listed[20:])
+                        self.assertEqual(recv_until(client), listed, mode)
+                    
+                    # Хост не из списка: данные идут без изменений
+                    with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as client:
+                        client.sendall(unlisted)
+                        self.assertEqual(recv_until(client), unlisted, mode)
+                    
+                    desynced = proxy.get_stats()['desynced']
+                    stats = proxy.get_stats()['dispatcher']
+                    proxy.stop()
+                    thread.join(5)
+                    self.assertEqual(desynced, 1, mode)
+                    self.assertEqual(stats['matched'], 1, mode)
+                    self.assertEqual(stats['unmatched'], 1, mode)
+            finally:
+                upstream.close()
+        
+        print("[✓] Стратегия выбирается по портам и спискам доменов")
+    
+    def test_20_domain_index(self):
+        """Тест индекса доменов: поддомены и приоритет исключений"""
+        import tempfile
+        from domain_index import DomainSuffixIndex
+        from strategy_rules import StrategyDispatcher
+        
+        index = DomainSuffixIndex()
+        general = index.add_list('general', ['youtube.com', '*.googlevideo.com', 'Discord.Media.'])
+        google = index.add_list('google', ['google.com', 'youtube.com'])
+        excluded = index.add_list('exclude', ['accounts.youtube.com'])
+        
+        self.assertEqual(index.lookup('youtube.com'), general | google)
+        self.assertEqual(index.lookup('rr1---sn-abc.GOOGLEVIDEO.com.'), general)
+        self.assertEqual(index.lookup('cdn.discord.media'), general)
+        self.assertEqual(index.lookup('notyoutube.com'), 0)
+        self.assertEqual(index.lookup('com'), 0)
+        self.assertTrue(index.matches('m.youtube.com', general, excluded))
+        self.assertFalse(index.matches('login.accounts.youtube.com', general, excluded))
+        self.assertEqual(index.add_list('general', ['discord.gg']), general)
+        self.assertEqual(len(index), 6)
+        
+        # list-exclude.txt важнее hostlist во всех правилах
+        with tempfile.TemporaryDirectory() as base_dir:
+            os.makedirs(os.path.join(base_dir, 'lists'))
+            with open(os.path.join(base_dir, 'lists', 'list-general.txt'), 'w') as f:
+                f.write('youtube.com\ndiscord.com\n')
+            with open(os.path.join(base_dir, 'lists', 'list-exclude.txt'), 'w') as f:
+                f.write('# без обхода\nstatus.discord.com\n')
+            
+            dispatcher = StrategyDispatcher.from_strategy_params({'params': [
+                '--filter-tcp=443 --hostlist="lists/list-general.txt" --dpi-desync=fake',
+                '--filter-tcp=80 --dpi-desync=multisplit',
+            ]}, base_dir)
+            self.assertIsNotNone(dispatcher.match(443, 'gateway.discord.com'))
+            self.assertIsNone(dispatcher.match(443, 'status.discord.com'))
+            self.assertIsNone(dispatcher.match(80, 'status.discord.com'))
+            self.assertIsNotNone(dispatcher.match(80, 'example.org'))
+            self.assertEqual(dispatcher.get_stats()['domains'], 3)
+        
+        print("[✓] Индекс доменов учитывает поддомены и исключения")
+    
+    def test_21_ip_index(self):
+        """Тест индекса подсетей: самый длинный префикс, исключения, сериализация"""
+        import tempfile
+        from ip_index import IPPrefixIndex
+        from strategy_rules import StrategyDispatcher
+        
+        index = IPPrefixIndex()
+        included = index.add_list('all', ['10.0.0.0/8', '10.1.0.0/16', '203.0.113.113/32',
+                                          '2a00:1450::/32', 'мусор'])
+        excluded = index.add_list('exclude', ['10.1.2.0/24', '2a00:1450:4001::/48'])
+        
+        self.assertEqual(index.longest_prefix('10.1.9.9'), ('10.1.0.0/16', included))
+        self.assertEqual(index.longest_prefix('10.1.2.3'), ('10.1.2.0/24', excluded))
+        self.assertIsNone(index.longest_prefix('192.0.2.1'))
+        self.assertTrue(index.matches('10.200.0.1', included, excluded))
+        self.assertFalse(index.matches('10.1.2.3', included, excluded))
+        self.assertTrue(index.matches('203.0.113.113', included))
+        self.assertFalse(index.matches('203.0.113.112', included))
+        self.assertTrue(index.matches('2a00:1450:4002::1', included, excluded))
+        self.assertFalse(index.matches('2a00:1450:4001::1', included, excluded))
+        self.assertTrue(index.matches(socket.inet_aton('10.9.9.9'), included))
+        self.assertEqual(index.get_stats()['prefixes'], 6)
+        
+        # Загрузка из байтов: массивы ссылаются на буфер, текст не разбирается
+        loaded = IPPrefixIndex.from_bytes(index.to_bytes())
+        self.assertEqual(loaded.lists, ['all', 'exclude'])
+        for address in ('10.1.9.9', '10.1.2.3', '192.0.2.1', '2a00:1450:4001::1', '::1'):
+            self.assertEqual(loaded.lookup(address), index.lookup(address), address)
+        self.assertEqual(loaded.longest_prefix('10.1.9.9'), ('10.1.0.0/16', included))
+        
+        # --ipset в правилах и общий ipset-exclude.txt
+        with tempfile.TemporaryDirectory() as base_dir:
+            os.makedirs(os.path.join(base_dir, 'lists'))
+            with open(os.path.join(base_dir, 'lists', 'ipset-all.txt'), 'w') as f:
+                f.write('# Discord\n162.159.128.0/19\n')
+            with open(os.path.join(base_dir, 'lists', 'ipset-exclude.txt'), 'w') as f:
+                f.write('162.159.130.0/24\n')
+            
+            dispatcher = StrategyDispatcher.from_strategy_params({'params': [
+                '--filter-tcp=443 --ipset="lists/ipset-all.txt" --dpi-desync=multisplit',
+            ]}, base_dir)
+            self.assertIsNotNone(dispatcher.match(443, address='162.159.135.232'))
+            self.assertIsNone(dispatcher.match(443, address='162.159.130.234'))
+            self.assertIsNone(dispatcher.match(443, address='8.8.8.8'))
+            self.assertIsNone(dispatcher.match(443, address='example.com'))
+        
+        print("[✓] Индекс подсетей находит самый точный префикс")
+
+    def test_22_list_snapshot(self):
+        """Тест снимка списков: сборка, mmap, пересборка при изменении"""
+        import pickle
+        import tempfile
+        import list_snapshot
+        from list_snapshot import ListSnapshot, build_snapshot
+        from strategy_rules import StrategyDispatcher
+
+        with tempfile.TemporaryDirectory() as base_dir:
+            lists_dir = os.path.join(base_dir, 'lists')
+            os.makedirs(lists_dir)
+            with open(os.path.join(lists_dir, 'list-general.txt'), 'w') as f:
+                f.write('youtube.com\ndiscord.com\n')
+            with open(os.path.join(lists_dir, 'list-exclude.txt'), 'w') as f:
+                f.write('status.discord.com\n')
+            with open(os.path.join(lists_dir, 'list-empty.txt'), 'w') as f:
+                f.write('# пусто\n')
+            with open(os.path.join(lists_dir, 'ipset-all.txt'), 'w') as f:
+                f.write('162.159.128.0/19\n2a00:1450::/32\n')
+
+            snapshot = ListSnapshot.open(base_dir)
+            self.assertTrue(os.path.exists(os.path.join(lists_dir, 'compiled.bin')))
+            self.assertGreater(snapshot.build_time, 0)
+            self.assertEqual(len(snapshot.domains), 3)
+            self.assertEqual(snapshot.ips.prefixes, 2)
+            general = snapshot.domains.bit('lists/list-general.txt')
+            self.assertTrue(snapshot.domains.matches('www.youtube.com', general))
+            self.assertTrue(snapshot.ips.lookup('2a00:1450::1'))
+
+            # Повторное открытие без изменений - без сборки; touch не в счёт,
+            # а новый mtime запоминается, чтобы не хэшировать файл снова
+            os.utime(os.path.join(lists_dir, 'list-general.txt'))
+            reopened = ListSnapshot.open(base_dir)
+            self.assertEqual(reopened.build_time, 0)
+            self.assertFalse(reopened.is_stale())
+            hashed = []
+            file_hash = list_snapshot._file_hash
+            list_snapshot._file_hash = lambda path: hashed.append(path) or file_hash(path)
+            try:
+                self.assertEqual(ListSnapshot.open(base_dir).build_time, 0)
+            finally:
+                list_snapshot._file_hash = file_hash
+            self.assertEqual(hashed, [])
+
+            # Правило с пустым hostlist не совпадает ни с чем, исключения важнее
+            params = {'params': [
+                '--filter-tcp=443 --hostlist="lists/list-empty.txt" --dpi-desync=fake',
+                '--filter-tcp=443 --hostlist="lists/list-general.txt" '
+                '--hostlist-domains=example.org --dpi-desync=multisplit',
+                '--filter-tcp=80 --ipset="lists/ipset-all.txt" --dpi-desync=multisplit',
+            ]}
+            dispatcher = StrategyDispatcher.from_strategy_params(params, base_dir, reopened)
+            text_dispatcher = StrategyDispatcher.from_strategy_params(params, base_dir)
+            worker_dispatcher = pickle.loads(pickle.dumps(dispatcher))
+            for candidate in (dispatcher, text_dispatcher, worker_dispatcher):
+                self.assertEqual(candidate.match(443, 'youtube.com').strategy.name, 'MULTISPLIT')
+                self.assertIsNotNone(candidate.match(443, 'www.example.org'))
+                self.assertIsNone(candidate.match(443, 'status.discord.com'))
+                self.assertIsNone(candidate.match(443, 'example.com'))
+                self.assertIsNotNone(candidate.match(80, address='162.159.130.1'))
+                self.assertIsNone(candidate.match(80, address='8.8.8.8'))
+            self.assertTrue(worker_dispatcher.get_stats()['snapshot'])
+
+            # Изменение списка: снимок устарел и пересобирается, старый mmap работает
+            with open(os.path.join(lists_dir, 'list-general.txt'), 'a') as f:
+                f.write('rutracker.org\n')
+            self.assertTrue(reopened.is_stale())
+            rebuilt = ListSnapshot.open(base_dir)
+            self.assertGreater(rebuilt.build_time, 0)
+            self.assertIn('rutracker.org', rebuilt.domains)
+            self.assertNotIn('rutracker.org', reopened.domains)
+
+            # Повреждённый файл не загружается, а пересобирается
+            with open(os.path.join(lists_dir, 'compiled.bin'), 'wb') as f:
+                f.write(b'garbage')
+            self.assertIn('rutracker.org', ListSnapshot.open(base_dir).domains)
+
+            # Правка списка во время сборки: отпечаток снят до чтения, и
+            # снимок без новой строки считается устаревшим
+            add_file = list_snapshot.DomainSuffixIndex.add_file
+
+            def add_file_then_edit(index, path, name=None):
+                bit = add_file(index, path, name)
+                if name == 'lists/list-general.txt':
+                    with open(path, 'a') as f:
+                        f.write('late.example\n')
+                return bit
+
+            list_snapshot.DomainSuffixIndex.add_file = add_file_then_edit
+            try:
+                build_snapshot(base_dir)
+            finally:
+                list_snapshot.DomainSuffixIndex.add_file = add_file
+            self.assertTrue(ListSnapshot(os.path.join(lists_dir, 'compiled.bin'),
+                                         base_dir).is_stale())
+            self.assertIn('late.example', ListSnapshot.open(base_dir).domains)
+
+            # Параллельные сборки не делят временный файл
+            errors = []
+
+            def build():
+                try:
+                    for _ in range(20):
+                        build_snapshot(base_dir)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=build) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(sorted(name for name in os.listdir(lists_dir)
+                                    if name.startswith('compiled')), ['compiled.bin'])
+            self.assertIn('rutracker.org', ListSnapshot.open(base_dir).domains)
+
+        print("[✓] Снимок списков загружается через mmap и пересобирается при изменениях")
+
+    def test_23_conditional_list_update(self):
+        """Тест обновления списков: ETag, 304, атомарная замена, без лишней сборки"""
+        import tempfile
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from zapret_core import ZapretCore
+
+        bodies = {'/general': b'youtube.com\ndiscord.com\n', '/ipset': b'162.159.128.0/19\n'}
+        requests_log = []
+
+        class ListHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = bodies.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                etag = '"%d"' % hash(body)
+                conditional = self.path != '/ipset'  # ipset отдаётся без ETag
+                requests_log.append((self.path, self.headers.get('If-None-Match')))
+                if conditional and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                if conditional:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), ListHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        sources = {'list-general.txt': url + '/general', 'ipset-all.txt': url + '/ipset'}
+
+        try:
+            with tempfile.TemporaryDirectory() as base_dir:
+                core = ZapretCore(base_dir)
+                builds = []
+                compile_lists = core.compile_lists
+                core.compile_lists = lambda: builds.append(1) or compile_lists()
+
+                self.assertEqual(sorted(core.update_lists(sources)),
+                                 ['ipset-all.txt', 'list-general.txt'])
+                self.assertEqual(len(builds), 1)
+                self.assertIn('discord.com', core.snapshot.domains)
+                with open(os.path.join(core.config_file)) as f:
+                    validators = json.load(f)['list_validators']
+                self.assertTrue(validators['list-general.txt']['etag'])
+
+                # Без изменений: 304 для general, тот же хэш для ipset - без сборки
+                requests_log.clear()
+                self.assertEqual(core.update_lists(sources), [])
+                self.assertEqual(len(builds), 1)
+                self.assertIn(('/general', validators['list-general.txt']['etag']), requests_log)
+
+                # Изменился один список - заменяется только он
+                bodies['/general'] += b'rutracker.org\n'
+                self.assertEqual(core.update_lists(sources), ['list-general.txt'])
+                self.assertEqual(len(builds), 2)
+                self.assertIn('rutracker.org', core.snapshot.domains)
+                self.assertFalse(any(name.endswith('.tmp')
+                                     for name in os.listdir(core.lists_dir)))
+
+                # Ошибка источника не портит текущий файл
+                self.assertEqual(core.update_lists({'list-general.txt': url + '/missing'}), [])
+                with open(os.path.join(core.lists_dir, 'list-general.txt'), 'rb') as f:
+                    self.assertEqual(f.read(), bodies['/general'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        print("[✓] Списки обновляются условными запросами и заменяются атомарно")
+
+    def test_24_hot_list_reload(self):
+        """Тест перезагрузки списков на ходу без разрыва соединений"""
+        import tempfile
+        from dpi_bypass import DPIBypass, DPIStrategy, ProxyMode
+        from list_snapshot import ListSnapshot
+        from list_watcher import ListWatcher
+        from strategy_rules import StrategyDispatcher
+
+        def wait_reloads(dispatcher, count):
+            deadline = time.time() + 5
+            while dispatcher.get_stats()['reloads'] < count and time.time() < deadline:
+                time.sleep(0.02)
+            return dispatcher.get_stats()['reloads'] >= count
+
+        with tempfile.TemporaryDirectory() as base_dir:
+            lists_dir = os.path.join(base_dir, 'lists')
+            os.makedirs(lists_dir)
+            general = os.path.join(lists_dir, 'list-general.txt')
+            with open(general, 'w') as f:
+                f.write('example.com\n')
+
+            # Слежение: изменение, появление и удаление файлов
+            changes = []
+            watcher = ListWatcher(lists_dir, changes.append, interval=0.05)
+            self.assertEqual(watcher.check(), [])
+            with open(os.path.join(lists_dir, 'list-new.txt'), 'w') as f:
+                f.write('new.org\n')
+            self.assertEqual(watcher.check(), [os.path.join(lists_dir, 'list-new.txt')])
+            os.remove(os.path.join(lists_dir, 'list-new.txt'))
+            self.assertEqual(len(watcher.check()), 1)
+            self.assertEqual(len(changes), 2)
+
+            upstream = start_echo_server()
+            upstream_port = upstream.getsockname()[1]
+            params = {'params': [
+                f'--filter-tcp={upstream_port} --hostlist="lists/list-general.txt" '
+                '--dpi-desync=hostfakesplit',
+            ]}
+            request = b'GET / HTTP/1.1\r\nHost: example.org\r\n\r\n'
+            try:
+                # Текстовые списки: открытое соединение переживает перезагрузку
+                dispatcher = StrategyDispatcher.from_strategy_params(params, base_dir)
+                dispatcher.watch(interval=0.05)
+                proxy = DPIBypass().create_proxy_server(0, '127.0.0.1', upstream_port,
+                                                        DPIStrategy.MULTISPLIT,
+                                                        mode=ProxyMode.THREAD,
+                                                        dispatcher=dispatcher)
+                thread = threading.Thread(target=proxy.start,
+                                          args=(0, '127.0.0.1', upstream_port), daemon=True)
+                thread.start()
+                self.assertTrue(proxy.ready.wait(5))
+
+                with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as old:
+                    old.sendall(request)
+                    self.assertEqual(recv_until(old), request)
+
+                    old_tables = dispatcher.tables
+                    with open(general, 'a') as f:
+                        f.write('example.org\n')
+                    self.assertTrue(wait_reloads(dispatcher, 1))
+                    self.assertIsNot(dispatcher.tables, old_tables)
+
+                    old.sendall(b'ping')
+                    self.assertEqual(recv_until(old, b'ping'), b'ping')
+                    with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=5) as new:
+                        new.sendall(request)
+                        self.assertEqual(recv_until(new), request)
+                    # Новое соединение уже выбрало правило по обновлённому списку
+                    self.assertEqual(proxy.get_stats()['desynced'], 1)
+
+                dispatcher.stop_watching()
+                proxy.stop()
+                thread.join(5)
+
+                # Снимок: воркер подхватывает пересобранный compiled.bin
+                dispatcher = StrategyDispatcher.from_strategy_params(
+                    params, base_dir, ListSnapshot.open(base_dir))
+                dispatcher.watch(interval=0.05)
+                old_tables = dispatcher.tables
+                self.assertIsNone(dispatcher.match(upstream_port, 'rutracker.org'))
+                with open(general, 'a') as f:
+                    f.write('rutracker.org\n')
+                self.assertGreater(ListSnapshot.open(base_dir).build_time, 0)
+                self.assertTrue(wait_reloads(dispatcher, 1))
+                self.assertIsNotNone(dispatcher.match(upstream_port, 'rutracker.org'))
+                # Старое поколение таблиц не изменилось (его ещё могут читать)
+                self.assertFalse(old_tables.index.lookup('rutracker.org'))
+                stats = dispatcher.get_stats()
+                self.assertGreater(stats['reload_ms'], 0)
+                self.assertGreater(stats['reload_latency_ms'], 0)
+                dispatcher.stop_watching()
+            finally:
+                upstream.close()
+
+        print("[✓] Списки перезагружаются без перезапуска прокси")
+
+    def test_25_in_process_proxy(self):
+        """Тест движка прокси в процессе ядра с правилами выбранной стратегии"""
+        import tempfile
+        from zapret_core import ZapretCore
+
+        upstream = start_echo_server()
+        upstream_port = upstream.getsockname()[1]
+        params = {'params': [
+            f'--filter-tcp={upstream_port} --hostlist="lists/list-general.txt" '
+            '--dpi-desync=hostfakesplit',
+        ]}
+        listed = b'GET / HTTP/1.1\r\nHost: www.youtube.com\r\n\r\n'
+        unlisted = b'GET / HTTP/1.1\r\nHost: example.org\r\n\r\n'
+
+        try:
+            with tempfile.TemporaryDirectory() as base_dir:
+                core = ZapretCore(base_dir)
+                # Снимок собирается при запуске прокси, а не при создании ядра
+                compiled = os.path.join(core.lists_dir, 'compiled.bin')
+                self.assertFalse(os.path.exists(compiled))
+                started = time.perf_counter()
+                port = core.start_proxy(params, 0, target=('127.0.0.1', upstream_port))
+                start_time = time.perf_counter() - started
+                self.assertLess(start_time, 1.0)
+                self.assertTrue(os.path.exists(compiled))
+                # Проверка стратегии идёт к хосту из её списков
+                self.assertIn('youtube.com', list(core.probe_hosts(params, upstream_port)))
+                self.assertEqual(list(core.probe_hosts(params, 443)), [])
+
+                # Сервер получает ровно те байты, что отправил клиент
+                with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+                    client.sendall(listed)
+                    self.assertEqual(recv_until(client), listed)
+                with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+                    client.sendall(unlisted)
+                    self.assertEqual(recv_until(client), unlisted)
+
+                # Изменённый список применяется сразу, без перезапуска
+                with open(os.path.join(core.lists_dir, 'list-general.txt'), 'a') as f:
+                    f.write('\nexample.org\n')
+                core.reload_lists([os.path.join(core.lists_dir, 'list-general.txt')])
+                with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+                    client.sendall(unlisted)
+                    self.assertEqual(recv_until(client), unlisted)
+
+                stats = core.get_proxy_stats()
+                self.assertEqual(stats['connections'], 3)
+                self.assertEqual(stats['desynced'], 2)
+                self.assertEqual(stats['dispatcher']['matched'], 2)
+
+                # Смена стратегии пересобирает перенаправление, только если
+                # изменились порты
+                redirects = []
+                core.setup_proxy_redirect = lambda port, params: redirects.append(
+                    (port, params['tcp_ports'], params['udp_ports']))
+                core.strategy_params = params
+                self.assertTrue(core.switch_strategy('ALT9'))
+                self.assertEqual(redirects, [(core.config['proxy_port'],
+                                              '80,443,2053,2083,2087,2096,8443',
+                                              '443,19294-19344,50000-50100')])
+                self.assertTrue(core.switch_strategy('SIMPLE_FAKE'))
+                self.assertEqual(len(redirects), 1)
+                self.assertTrue(core.switch_strategy('AUTO'))
+                self.assertEqual(redirects[-1][1:], ('80,443', '443'))
+
+                started = time.perf_counter()
+                core.stop_proxy()
+                self.assertLess(time.perf_counter() - started, 1.0)
+                self.assertIsNone(core.get_proxy_stats())
+                with self.assertRaises(OSError):
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        finally:
+            upstream.close()
+
+        print(f"[✓] Прокси запускается в процессе ядра за {start_time * 1000:.1f} мс")
+
+    def test_26_strategy_switch(self):
+        """Тест смены стратегии без перезапуска прокси и воркеров"""
+        from dpi_bypass import DPIStrategy
+        from proxy_workers import ProxyWorkerSupervisor
+        from strategy_rules import StrategyDispatcher, parse_strategy_params
+
+        upstream = start_echo_server()
+        upstream_port = upstream.getsockname()[1]
+        passthrough = {'params': [
+            f'--filter-tcp={upstream_port} --hostlist-domains=example.org --dpi-desync=split',
+        ]}
+        hostfake = {'params': [
+            f'--filter-tcp={upstream_port} --hostlist-domains=example.com '
+            '--dpi-desync=hostfakesplit',
+        ]}
+        request = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+
+        dispatcher = StrategyDispatcher.from_strategy_params(passthrough)
+        old_tables = dispatcher.tables
+        self.assertIsNone(dispatcher.match(upstream_port, 'example.com'))
+        dispatcher.replace_rules(parse_strategy_params(hostfake))
+        self.assertEqual(dispatcher.match(upstream_port, 'example.com').strategy,
+                         DPIStrategy.HOST_FAKE_SPLIT)
+        # Предыдущее поколение правил не изменилось
+        self.assertEqual(len(old_tables.rules), 1)
+        self.assertEqual(old_tables.rules[0].strategy, DPIStrategy.MULTISPLIT)
+        self.assertEqual(dispatcher.get_stats()['switches'], 1)
+
+        # Перезагрузка списков во время смены правил не возвращает старые:
+        # медленная сборка в reload() завершается позже replace_rules()
+        build_tables = dispatcher._build_tables
+        delays = [0.2]
+
+        def slow_build(rules, snapshot):
+            if delays:
+                time.sleep(delays.pop())
+            return build_tables(rules, snapshot)
+
+        dispatcher._build_tables = slow_build
+        reload_thread = threading.Thread(target=dispatcher.reload)
+        reload_thread.start()
+        time.sleep(0.05)
+        dispatcher.replace_rules(parse_strategy_params(passthrough))
+        reload_thread.join(5)
+        self.assertEqual(dispatcher.rules[0].strategy, DPIStrategy.MULTISPLIT)
+
+        supervisor = ProxyWorkerSupervisor(
+            0, '127.0.0.1', upstream_port, DPIStrategy.AUTO, workers=2,
+            stats_interval=0.05, check_interval=0.05,
+            dispatcher=StrategyDispatcher.from_strategy_params(passthrough))
+        try:
+            port = supervisor.start()
+            self.assertTrue(supervisor.wait_ready(30))
+            pids = [process.pid for process in supervisor._processes]
+
+            def settled(total):
+                # Отчёты воркеров приходят раз в stats_interval: ждём, пока
+                # в сводке появятся все обслуженные соединения
+                wait_deadline = time.time() + 5
+                stats = supervisor.get_stats()
+                while stats['connections'] < total and time.time() < wait_deadline:
+                    time.sleep(0.02)
+                    stats = supervisor.get_stats()
+                return stats
+
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as old:
+                old.sendall(request)
+                self.assertEqual(recv_until(old), request)
+                sent = 1
+                desynced = settled(sent)['desynced']
+                self.assertEqual(desynced, 0)
+
+                # Правило сработало, если соединение попало в stats['desynced']
+                self.assertTrue(supervisor.replace_rules(parse_strategy_params(hostfake)))
+                deadline = time.time() + 20
+                switched = 0
+                while switched < 20 and time.time() < deadline:
+                    with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+                        client.sendall(request)
+                        self.assertEqual(recv_until(client), request)
+                    sent += 1
+                    current = settled(sent)['desynced']
+                    switched = switched + 1 if current > desynced else 0
+                    desynced = current
+                self.assertEqual(switched, 20)
+
+                # Соединение, открытое до смены, продолжает работать
+                old.sendall(b'ping')
+                self.assertEqual(recv_until(old, b'ping'), b'ping')
+
+            self.assertEqual([process.pid for process in supervisor._processes], pids)
+            self.assertEqual(supervisor.get_stats()['restarts'], 0)
+        finally:
+            supervisor.stop()
+            upstream.close()
+
+        print("[✓] Стратегия меняется без перезапуска прокси")
+
+    def test_27_iptables_restore(self):
+        """Тест правил перенаправления: одна транзакция, своя цепочка"""
+        import tempfile
+        from firewall import IptablesRedirect, multiport_groups
+
+        self.assertEqual(multiport_groups('80,443,19294-19344,50000-50100'),
+                         ['80,443,19294:19344,50000:50100'])
+        groups = multiport_groups(','.join(str(port) for port in range(1000, 1020)))
+        self.assertEqual([len(group.split(',')) for group in groups], [15, 5])
+        self.assertEqual(multiport_groups('1-2,3-4,5-6,7-8,9-10,11-12,13-14,15-16'),
+                         ['1:2,3:4,5:6,7:8,9:10,11:12,13:14', '15:16'])
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            # Фиктивный iptables: пишет вызовы в журнал и помнит переход из OUTPUT
+            log_path = os.path.join(work_dir, 'calls.log')
+            state_path = os.path.join(work_dir, 'jump')
+            fake = os.path.join(work_dir, 'fake_iptables')
+            with open(fake, 'w') as f:
+                f.write(f'''#!{sys.executable}
+import json, os, sys
+rules = sys.stdin.read() if '--noflush' in sys.argv else ''
+with open({log_path!r}, 'a') as log:
+    log.write(json.dumps([sys.argv[1:], rules]) + '\\n')
+if '-C' in sys.argv:
+    sys.exit(0 if os.path.exists({state_path!r}) else 1)
+if '-A OUTPUT -j ZAPRET' in rules:
+    open({state_path!r}, 'w').close()
+if '-D OUTPUT -j ZAPRET' in rules:
+    os.remove({state_path!r})
+''')
+            os.chmod(fake, 0o755)
+
+            def calls():
+                with open(log_path) as log:
+                    return [json.loads(line) for line in log]
+
+            firewall = IptablesRedirect(fake, fake)
+            self.assertTrue(firewall.setup(8080, '80,443,2053,50000-50100', exclude_uid=10123))
+            restores = [rules for args, rules in calls() if args == ['--noflush']]
+            self.assertEqual(len(restores), 1)
+            rules = restores[0]
+            self.assertIn(':ZAPRET - [0:0]', rules)
+            self.assertIn('-A ZAPRET -m owner --uid-owner 10123 -j RETURN', rules)
+            self.assertIn('-A ZAPRET -p tcp -m multiport --dports 80,443,2053,50000:50100 '
+                          '-j REDIRECT --to-ports 8080', rules)
+            self.assertEqual(rules.count('-A OUTPUT -j ZAPRET'), 1)
+            self.assertTrue(rules.endswith('COMMIT\n'))
+            self.assertEqual(firewall.get_stats()['rules'], 3)
+            self.assertGreater(firewall.get_stats()['setup_ms'], 0)
+
+            # Повторная установка заменяет цепочку, но не дублирует переход
+            self.assertTrue(firewall.setup(8081, '443'))
+            rules = [rules for args, rules in calls() if args == ['--noflush']][-1]
+            self.assertNotIn('-A OUTPUT', rules)
+            self.assertIn('--to-ports 8081', rules)
+
+            # Снятие: только своя цепочка, без -F для всей таблицы
+            self.assertTrue(firewall.teardown())
+            rules = [rules for args, rules in calls() if args == ['--noflush']][-1]
+            self.assertIn('-D OUTPUT -j ZAPRET', rules)
+            self.assertIn('-X ZAPRET', rules)
+            self.assertFalse(os.path.exists(state_path))
+            self.assertFalse(any(args in (['-F'], ['-t', 'nat', '-F']) for args, _ in calls()))
+            self.assertTrue(firewall.teardown())
+            self.assertNotIn('-D OUTPUT', calls()[-1][1])
+
+        # Без iptables (нет root) установка просто не удаётся
+        self.assertFalse(IptablesRedirect('/nonexistent/iptables',
+                                          '/nonexistent/iptables-restore').setup(8080, '443'))
+
+        print("[✓] Правила iptables ставятся одной транзакцией в цепочку ZAPRET")
+
+    def test_28_kernel_ipset(self):
+        """Тест набора адресов в ядре: пакет ipset restore и правила по нему"""
+        import tempfile
+        from firewall import (KernelIpset, build_redirect_rules, ipv4_networks,
+                              resolve_ipv4)
+
+        self.assertEqual(ipv4_networks(['10.1.2.3/8', '10.0.0.0/8', '192.0.2.1',
+                                        '2a00:1450::/32', 'мусор', '10.0.0.0/33']),
+                         ['10.0.0.0/8', '192.0.2.1/32'])
+        self.assertEqual(resolve_ipv4(['localhost', 'invalid..name']), ['127.0.0.1'])
+
+        rules = build_redirect_rules(8080, '80,443', ipsets=['zapret'])
+        self.assertIn('-A ZAPRET -p tcp -m set --match-set zapret dst '
+                      '-m multiport --dports 80,443 -j REDIRECT --to-ports 8080', rules)
+        self.assertNotIn('-p tcp -m multiport', rules)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            log_path = os.path.join(work_dir, 'calls.log')
+            fake = os.path.join(work_dir, 'fake_ipset')
+            with open(fake, 'w') as f:
+                f.write(f'''#!{sys.executable}
+import json, sys
+batch = sys.stdin.read() if sys.argv[1:] == ['restore'] else ''
+with open({log_path!r}, 'a') as log:
+    log.write(json.dumps([sys.argv[1:], batch]) + '\\n')
+''')
+            os.chmod(fake, 0o755)
+
+            ipset = KernelIpset(fake)
+            self.assertTrue(ipset.load(['162.159.128.0/19', '162.159.130.1',
+                                        '162.159.128.0/19', '2606:4700::/32']))
+            self.assertEqual(ipset.get_stats()['entries'], 2)
+            with open(log_path) as log:
+                calls = [json.loads(line) for line in log]
+            # Один вызов: временный набор заполняется и подменяет рабочий
+            self.assertEqual(len(calls), 1)
+            batch = calls[0][1].splitlines()
+            self.assertEqual(batch[0], 'create zapret-tmp hash:net family inet '
+                                       'maxelem 65536 -exist')
+            self.assertEqual(batch[2:4], ['add zapret-tmp 162.159.128.0/19',
+                                          'add zapret-tmp 162.159.130.1/32'])
+            self.assertEqual(batch[-2:], ['swap zapret-tmp zapret', 'destroy zapret-tmp'])
+
+            self.assertTrue(ipset.destroy())
+            with open(log_path) as log:
+                self.assertEqual(json.loads(log.readlines()[-1])[0], ['destroy', 'zapret'])
+
+        self.assertFalse(KernelIpset('/nonexistent/ipset').load(['10.0.0.0/8']))
+
+        print("[✓] Адреса загружаются в ipset ядра одним пакетом")
+
+    def test_29_udp_relay(self):
+        """Тест UDP-ретранслятора: потоки, фейки на первой датаграмме, вытеснение"""
+        from dpi_bypass import DPIBypass, DPIStrategy
+        from firewall import build_tproxy_rules, build_tproxy_routes
+        from protocol_classifier import Protocol, classify_datagram
+        from udp_relay import UDPRelay
+
+        bypass = DPIBypass()
+        fake = bypass.templates.get('quic_initial_www_google_com')
+        self.assertEqual(classify_datagram(fake), Protocol.QUIC)
+        stun = b'\x00\x01\x00\x00\x21\x12\xa4\x42' + bytes(12)
+        self.assertEqual(classify_datagram(stun), Protocol.STUN)
+        self.assertEqual(classify_datagram(b'\x00\x01\x00\x46' + bytes(70)), Protocol.DISCORD)
+        self.assertEqual(classify_datagram(b'\x80\x78' + bytes(10)), Protocol.DISCORD)
+        self.assertEqual(classify_datagram(b'ping'), Protocol.UNKNOWN)
+
+        # Локальный UDP-сервер вместо TPROXY: записывает датаграммы, эхо на ping
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        received = []
+
+        def serve():
+            while True:
+                try:
+                    data, address = server.recvfrom(65535)
+                except OSError:
+                    break
+                received.append(data)
+                if data.startswith(b'ping'):
+                    server.sendto(data, address)
+
+        threading.Thread(target=serve, daemon=True).start()
+
+        relay = UDPRelay(bypass, DPIStrategy.FAKE_QUIC, idle_timeout=0.3)
+        thread = threading.Thread(target=relay.start,
+                                  args=(0, '127.0.0.1', server.getsockname()[1]),
+                                  daemon=True)
+        thread.start()
+        self.assertTrue(relay.ready.wait(5))
+        repeats = bypass.strategy_configs[DPIStrategy.FAKE_QUIC]['repeats']
+
+        clients = []
+        try:
+            for _ in range(2):
+                client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                client.settimeout(5)
+                clients.append(client)
+                for number in range(20):
+                    client.sendto(b'ping %d' % number, ('127.0.0.1', relay.listen_port))
+                    self.assertEqual(client.recv(65535), b'ping %d' % number)
+
+            # Фейки только перед первой датаграммой каждого потока
+            # (случайные поля шаблона у каждого фейка свои)
+            fakes = [data for data in received if classify_datagram(data) == Protocol.QUIC]
+            self.assertEqual(len(fakes), 2 * repeats)
+            self.assertTrue(all(len(data) == len(fake) for data in fakes))
+            self.assertEqual(received[repeats], b'ping 0')
+            deadline = time.time() + 5
+            while relay.get_stats()['datagrams_in'] < 40 and time.time() < deadline:
+                time.sleep(0.01)
+            stats = relay.get_stats()
+            self.assertEqual(stats['flows'], 2)
+            self.assertEqual(stats['opened'], 2)
+            self.assertEqual(stats['fakes'], 2 * repeats)
+            self.assertEqual(stats['datagrams_out'], 40)
+            self.assertEqual(stats['datagrams_in'], 40)
+
+            # Простаивающие потоки закрываются, новый получает фейки заново
+            deadline = time.time() + 5
+            while relay.get_stats()['flows'] and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(relay.get_stats()['flows'], 0)
+            self.assertEqual(relay.get_stats()['idle_evicted'], 2)
+            clients[0].sendto(b'ping again', ('127.0.0.1', relay.listen_port))
+            self.assertEqual(clients[0].recv(65535), b'ping again')
+            self.assertEqual(sum(classify_datagram(data) == Protocol.QUIC
+                                 for data in received), 3 * repeats)
+        finally:
+            relay.stop()
+            thread.join(5)
+            server.close()
+            for client in clients:
+                client.close()
+        self.assertFalse(thread.is_alive())
+
+        # Переполненная таблица вытесняет самый старый поток
+        relay = UDPRelay(bypass, DPIStrategy.MULTISPLIT, max_flows=1)
+        thread = threading.Thread(target=relay.start, args=(0, '127.0.0.1', 9), daemon=True)
+        thread.start()
+        self.assertTrue(relay.ready.wait(5))
+        try:
+            for _ in range(3):
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+                    client.sendto(b'x', ('127.0.0.1', relay.listen_port))
+                    deadline = time.time() + 5
+                    while relay.get_stats()['datagrams_out'] + relay.get_stats()['dropped'] < 1 \
+                            and time.time() < deadline:
+                        time.sleep(0.01)
+            deadline = time.time() + 5
+            while relay.get_stats()['opened'] < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertLessEqual(relay.get_stats()['flows'], 1)
+            self.assertEqual(relay.get_stats()['fakes'], 0)
+        finally:
+            relay.stop()
+            thread.join(5)
+
+        rules = build_tproxy_rules(8080, '443,50000-50100', exclude_uid=10123)
+        self.assertIn('-A ZAPRET_UDP -p udp -m multiport --dports 443,50000:50100 '
+                      '-j MARK --set-mark 0x1', rules)
+        self.assertIn('-A ZAPRET_UDP_TPROXY -p udp -m mark --mark 0x1 -j TPROXY '
+                      '--on-ip 127.0.0.1 --on-port 8080 --tproxy-mark 0x1', rules)
+        self.assertIn('-A PREROUTING -j ZAPRET_UDP_TPROXY', rules)
+        self.assertIn('rule add fwmark 0x1 lookup 100', build_tproxy_routes())
+
+        print("[✓] UDP-ретранслятор держит таблицу потоков и шлёт фейки один раз")
+
+    def test_30_packet_engine(self):
+        """Тест пакетного движка: фейки и части на уровне IP/TCP, pcap, вердикты"""
+        import ssl
+        import struct
+        import tempfile
+        from dpi_bypass import DPIBypass, DPIStrategy
+        from firewall import build_nfqueue_rules
+        from packet_engine import (PacketEngine, QueuedPacket, internet_checksum,
+                                   parse_packet, read_pcap, write_pcap, nfq_message,
+                                   nfq_verdict_message, parse_nfq_messages, NF_ACCEPT,
+                                   NF_DROP, NFQA_PACKET_HDR, NFQA_PAYLOAD, NFQNL_MSG_PACKET,
+                                   TS_INCREMENT, TCP_OPTION_MD5SIG, BADSEQ_INCREMENT)
+        from strategy_rules import StrategyDispatcher
+
+        # Пример заголовка IPv4 с верной суммой: проверка даёт 0
+        header = bytes.fromhex('4500003c1c4640004006b1e6ac100a63ac100a0c')
+        self.assertEqual(internet_checksum(header), 0)
+
+        incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+        tls = ssl.create_default_context().wrap_bio(incoming, outgoing,
+                                                    server_hostname='example.com')
+        with self.assertRaises(ssl.SSLWantReadError):
+            tls.do_handshake()
+        hello = outgoing.read()
+
+        src, dst = socket.inet_aton('10.0.0.2'), socket.inet_aton('93.184.216.34')
+
+        def checksum_ok(packet):
+            info = parse_packet(packet)
+            segment = bytes(packet[info.ip_header_len:info.length])
+            pseudo = struct.pack('!4s4sBBH', info.src, info.dst, 0, info.proto, len(segment))
+            return (internet_checksum(packet[:info.ip_header_len]) == 0 and
+                    internet_checksum(pseudo + segment) == 0)
+
+        def tcp_packet(payload, seq, sport=40000, tsval=123456789):
+            options = b'\x01\x01\x08\x0a' + struct.pack('!II', tsval, 1)
+            tcp = struct.pack('!HHIIBBHHH', sport, 443, seq, 5000, (32 // 4) << 4, 0x18,
+                              64240, 0, 0) + options + payload
+            ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 1, 0x4000, 64, 6, 0,
+                             src, dst)
+            ip = ip[:10] + struct.pack('!H', internet_checksum(ip)) + ip[12:]
+            pseudo = struct.pack('!4s4sBBH', src, dst, 0, 6, len(tcp))
+            checksum = internet_checksum(pseudo + tcp)
+            return ip + tcp[:16] + struct.pack('!H', checksum) + tcp[18:]
+
+        def udp_packet(payload):
+            udp = struct.pack('!HHHH', 50000, 443, 8 + len(payload), 0) + payload
+            pseudo = struct.pack('!4s4sBBH', src, dst, 0, 17, len(udp))
+            udp = udp[:6] + struct.pack('!H', internet_checksum(pseudo + udp)) + udp[8:]
+            ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 2, 0, 64, 17, 0,
+                             src, dst)
+            return ip[:10] + struct.pack('!H', internet_checksum(ip)) + ip[12:] + udp
+
+        bypass = DPIBypass()
+        quic = bypass.templates.get('quic_initial_www_google_com')
+        first = tcp_packet(hello, 1000)
+        second = tcp_packet(b'\x17\x03\x03\x00\x05hello', 1000 + len(hello))
+        datagram = udp_packet(quic)
+        self.assertTrue(checksum_ok(first) and checksum_ok(datagram))
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            # Захват с Ethernet (и меткой VLAN) - как из tcpdump
+            pcap_path = os.path.join(work_dir, 'capture.pcap')
+            with open(pcap_path, 'wb') as f:
+                f.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+                for packet, vlan in ((first, False), (second, True), (datagram, False)):
+                    frame = bytes(12) + (b'\x81\x00\x00\x05' if vlan else b'') + \
+                        b'\x08\x00' + packet + bytes(4)
+                    f.write(struct.pack('<IIII', 0, 0, len(frame), len(frame)) + frame)
+            self.assertEqual([packet[:len(expected)] for packet, expected in
+                              zip(read_pcap(pcap_path), (first, second, datagram))],
+                             [first, second, datagram])
+
+            dispatcher = StrategyDispatcher.from_strategy_params({'params': [
+                '--filter-tcp=443 --hostlist-domains=example.com --dpi-desync=fake '
+                '--dpi-desync-repeats=2 --dpi-desync-fooling=md5sig,ts --dpi-desync-ttl=3',
+                '--filter-udp=443 --filter-l7=quic --dpi-desync=fake --dpi-desync-repeats=3',
+            ]}, work_dir)
+            engine = PacketEngine(bypass, dispatcher=dispatcher)
+            output = engine.replay_pcap(pcap_path)
+
+            # TCP: два фейка с TTL 3, опцией MD5 и сдвинутым TSval, затем оригинал
+            self.assertEqual(len(output), 2 + 1 + 1 + 3 + 1)
+            for fake in output[:2]:
+                info = parse_packet(fake)
+                self.assertEqual(info.ttl, 3)
+                self.assertEqual(info.seq, 1000)
+                self.assertTrue(checksum_ok(fake))
+                options = bytes(fake[info.ip_header_len + 20:info.payload_offset])
+                self.assertIn(bytes((TCP_OPTION_MD5SIG, 18)), options)
+                tsval, = struct.unpack_from('!I', options, 4)
+                self.assertEqual(tsval, (123456789 + TS_INCREMENT) & 0xFFFFFFFF)
+                self.assertNotEqual(bytes(fake[info.payload_offset:]), hello)
+            self.assertEqual(output[2][:len(first)], first)
+            # Только первый полёт: следующий сегмент не тронут
+            self.assertEqual(output[3][:len(second)], second)
+            # UDP: фейковые QUIC Initial с TTL из autottl перед датаграммой
+            for fake in output[4:7]:
+                self.assertEqual(parse_packet(fake).ttl, 2)
+                self.assertTrue(checksum_ok(fake))
+            self.assertEqual(output[7][:len(datagram)], datagram)
+            stats = engine.get_stats()
+            self.assertEqual(stats['fakes'], 5)
+            self.assertEqual(stats['modified'], 2)
+
+            write_pcap(os.path.join(work_dir, 'out.pcap'), output)
+            self.assertEqual(list(read_pcap(os.path.join(work_dir, 'out.pcap'))), output)
+
+        # disorder: части с правильными seq в обратном порядке, склеиваются в оригинал
+        engine = PacketEngine(bypass, DPIStrategy.MULTIDISORDER)
+        parts = engine.process(tcp_packet(hello, 7000, sport=40001))
+        self.assertEqual(len(parts), 2)
+        infos = [parse_packet(part) for part in parts]
+        self.assertGreater(infos[0].seq, infos[1].seq)
+        self.assertTrue(all(checksum_ok(part) for part in parts))
+        stream = b''.join(bytes(part[info.payload_offset:]) for part, info in
+                          sorted(zip(parts, infos), key=lambda item: item[1].seq))
+        self.assertEqual(stream, hello)
+        self.assertEqual(infos[1].seq, 7000)
+
+        # Вердикты: пропускаемые - одним пакетным, замена - DROP и отправка своих
+        class FakeQueue:
+            def __init__(self):
+                self.calls = []
+
+            def verdict(self, packet_id, verdict, payload=None):
+                self.calls.append(('verdict', packet_id, verdict))
+
+            def verdict_batch(self, packet_id, verdict):
+                self.calls.append(('batch', packet_id, verdict))
+
+        class FakeInjector:
+            def __init__(self):
+                self.sent = []
+
+            def send(self, packets):
+                self.sent.extend(packets)
+
+        engine = PacketEngine(bypass, DPIStrategy.FAKE_TLS)
+        queue, injector = FakeQueue(), FakeInjector()
+        engine.handle_batch(queue, injector, [
+            QueuedPacket(1, b'\x45' + bytes(30)),
+            QueuedPacket(2, tcp_packet(b'', 1, sport=40010)),
+            QueuedPacket(3, tcp_packet(hello, 1, sport=40011)),
+            QueuedPacket(4, tcp_packet(hello, 1, sport=40012)),
+            QueuedPacket(5, tcp_packet(b'x', 1 + len(hello), sport=40011)),
+            QueuedPacket(6, tcp_packet(b'y', 1 + len(hello), sport=40012)),
+        ])
+        self.assertEqual(queue.calls, [('batch', 2, NF_ACCEPT), ('verdict', 3, NF_DROP),
+                                       ('verdict', 4, NF_DROP), ('batch', 6, NF_ACCEPT)])
+        repeats = bypass.strategy_configs[DPIStrategy.FAKE_TLS]['repeats']
+        self.assertEqual(len(injector.sent), 2 * (repeats + 1))
+
+        # Сообщения netlink: пакет из очереди и вердикты
+        payload = tcp_packet(hello, 1)
+        attributes = (struct.pack('=HH', 4 + 7, NFQA_PACKET_HDR) +
+                      struct.pack('!IHB', 77, 0x0800, 3) + bytes(1) +
+                      struct.pack('=HH', 4 + len(payload), NFQA_PAYLOAD) + payload +
+                      bytes(-len(payload) % 4))
+        message = nfq_message(NFQNL_MSG_PACKET, 200, attributes)
+        self.assertEqual(parse_nfq_messages(message + message),
+                         [QueuedPacket(77, payload), QueuedPacket(77, payload)])
+        error = struct.pack('=IHHII', 16 + 4, 2, 0, 1, 0) + struct.pack('=i', -1)
+        with self.assertRaises(OSError):
+            parse_nfq_messages(error)
+        verdict = nfq_verdict_message(200, 77, NF_ACCEPT, batch=True)
+        self.assertEqual(struct.unpack_from('=H', verdict, 4)[0], (3 << 8) | 3)
+        self.assertEqual(verdict[-8:], struct.pack('!II', NF_ACCEPT, 77))
+
+        # FAKE_DSPLIT: фейки с настоящими seq обязаны нести обман
+        engine = PacketEngine(DPIBypass(), DPIStrategy.FAKE_DSPLIT)
+        result = engine.process(first)
+        self.assertEqual(len(result), 4)
+        pos = min(len(hello) // 2, 500)
+        for item, offset in ((result[0], 0), (result[2], pos)):
+            info = parse_packet(bytes(item))
+            self.assertEqual(info.ttl, 2)
+            self.assertEqual(info.seq, (1000 + offset + BADSEQ_INCREMENT) & 0xFFFFFFFF)
+            self.assertTrue(checksum_ok(bytes(item)))
+        self.assertEqual(parse_packet(bytes(result[1])).seq, 1000)
+
+        # Без fooling и TTL фейки не отправляются, остаются только части
+        plain = DPIBypass()
+        plain.strategy_configs[DPIStrategy.FAKE_DSPLIT] = {}
+        engine = PacketEngine(plain, DPIStrategy.FAKE_DSPLIT)
+        result = engine.process(first)
+        self.assertEqual([parse_packet(bytes(item)).seq for item in result], [1000, 1000 + pos])
+        self.assertEqual(engine.get_stats()['fakes'], 0)
+        self.assertEqual(engine.get_stats()['fakes_refused'], 2)
+        plain.strategy_configs[DPIStrategy.FAKE_TLS] = {}
+        self.assertIsNone(PacketEngine(plain, DPIStrategy.FAKE_TLS).process(first))
+
+        rules = build_nfqueue_rules(200, '80,443', '443')
+        self.assertIn('-A ZAPRET_NFQ -p tcp -m multiport --dports 80,443 -m connbytes '
+                      '--connbytes-dir=original --connbytes-mode=packets --connbytes 1:6 '
+                      '-j NFQUEUE --queue-num 200 --queue-bypass', rules)
+        self.assertIn('-A POSTROUTING -j ZAPRET_NFQ', rules)
+
+        print("[✓] Пакетный движок меняет заголовки фейков и частей на проводе")
+
+    def test_31_packet_arena(self):
+        """Тест сборки пакетов в арене: суммы RFC 1624, IPv6, переиспользование слотов"""
+        import os
+        import struct
+        from dpi_bypass import DPIBypass, DPIStrategy
+        from packet_engine import (PacketArena, PacketEngine, checksum_update, internet_checksum,
+                                   ones_sum, parse_packet)
+
+        def reference(data):
+            if len(data) % 2:
+                data += b'\x00'
+            total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+            while total >> 16:
+                total = (total & 0xFFFF) + (total >> 16)
+            return ~total & 0xFFFF
+
+        for size in (0, 1, 2, 3, 20, 41, 1500):
+            data = os.urandom(size)
+            self.assertEqual(internet_checksum(data), reference(data))
+        self.assertEqual(internet_checksum(b'\xff\xff\xff\xff'), reference(b'\xff\xff\xff\xff'))
+        self.assertEqual(ones_sum(b'\x00\x00'), 0)
+
+        # Инкрементальная правка заголовка совпадает с полным пересчётом
+        header = bytearray.fromhex('4500003c1c4640004006b1e6ac100a63ac100a0c')
+        old_word = struct.unpack_from('!H', header, 8)[0]
+        header[8] = 3
+        new_word = struct.unpack_from('!H', header, 8)[0]
+        checksum = checksum_update(0xB1E6, old_word, new_word)
+        header[10:12] = b'\x00\x00'
+        self.assertEqual(checksum, internet_checksum(header))
+
+        src = bytes.fromhex('20010db8000000000000000000000002')
+        dst = bytes.fromhex('2a00145040010800000000000000200e')
+
+        def tcp6_packet(payload, seq, sport=40000):
+            tcp = struct.pack('!HHIIBBHHH', sport, 443, seq, 5000, 5 << 4, 0x18,
+                              64240, 0, 0) + payload
+            pseudo = src + dst + struct.pack('!IxxxB', len(tcp), 6)
+            tcp = tcp[:16] + struct.pack('!H', internet_checksum(pseudo + tcp)) + tcp[18:]
+            return struct.pack('!IHBB16s16s', 6 << 28, len(tcp), 6, 64, src, dst) + tcp
+
+        def checksum_ok(packet):
+            info = parse_packet(packet)
+            segment = bytes(packet[40:info.length])
+            pseudo = src + dst + struct.pack('!IxxxB', len(segment), info.proto)
+            return internet_checksum(pseudo + segment) == 0
+
+        payload = b'\x16\x03\x01' + os.urandom(300)
+        packet = tcp6_packet(payload, 1000)
+        info = parse_packet(packet)
+        self.assertEqual((info.version, info.sport, info.dport, info.seq), (6, 40000, 443, 1000))
+        self.assertTrue(checksum_ok(packet))
+
+        bypass = DPIBypass()
+        engine = PacketEngine(bypass, DPIStrategy.MULTISPLIT, arena=PacketArena(4, 256))
+        engine.bypass.strategy_configs[DPIStrategy.MULTISPLIT].update(split_pos=100,
+                                                                      split_seqovl=0)
+        parts = engine.process(packet)
+        self.assertEqual(len(parts), 2)
+        for part in parts:
+            self.assertIsInstance(part, memoryview)
+            self.assertTrue(checksum_ok(bytes(part)))
+        first, second = (parse_packet(bytes(part)) for part in parts)
+        self.assertEqual((first.seq, second.seq), (1000, 1100))
+        self.assertEqual(bytes(parts[0][first.payload_offset:]), payload[:100])
+        self.assertEqual(bytes(parts[1][second.payload_offset:]), payload[100:])
+        # Второй слот не вмещает 203 байта данных: отдельный буфер
+        stats = engine.get_stats()['arena']
+        self.assertEqual((stats['max_used'], stats['overflows']), (1, 1))
+
+        # Следующий вызов (новое соединение) пишет в те же слоты
+        slot, before = parts[0], bytes(parts[0])
+        again = engine.process(tcp6_packet(payload, 5000, sport=40001))
+        self.assertIs(again[0].obj, engine.arena.buffer)
+        self.assertNotEqual(bytes(slot), before)
+        self.assertEqual(parse_packet(bytes(slot)).seq, 5000)
+        self.assertEqual(engine.get_stats()['arena']['max_used'], 1)
+
+        self.assertEqual(bypass._encode_var_int(37), b'\x25')
+        self.assertEqual(bypass._encode_var_int(15293), bytes.fromhex('7bbd'))
+        self.assertEqual(bypass._encode_var_int(494878333), bytes.fromhex('9d7f3e7d'))
+        self.assertEqual(bypass._encode_var_int(151288809941952652),
+                         bytes.fromhex('c2197c5eff14e88c'))
+
+        print("[✓] Пакеты собираются в арене с верными суммами IPv4/IPv6")
+
+    def test_32_template_files(self):
+        """Тест шаблонов из bin/: загрузка один раз, замена SNI с верными длинами"""
+        import struct
+        import tempfile
+        from dpi_bypass import (DPIBypass, TEMPLATE_DIR, client_hello_layout,
+                                load_template_files, rewrite_sni)
+        from protocol_classifier import classify_flight
+
+        files = load_template_files()
+        self.assertIs(load_template_files(TEMPLATE_DIR), files)
+        self.assertIn('tls_clienthello_www_google_com', files)
+        with self.assertRaises(TypeError):
+            files['tls_clienthello_www_google_com'] = b''
+
+        def lengths_ok(hello):
+            record_len, = struct.unpack_from('!H', hello, 3)
+            return (record_len == len(hello) - 5 and
+                    int.from_bytes(hello[6:9], 'big') == len(hello) - 9 and
+                    client_hello_layout(hello) is not None)
+
+        template = files['tls_clienthello_www_google_com']
+        layout = client_hello_layout(template)
+        self.assertIsNotNone(layout)
+        self.assertEqual(classify_flight(template).sni, 'www.google.com')
+
+        # Короткое и длинное имя: разницу забирает padding, размер прежний
+        for sni in ('x.io', 'rr1---sn-4g5edne7.googlevideo.com'):
+            hello = rewrite_sni(template, layout, sni)
+            self.assertEqual(len(hello), len(template))
+            self.assertTrue(lengths_ok(hello))
+            self.assertEqual(classify_flight(hello).sni, sni)
+
+        # Имя длиннее padding: правятся длины записи, handshake и расширений
+        sni = 'a' * 60 + '.' + 'b' * 60 + '.' + 'c' * 60 + '.' + 'd' * 60 + '.com'
+        hello = rewrite_sni(template, layout, sni)
+        self.assertGreater(len(hello), len(template))
+        self.assertTrue(lengths_ok(hello))
+        self.assertEqual(classify_flight(hello).sni, sni)
+
+        bypass = DPIBypass()
+        fake = bypass.templates.get('tls_clienthello_www_google_com', 'example.org', 2)
+        self.assertEqual(len(fake), 2 * len(template))
+        self.assertEqual(classify_flight(fake[:len(template)]).sni, 'example.org')
+        self.assertEqual(classify_flight(bypass.templates.get('tls_clienthello_4pda_to')).sni,
+                         '4pda.to')
+
+        # Без каталога - исправленный генератор
+        with tempfile.TemporaryDirectory() as work_dir:
+            fallback = DPIBypass(work_dir)
+            self.assertEqual(len(fallback.template_files), 0)
+            hello = fallback.templates.get('tls_clienthello_www_google_com', 'example.com')
+            self.assertTrue(lengths_ok(hello))
+            info = classify_flight(hello)
+            self.assertTrue(info.complete)
+            self.assertEqual(info.sni, 'example.com')
+            self.assertIsNone(client_hello_layout(hello[:-1]))
+
+        print("[✓] Шаблоны ClientHello из bin/ с заменой SNI")
 
 def run_all_tests():
     """Запуск всех тестов"""
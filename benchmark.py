@@ -0,0 +1,605 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочные тесты движка обхода DPI
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import multiprocessing
+import os
+import random
+import select
+import shutil
+import socket
+import ssl
+import struct
+import tempfile
+import threading
+import time
+from typing import Dict, Any, List
+
+from dpi_bypass import (DPIBypass, DPIStrategy, ProxyMode, SocketRelay, flatten_segments,
+                        client_hello_layout, load_template_files, rewrite_sni)
+from domain_index import DomainSuffixIndex
+from ip_index import IPPrefixIndex
+from list_snapshot import ListSnapshot
+from strategy_rules import StrategyDispatcher
+from protocol_classifier import FirstFlightClassifier
+from proxy_workers import ProxyWorkerSupervisor
+from udp_relay import UDPRelay
+from packet_engine import PacketEngine, internet_checksum
+
+# Целевые показатели прокси на телефоне среднего уровня
+# (100 одновременных коротких соединений)
+TARGET_CONNECTIONS_PER_SEC = 500
+TARGET_P99_LATENCY_MS = 150.0
+
+# Максимальный размер данных, для которого замеряется склейка через +=
+CONCAT_MAX_SIZE = 256 * 1024
+
+HTTP_REQUEST = b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    """Перцентиль по отсортированной выборке"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _echo_server_process(port_queue):
+    """Upstream-сервер: отвечает эхом на всё, что получил"""
+    async def handle(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0, backlog=1024)
+        port_queue.put(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def _client_load_process(port, total, concurrency, result_queue):
+    """Генератор нагрузки: total коротких соединений, concurrency одновременно"""
+    latencies = []
+    errors = 0
+
+    async def one_connection():
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(HTTP_REQUEST)
+            await writer.drain()
+            data = await reader.read(65536)
+            writer.close()
+            if not data:
+                errors += 1
+                return
+            latencies.append((time.perf_counter() - started) * 1000.0)
+        except OSError:
+            errors += 1
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited():
+            async with semaphore:
+                await one_connection()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited() for _ in range(total)))
+        return time.perf_counter() - started
+
+    elapsed = asyncio.run(main())
+    result_queue.put({'elapsed': elapsed, 'latencies': latencies, 'errors': errors})
+
+
+def bench_proxy_modes(connections: int = 1000, concurrency: int = 100) -> Dict[str, Any]:
+    """Сравнение поточного и asyncio режимов прокси: соединений/с и p99"""
+    ctx = multiprocessing.get_context('spawn')
+    port_queue = ctx.Queue()
+    echo = ctx.Process(target=_echo_server_process, args=(port_queue,), daemon=True)
+    echo.start()
+    upstream_port = port_queue.get(timeout=10)
+
+    results = {}
+    try:
+        for mode in ProxyMode:
+            bypass = DPIBypass()
+            proxy = bypass.create_proxy_server(0, '127.0.0.1', upstream_port,
+                                               DPIStrategy.AUTO, mode=mode)
+            thread = threading.Thread(
+                target=proxy.start, args=(0, '127.0.0.1', upstream_port), daemon=True
+            )
+            thread.start()
+            proxy.ready.wait(5)
+
+            result_queue = ctx.Queue()
+            client = ctx.Process(
+                target=_client_load_process,
+                args=(proxy.listen_port, connections, concurrency, result_queue)
+            )
+            client.start()
+            run = result_queue.get(timeout=300)
+            client.join()
+
+            pool_stats = proxy.get_stats()['buffer_pool']
+            proxy.stop()
+            thread.join(5)
+
+            cps = len(run['latencies']) / run['elapsed'] if run['elapsed'] else 0.0
+            p99 = _percentile(run['latencies'], 99)
+            results[mode.value] = {
+                'connections_per_sec': cps,
+                'p50_ms': _percentile(run['latencies'], 50),
+                'p99_ms': p99,
+                'errors': run['errors'],
+                'meets_target': cps >= TARGET_CONNECTIONS_PER_SEC and p99 <= TARGET_P99_LATENCY_MS,
+                'pool_hit_rate': pool_stats['hit_rate'],
+            }
+    finally:
+        echo.terminate()
+        echo.join()
+
+    return results
+
+
+def bench_proxy_workers(connections: int = 2000, concurrency: int = 100) -> Dict[str, Any]:
+    """Масштабирование по ядрам: 1 процесс прокси против воркеров SO_REUSEPORT"""
+    ctx = multiprocessing.get_context('spawn')
+    port_queue = ctx.Queue()
+    echo = ctx.Process(target=_echo_server_process, args=(port_queue,), daemon=True)
+    echo.start()
+    upstream_port = port_queue.get(timeout=10)
+
+    results = {}
+    try:
+        for workers in sorted({1, os.cpu_count() or 1}):
+            supervisor = ProxyWorkerSupervisor(0, '127.0.0.1', upstream_port,
+                                               DPIStrategy.AUTO, workers=workers,
+                                               mode=ProxyMode.ASYNCIO)
+            port = supervisor.start()
+            supervisor.wait_ready(30)
+
+            result_queue = ctx.Queue()
+            client = ctx.Process(
+                target=_client_load_process,
+                args=(port, connections, concurrency, result_queue)
+            )
+            client.start()
+            run = result_queue.get(timeout=300)
+            client.join()
+            supervisor.stop()
+
+            cps = len(run['latencies']) / run['elapsed'] if run['elapsed'] else 0.0
+            results[f"workers_{workers}"] = {
+                'connections_per_sec': cps,
+                'p50_ms': _percentile(run['latencies'], 50),
+                'p99_ms': _percentile(run['latencies'], 99),
+                'errors': run['errors'],
+            }
+    finally:
+        echo.terminate()
+        echo.join()
+
+    return results
+
+
+def _legacy_relay(src, dst) -> int:
+    """Прежний вариант: новый bytes на каждую порцию в 4 КиБ"""
+    data = src.recv(4096)
+    if data:
+        dst.sendall(data)
+    return len(data)
+
+
+def _measure_relay(step, total_bytes: int) -> float:
+    """Пропускная способность (МБ/с) одного направления через пару сокетов"""
+    source, relay_in = socket.socketpair()
+    relay_out, sink = socket.socketpair()
+    chunk = b'\x00' * 65536
+
+    def produce():
+        sent = 0
+        while sent < total_bytes:
+            source.sendall(chunk)
+            sent += len(chunk)
+        source.shutdown(socket.SHUT_WR)
+
+    def consume():
+        buffer = bytearray(262144)
+        while sink.recv_into(buffer):
+            pass
+
+    producer = threading.Thread(target=produce, daemon=True)
+    consumer = threading.Thread(target=consume, daemon=True)
+    started = time.perf_counter()
+    producer.start()
+    consumer.start()
+
+    while True:
+        select.select([relay_in], [], [])
+        if not step(relay_in, relay_out):
+            break
+    relay_out.shutdown(socket.SHUT_WR)
+    consumer.join()
+    elapsed = time.perf_counter() - started
+
+    for sock in (source, relay_in, relay_out, sink):
+        sock.close()
+    return total_bytes / elapsed / 1e6
+
+
+def bench_downstream_relay(total_mb: int = 256) -> Dict[str, Any]:
+    """Сравнение перекачки server→client: recv/send, recv_into и splice"""
+    total_bytes = total_mb * 1024 * 1024
+    results = {'recv_send_4k': {'mb_per_sec': _measure_relay(_legacy_relay, total_bytes)}}
+
+    copy_relay = SocketRelay(zero_copy=False)
+    results['recv_into_64k'] = {'mb_per_sec': _measure_relay(copy_relay.relay, total_bytes)}
+
+    splice_relay = SocketRelay(zero_copy=True)
+    if splice_relay.zero_copy:
+        results['splice_64k'] = {'mb_per_sec': _measure_relay(splice_relay.relay, total_bytes)}
+    splice_relay.close()
+
+    return results
+
+
+def _concat_segments(segments) -> bytes:
+    """Прежний способ сборки результата: result += ... в цикле"""
+    result = b''
+    for segment in segments:
+        result += segment
+    return result
+
+
+def _time_call(func, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def bench_strategy_transforms() -> Dict[str, Any]:
+    """Стоимость стратегий для 1 КиБ - 1 МиБ: склейка += против сегментов"""
+    bypass = DPIBypass()
+    results = {}
+
+    for size in (1024, 16 * 1024, 256 * 1024, 1024 * 1024):
+        data = bytes(size)
+        repeat = max(1, (256 * 1024) // size)
+        for strategy in (DPIStrategy.MULTISPLIT, DPIStrategy.MULTIDISORDER,
+                         DPIStrategy.FAKE_TLS):
+            def segments():
+                return flatten_segments(bypass.apply_strategy_segments(data, strategy))
+
+            result = {
+                'join_us': _time_call(lambda: b''.join(segments()), repeat),
+                'segments_us': _time_call(segments, repeat),
+            }
+            # Квадратичная склейка на 1 МиБ MULTISPLIT занимает минуты
+            if size <= CONCAT_MAX_SIZE:
+                result['concat_us'] = _time_call(lambda: _concat_segments(segments()), repeat)
+            results[f"{strategy.value}_{size // 1024}k"] = result
+
+    return results
+
+
+def _client_hello(server_name: str) -> bytes:
+    """Настоящий ClientHello из модуля ssl"""
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+    tls = ssl.create_default_context().wrap_bio(incoming, outgoing,
+                                                server_hostname=server_name)
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+def bench_flight_classifier(repeat: int = 20000) -> Dict[str, Any]:
+    """Стоимость разбора первого полёта: целиком, по частям и после него"""
+    hello = _client_hello('www.youtube.com')
+    chunk = bytes(16384)
+
+    def whole(data):
+        return lambda: FirstFlightClassifier().feed(data)
+
+    def split(data):
+        def run():
+            classifier = FirstFlightClassifier()
+            classifier.feed(data[:64])
+            classifier.feed(data[64:])
+        return run
+
+    done = FirstFlightClassifier()
+    done.feed(hello)
+
+    return {
+        'tls_hello': {'us': _time_call(whole(hello), repeat)},
+        'tls_hello_split': {'us': _time_call(split(hello), repeat)},
+        'http_request': {'us': _time_call(whole(HTTP_REQUEST), repeat)},
+        'later_chunk': {'us': _time_call(lambda: done.feed(chunk), repeat)},
+    }
+
+
+def _scan_hostlist(domains: List[str], host: str) -> bool:
+    """Прежний подход: перебор строк списка для каждого соединения"""
+    for domain in domains:
+        if host == domain or host.endswith('.' + domain):
+            return True
+    return False
+
+
+def bench_domain_index(domains: int = 100000, repeat: int = 100000) -> Dict[str, Any]:
+    """Поиск хоста в списке из domains доменов: индекс суффиксов против перебора"""
+    names = [f"site{number}.example{number % 97}.com" for number in range(domains)]
+
+    started = time.perf_counter()
+    index = DomainSuffixIndex()
+    include = index.add_list('general', names)
+    exclude = index.add_list('exclude', names[:100])
+    build_ms = (time.perf_counter() - started) * 1000.0
+
+    hit = 'rr4---sn-abc.cdn.' + names[-1]
+    miss = 'rr4---sn-abc.cdn.unlisted.org'
+    scan_repeat = max(1, repeat // 10000)
+
+    return {
+        'index': {
+            'build_ms': build_ms,
+            'hit_us': _time_call(lambda: index.matches(hit, include, exclude), repeat),
+            'miss_us': _time_call(lambda: index.matches(miss, include, exclude), repeat),
+        },
+        'line_scan': {
+            'hit_us': _time_call(lambda: _scan_hostlist(names, hit), scan_repeat),
+            'miss_us': _time_call(lambda: _scan_hostlist(names, miss), scan_repeat),
+        },
+    }
+
+
+def bench_ip_index(prefixes: int = 50000, repeat: int = 100000) -> Dict[str, Any]:
+    """Поиск адреса среди prefixes подсетей: построение, поиск, загрузка из байтов"""
+    rng = random.Random(1)
+    networks = [str(ipaddress.IPv4Network((rng.getrandbits(32), rng.randint(8, 32)), strict=False))
+                for _ in range(prefixes)]
+
+    started = time.perf_counter()
+    index = IPPrefixIndex()
+    include = index.add_list('all', networks)
+    exclude = index.add_list('exclude', networks[:100])
+    build_ms = (time.perf_counter() - started) * 1000.0
+
+    data = index.to_bytes()
+    started = time.perf_counter()
+    loaded = IPPrefixIndex.from_bytes(data)
+    load_ms = (time.perf_counter() - started) * 1000.0
+
+    address = networks[-1].split('/')[0]
+    return {
+        'ipv4': {
+            'build_ms': build_ms,
+            'load_ms': load_ms,
+            'size_kb': len(data) / 1024.0,
+            'lookup_us': _time_call(lambda: loaded.matches(address, include, exclude), repeat),
+            'miss_us': _time_call(lambda: loaded.matches('192.0.2.1', include, exclude), repeat),
+        },
+    }
+
+
+def bench_list_snapshot(domains: int = 100000, prefixes: int = 50000,
+                        repeat: int = 100000) -> Dict[str, Any]:
+    """Запуск диспетчера: разбор текстовых списков против mmap снимка"""
+    rng = random.Random(2)
+    base_dir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(base_dir, 'lists'))
+        with open(os.path.join(base_dir, 'lists', 'list-general.txt'), 'w') as f:
+            f.write('\n'.join(f"site{number}.example{number % 97}.com"
+                              for number in range(domains)))
+        with open(os.path.join(base_dir, 'lists', 'ipset-all.txt'), 'w') as f:
+            f.write('\n'.join(
+                str(ipaddress.IPv4Network((rng.getrandbits(32), rng.randint(8, 32)), strict=False))
+                for _ in range(prefixes)))
+        params = {'params': [
+            '--filter-tcp=443 --hostlist="lists/list-general.txt" --dpi-desync=fake',
+            '--filter-tcp=80 --ipset="lists/ipset-all.txt" --dpi-desync=multisplit',
+        ]}
+
+        started = time.perf_counter()
+        text_dispatcher = StrategyDispatcher.from_strategy_params(params, base_dir)
+        text_ms = (time.perf_counter() - started) * 1000.0
+
+        snapshot = ListSnapshot.open(base_dir)
+        build_ms = snapshot.build_time * 1000.0
+        started = time.perf_counter()
+        snapshot = ListSnapshot.open(base_dir)
+        dispatcher = StrategyDispatcher.from_strategy_params(params, base_dir, snapshot)
+        load_ms = (time.perf_counter() - started) * 1000.0
+
+        host = f"cdn.site{domains - 1}.example{(domains - 1) % 97}.com"
+        return {
+            'text': {
+                'startup_ms': text_ms,
+                'match_us': _time_call(lambda: text_dispatcher.match(443, host), repeat),
+            },
+            'snapshot': {
+                'build_ms': build_ms,
+                'startup_ms': load_ms,
+                'size_kb': snapshot.get_stats()['size'] / 1024.0,
+                'match_us': _time_call(lambda: dispatcher.match(443, host), repeat),
+            },
+        }
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def _udp_echo_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+
+    def serve():
+        while True:
+            try:
+                data, address = server.recvfrom(65535)
+                server.sendto(data, address)
+            except OSError:
+                break
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def bench_udp_relay(flows: int = 50, datagrams: int = 400, window: int = 16,
+                    size: int = 160) -> Dict[str, Any]:
+    """Голосовой трафик через UDP-ретранслятор: датаграмм в секунду туда и обратно"""
+    server = _udp_echo_server()
+    relay = UDPRelay(DPIBypass(), DPIStrategy.FAKE_QUIC)
+    thread = threading.Thread(target=relay.start,
+                              args=(0, '127.0.0.1', server.getsockname()[1]), daemon=True)
+    thread.start()
+    relay.ready.wait(5)
+    payload = b'\x80\x78' + bytes(size - 2)
+
+    def run(address):
+        clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(flows)]
+        for client in clients:
+            client.settimeout(0.2)
+        received = 0
+        started = time.perf_counter()
+        try:
+            # В полёте не больше window датаграмм: потери на loopback
+            # из-за переполнения буферов не искажают замер
+            for _ in range(datagrams // window):
+                for client in clients:
+                    for _ in range(window):
+                        client.sendto(payload, address)
+                    for _ in range(window):
+                        try:
+                            client.recv(65535)
+                            received += 1
+                        except socket.timeout:
+                            break
+        finally:
+            for client in clients:
+                client.close()
+        elapsed = time.perf_counter() - started
+        total = flows * (datagrams // window) * window
+        return {'datagrams_per_sec': received / elapsed, 'lost': total - received}
+
+    try:
+        direct = run(server.getsockname())
+        relayed = run(('127.0.0.1', relay.listen_port))
+        relayed['fakes'] = relay.get_stats()['fakes']
+        relayed['flows_opened'] = relay.get_stats()['opened']
+        return {'direct': direct, 'relay': relayed}
+    finally:
+        relay.stop()
+        thread.join(5)
+        server.close()
+
+
+def _tcp_packet(payload: bytes, sport: int, seq: int) -> bytes:
+    src, dst = socket.inet_aton('10.0.0.2'), socket.inet_aton('93.184.216.34')
+    tcp = struct.pack('!HHIIBBHHH', sport, 443, seq, 1, 5 << 4, 0x18, 64240, 0, 0) + payload
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0x4000, 64, 6, 0, src, dst)
+    ip = ip[:10] + struct.pack('!H', internet_checksum(ip)) + ip[12:]
+    pseudo = struct.pack('!4s4sBBH', src, dst, 0, 6, len(tcp))
+    return ip + tcp[:16] + struct.pack('!H', internet_checksum(pseudo + tcp)) + tcp[18:]
+
+
+def bench_packet_engine(flows: int = 5000) -> Dict[str, Any]:
+    """Пакетный движок: цена первого полёта и пропуска остальных пакетов"""
+    hello = _client_hello('example.com')
+    results = {}
+    for strategy in (DPIStrategy.FAKE_TLS, DPIStrategy.MULTIDISORDER):
+        engine = PacketEngine(DPIBypass(), strategy, max_flows=flows)
+        firsts = [_tcp_packet(hello, 1024 + number, 1) for number in range(flows)]
+        seconds = [_tcp_packet(b'x' * 512, 1024 + number, 1 + len(hello))
+                   for number in range(flows)]
+        started = time.perf_counter()
+        for packet in firsts:
+            engine.process(packet)
+        first_us = (time.perf_counter() - started) / flows * 1e6
+        started = time.perf_counter()
+        for packet in seconds:
+            engine.process(packet)
+        results[strategy.value] = {
+            'first_flight_us': first_us,
+            'passthrough_us': (time.perf_counter() - started) / flows * 1e6,
+            'fakes_per_flow': engine.get_stats()['fakes'] / flows,
+        }
+    return results
+
+
+def bench_fake_templates(repeat: int = 20000) -> Dict[str, Any]:
+    """Фейковый ClientHello: генерация заново против шаблона из bin/"""
+    bypass = DPIBypass()
+    template = load_template_files()['tls_clienthello_www_google_com']
+    layout = client_hello_layout(template)
+    return {
+        'generate': {'us': _time_call(
+            lambda: bypass._generate_tls_client_hello('example.com'), repeat)},
+        'rewrite_sni': {'us': _time_call(
+            lambda: rewrite_sni(template, layout, 'example.com'), repeat)},
+        'cached_get': {'us': _time_call(
+            lambda: bypass.templates.get('tls_clienthello_www_google_com', 'example.com'),
+            repeat)},
+    }
+
+
+def _print_results(title: str, results: Dict[str, Any]):
+    print(f"=== {title} ===")
+    for name, values in results.items():
+        formatted = ', '.join(
+            f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in values.items()
+        )
+        print(f"  {name}: {formatted}")
+
+
+BENCHMARKS = {
+    'proxy': bench_proxy_modes,
+    'workers': bench_proxy_workers,
+    'relay': bench_downstream_relay,
+    'transforms': bench_strategy_transforms,
+    'classifier': bench_flight_classifier,
+    'domains': bench_domain_index,
+    'ipset': bench_ip_index,
+    'snapshot': bench_list_snapshot,
+    'udp': bench_udp_relay,
+    'packets': bench_packet_engine,
+    'templates': bench_fake_templates,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочные тесты Zapret Android')
+    parser.add_argument('names', nargs='*', default=list(BENCHMARKS),
+                        help='Какие тесты запускать: ' + ', '.join(BENCHMARKS))
+    args = parser.parse_args()
+
+    for name in args.names:
+        _print_results(name, BENCHMARKS[name]())
+
+
+if __name__ == '__main__':
+    main()
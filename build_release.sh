@@ -24,6 +24,7 @@ version = 1.0.0
 version.code = 1
 source.dir = .
 source.main = main.py
+source.include_exts = py,png,jpg,kv,atlas,ttf,json,txt,bin
 requirements = python3,kivy,requests,psutil,flask
 orientation = portrait
 fullscreen = 0
@@ -46,7 +46,7 @@ presplash.filename = assets/presplash.png
 
 # Исходный код
 source.dir = .
-source.include_exts = py,png,jpg,kv,atlas,ttf,json,txt
+source.include_exts = py,png,jpg,kv,atlas,ttf,json,txt,bin
 
 # Главный файл
 source.main = main.py
@@ -83,7 +83,7 @@ android.add_compiler_flags = -O3
 android.add_gradle_repositories = maven { url 'https://jitpack.io' }
 
 # Дополнительные файлы
-include_exts = json,txt
+include_exts = json,txt,bin
 
 # Билд с отладочной информацией
 # (закомментировать для релиза)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import struct
+from zlib import crc32
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+
+# Заголовок сериализованного индекса: сигнатура, версия, ёмкость таблицы,
+# число доменов, длина списка имён
+TABLE_HEADER = struct.Struct('=4sIQQI')
+TABLE_MAGIC = b'ZDOM'
+TABLE_VERSION = 1
+
+
+def domain_hash(domain: str) -> int:
+    """64-битный хэш домена для плоской таблицы (0 - признак пустой ячейки)
+
+    Два CRC32 - по прямому и обратному порядку байт: стабильны между
+    процессами (в отличие от hash()) и в разы быстрее криптографических.
+    """
+    data = domain.encode('utf-8')
+    return crc32(data) << 32 | crc32(data[::-1]) or 1
+
+
+def _align(offset: int, size: int = 8) -> int:
+    return (offset + size - 1) // size * size
+
+
+def normalize_domain(domain: str) -> str:
+    """Приведение записи списка к виду для поиска: example.com"""
+    domain = domain.strip().lower().rstrip('.')
+    if domain.startswith('*.'):
+        domain = domain[2:]
+    return domain.lstrip('.')
+
+
+def read_hostlist(path: str) -> Iterator[str]:
+    """Домены из файла списка: по одному в строке, # - комментарий"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                domain = normalize_domain(line.split('#', 1)[0])
+                if domain:
+                    yield domain
+    except OSError:
+        return
+
+
+class DomainSuffixIndex:
+    """Индекс доменов по суффиксам для hostlist-фильтров
+
+    Каждый список получает свой бит, в словаре хранится домен -> маска
+    списков, где он есть. Поиск проходит хост и его родительские домены
+    (www.youtube.com, youtube.com, com) - O(числа меток) обращений к
+    словарю независимо от размера списков.
+    """
+
+    def __init__(self):
+        self._masks: Dict[str, int] = {}
+        self._bits: Dict[str, int] = {}
+
+    def add_list(self, name: str, domains: Iterable[str]) -> int:
+        """Добавление списка; возвращает его бит (повторно - тот же бит)"""
+        bit = self._bits.get(name)
+        if bit is None:
+            bit = 1 << len(self._bits)
+            self._bits[name] = bit
+
+        masks = self._masks
+        for domain in domains:
+            domain = normalize_domain(domain)
+            if domain:
+                masks[domain] = masks.get(domain, 0) | bit
+        return bit
+
+    def add_file(self, path: str, name: Optional[str] = None) -> int:
+        """Добавление файла списка (каждый файл читается один раз)"""
+        name = name or path
+        if name in self._bits:
+            return self._bits[name]
+        return self.add_list(name, read_hostlist(path))
+
+    def bit(self, name: str) -> int:
+        return self._bits.get(name, 0)
+
+    def lookup(self, host: str) -> int:
+        """Маска всех списков, в которые входит хост или его родительский домен"""
+        if not host:
+            return 0
+        host = host.lower().rstrip('.')
+        masks = self._masks
+        mask = masks.get(host, 0)
+        pos = host.find('.')
+        while pos >= 0:
+            mask |= masks.get(host[pos + 1:], 0)
+            pos = host.find('.', pos + 1)
+        return mask
+
+    def matches(self, host: str, include: int, exclude: int = 0) -> bool:
+        """Хост входит в include и не входит в exclude (исключения важнее)"""
+        mask = self.lookup(host)
+        return bool(mask & include) and not mask & exclude
+
+    def __len__(self) -> int:
+        return len(self._masks)
+
+    def __contains__(self, host: str) -> bool:
+        return bool(self.lookup(host))
+
+    @property
+    def lists(self) -> List[str]:
+        return list(self._bits)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'domains': len(self._masks), 'lists': len(self._bits)}
+
+    def to_bytes(self) -> bytes:
+        """Плоская хэш-таблица с открытой адресацией: хэши и маски доменов
+
+        Хранятся только 64-битные хэши, поэтому таблица не зависит от длины
+        доменов и читается прямо из mmap без разбора (CompiledDomainIndex).
+        Маски 64-битные: в таблице может быть не больше 64 списков.
+        """
+        capacity = 8
+        while capacity < len(self._masks) * 2:
+            capacity *= 2
+        hashes = [0] * capacity
+        masks = [0] * capacity
+        for domain, mask in self._masks.items():
+            value = domain_hash(domain)
+            slot = value & (capacity - 1)
+            while hashes[slot] and hashes[slot] != value:
+                slot = (slot + 1) & (capacity - 1)
+            hashes[slot] = value
+            masks[slot] |= mask
+
+        names = '\n'.join(self._bits).encode('utf-8')
+        header = TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, capacity,
+                                   len(self._masks), len(names)) + names
+        header += b'\0' * (_align(len(header)) - len(header))
+        return header + struct.pack(f'={capacity}Q', *hashes) + \
+            struct.pack(f'={capacity}Q', *masks)
+
+    @classmethod
+    def from_bytes(cls, buffer, offset: int = 0) -> 'CompiledDomainIndex':
+        return CompiledDomainIndex(buffer, offset)
+
+
+class CompiledDomainIndex:
+    """Индекс доменов поверх буфера DomainSuffixIndex.to_bytes (только чтение)
+
+    Тот же интерфейс поиска, что у DomainSuffixIndex; таблица не копируется,
+    поэтому процессы, открывшие один mmap, делят её страницы.
+    """
+
+    def __init__(self, buffer, offset: int = 0):
+        magic, version, capacity, count, names_size = TABLE_HEADER.unpack_from(buffer, offset)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            raise ValueError("Неверный формат индекса доменов")
+        offset += TABLE_HEADER.size
+        names = bytes(buffer[offset:offset + names_size]).decode('utf-8')
+        self._bits = {name: 1 << number
+                      for number, name in enumerate(names.split('\n') if names else [])}
+
+        offset = _align(offset + names_size)
+        view = memoryview(buffer)
+        self._hashes = view[offset:offset + capacity * 8].cast('Q')
+        self._masks = view[offset + capacity * 8:offset + capacity * 16].cast('Q')
+        self._slot_mask = capacity - 1
+        self._count = count
+
+    def lookup(self, host: str) -> int:
+        if not host:
+            return 0
+        data = host.lower().rstrip('.').encode('utf-8')
+        hashes, masks, slot_mask = self._hashes, self._masks, self._slot_mask
+        mask = 0
+        pos = 0
+        # Хэш считается по байтам, как в domain_hash; поиск встроен в цикл
+        while pos >= 0:
+            suffix = data[pos:]
+            value = crc32(suffix) << 32 | crc32(suffix[::-1]) or 1
+            slot = value & slot_mask
+            while True:
+                found = hashes[slot]
+                if found == value:
+                    mask |= masks[slot]
+                    break
+                if not found:
+                    break
+                slot = (slot + 1) & slot_mask
+            pos = data.find(b'.', pos)
+            if pos >= 0:
+                pos += 1
+        return mask
+
+    def matches(self, host: str, include: int, exclude: int = 0) -> bool:
+        mask = self.lookup(host)
+        return bool(mask & include) and not mask & exclude
+
+    def bit(self, name: str) -> int:
+        return self._bits.get(name, 0)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, host: str) -> bool:
+        return bool(self.lookup(host))
+
+    @property
+    def lists(self) -> List[str]:
+        return list(self._bits)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'domains': self._count, 'lists': len(self._bits)}
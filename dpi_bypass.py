@@ -1,16 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import errno
+import os
+import select
 import socket
 import ssl
 import struct
-import hashlib
 import random
 import time
-from typing import Tuple, Optional, Dict, Any
+from collections import OrderedDict, deque
+from functools import partial
+from types import MappingProxyType
+from typing import Tuple, Optional, Dict, Any, Callable, List, Mapping, NamedTuple, Union
 import threading
 from enum import Enum
 
+from protocol_classifier import (
+    HTTP_METHODS, Protocol, FlightInfo, FirstFlightClassifier, classify_flight,
+    TLS_CONTENT_HANDSHAKE, TLS_HANDSHAKE_CLIENT_HELLO, TLS_EXTENSION_SERVER_NAME
+)
+
 class DPIStrategy(Enum):
     """Стратегии обхода DPI"""
     FAKE_TLS = "fake_tls"
@@ -22,16 +33,351 @@ class DPIStrategy(Enum):
     MULTIDISORDER = "multidisorder"
     AUTO = "auto"
 
+class ProxyMode(Enum):
+    """Режимы работы прокси-сервера"""
+    THREAD = "thread"
+    ASYNCIO = "asyncio"
+
+# Размер буферов для чтения из сокетов прокси
+BUFFER_SIZE = 65536
+
+# Сколько буферов держит пул одного рабочего процесса
+BUFFER_POOL_CAPACITY = 32
+
+# os.splice есть только в Linux (Python 3.10+)
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
+# Граница десинхронизации по умолчанию (как --dpi-desync-cutoff у zapret):
+# обрабатывается только первая порция данных клиента
+DEFAULT_DESYNC_CUTOFF = 'n2'
+
+# Буфер результата стратегии: bytes или срез исходных данных без копирования
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class Segment(NamedTuple):
+    """TCP-сегмент результата стратегии
+    
+    buffers отправляются одним sendmsg. flush=True - после сегмента граница:
+    следующие данные уйдут отдельным сегментом. delay - пауза перед отправкой.
+    """
+    buffers: List[Buffer]
+    flush: bool = False
+    delay: float = 0.0
+
+
+def flatten_segments(segments: List[Segment]) -> List[Buffer]:
+    """Все буферы сегментов подряд"""
+    return [buffer for segment in segments for buffer in segment.buffers]
+
+
+def group_segments(segments: List[Segment]) -> List[Tuple[float, List[Buffer]]]:
+    """Объединение сегментов в группы для отправки одним sendmsg
+    
+    Соседние сегменты без flush и без паузы склеиваются в одну группу,
+    flush закрывает группу. Возвращает список (пауза, буферы).
+    """
+    groups = []
+    current = None
+    for segment in segments:
+        if current is None or segment.delay:
+            current = (segment.delay, [])
+            groups.append(current)
+        current[1].extend(segment.buffers)
+        if segment.flush:
+            current = None
+    return groups
+
+# QUIC variable-length integer: 2, 4 и 8 байт (RFC 9000, 16)
+VARINT_16 = struct.Struct('!H')
+VARINT_32 = struct.Struct('!I')
+VARINT_64 = struct.Struct('!Q')
+
+# Ограничение числа буферов в одном вызове sendmsg (IOV_MAX)
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# Очередь listen() и ограничение одновременных соединений прокси.
+# Соединения сверх лимита ждут в очереди, при её переполнении - сбрасываются
+LISTEN_BACKLOG = 128
+MAX_CONNECTIONS = 256
+MAX_QUEUED = 256
+
+# getsockopt для исходного адреса назначения после iptables REDIRECT
+# (linux/netfilter_ipv4.h, в модуле socket константы нет)
+SO_ORIGINAL_DST = 80
+
+# Пул keep-alive соединений к upstream: время простоя и лимит на хост
+UPSTREAM_IDLE_TIMEOUT = 30.0
+UPSTREAM_MAX_PER_HOST = 8
+# Предел заголовков HTTP, которые разбирает учёт ответов для пула
+HTTP_MAX_HEAD = 65536
+
+# Какая сторона закрыла соединение в цикле проксирования
+CLOSED_BY_CLIENT = 'client'
+CLOSED_BY_REMOTE = 'remote'
+
+# Сколько готовых фейковых payload держит кэш шаблонов
+TEMPLATE_CACHE_SIZE = 128
+
+# Положение случайных полей в сгенерированных шаблонах: (смещение, длина).
+# TLS: 5 байт заголовка записи + 4 байта заголовка handshake + 2 байта версии
+TLS_RANDOM_FIELDS = ((11, 32),)
+# QUIC Initial: Destination Connection ID и содержимое CRYPTO фрейма
+QUIC_RANDOM_FIELDS = ((7, 8), (25, 100))
+
+# Снятые с настоящих клиентов шаблоны (как bin/*.bin в zapret для Windows)
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
+TEMPLATE_SUFFIX = '.bin'
+
+TLS_EXTENSION_PADDING = 0x0015
+TLS_RECORD_HEADER = struct.Struct('!BHH')
+TLS_EXTENSION_HEADER = struct.Struct('!HH')
+# server_name: тип и длина расширения, длина списка, host_name, длина имени
+TLS_SNI_EXTENSION = struct.Struct('!HHHBH')
+TLS_LENGTH = struct.Struct('!H')
+
+_template_files: Dict[str, Mapping[str, bytes]] = {}
+_template_files_lock = threading.Lock()
+
+
+def load_template_files(directory: str = TEMPLATE_DIR) -> Mapping[str, bytes]:
+    """Шаблоны *.bin из каталога (имя файла без .bin -> содержимое)
+
+    Каталог читается один раз на процесс, повторные вызовы отдают тот же
+    неизменяемый словарь. Нет каталога - пустой словарь.
+    """
+    directory = os.path.abspath(directory)
+    with _template_files_lock:
+        files = _template_files.get(directory)
+        if files is not None:
+            return files
+        loaded = {}
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            names = []
+        for filename in names:
+            if not filename.endswith(TEMPLATE_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(directory, filename), 'rb') as f:
+                    loaded[filename[:-len(TEMPLATE_SUFFIX)]] = f.read()
+            except OSError as e:
+                print(f"Не удалось прочитать шаблон {filename}: {e}")
+        files = MappingProxyType(loaded)
+        _template_files[directory] = files
+        return files
+
+
+class ClientHelloLayout(NamedTuple):
+    """Смещения в ClientHello, нужные для замены SNI
+
+    sni - границы расширения server_name целиком; если его нет - пустой
+    диапазон в начале списка расширений. padding - границы расширения
+    padding (RFC 7685) или None.
+    """
+    extensions_len_pos: int
+    sni_start: int
+    sni_end: int
+    padding_start: Optional[int]
+    padding_end: Optional[int]
+
+
+def client_hello_layout(data: bytes) -> Optional[ClientHelloLayout]:
+    """Разметка ClientHello в одной TLS-записи; None - не ClientHello или битый"""
+    if len(data) < 9 + 38:
+        return None
+    content_type, _, record_len = TLS_RECORD_HEADER.unpack_from(data)
+    if content_type != TLS_CONTENT_HANDSHAKE or record_len != len(data) - 5:
+        return None
+    if data[5] != TLS_HANDSHAKE_CLIENT_HELLO or \
+            int.from_bytes(data[6:9], 'big') != len(data) - 9:
+        return None
+    try:
+        # version(2) + random(32), затем session_id, cipher_suites, compression
+        pos = 9 + 34
+        pos += 1 + data[pos]
+        pos += 2 + TLS_LENGTH.unpack_from(data, pos)[0]
+        pos += 1 + data[pos]
+        extensions_len_pos = pos
+        end = pos + 2 + TLS_LENGTH.unpack_from(data, pos)[0]
+    except (IndexError, struct.error):
+        return None
+    if end != len(data):
+        return None
+
+    pos = extensions_len_pos + 2
+    sni = (pos, pos)
+    padding = (None, None)
+    while pos < end:
+        if pos + 4 > end:
+            return None
+        ext_type, ext_len = TLS_EXTENSION_HEADER.unpack_from(data, pos)
+        ext_end = pos + 4 + ext_len
+        if ext_end > end:
+            return None
+        if ext_type == TLS_EXTENSION_SERVER_NAME:
+            sni = (pos, ext_end)
+        elif ext_type == TLS_EXTENSION_PADDING:
+            padding = (pos, ext_end)
+        pos = ext_end
+    return ClientHelloLayout(extensions_len_pos, *sni, *padding)
+
+
+def sni_extension(sni: str) -> bytes:
+    """Расширение server_name с одним именем host_name"""
+    name = sni.encode('ascii') if sni.isascii() else sni.encode('idna')
+    return TLS_SNI_EXTENSION.pack(TLS_EXTENSION_SERVER_NAME, len(name) + 5,
+                                  len(name) + 3, 0, len(name)) + name
+
+
+def rewrite_sni(data: bytes, layout: ClientHelloLayout, sni: str) -> bytes:
+    """ClientHello с другим SNI и исправленными длинами
+
+    Если в шаблоне есть padding, он забирает разницу в длине имени:
+    размер ClientHello остаётся прежним, длины записи и handshake не
+    меняются. Иначе правятся длины записи, handshake и списка расширений.
+    """
+    extension = sni_extension(sni)
+    delta = len(extension) - (layout.sni_end - layout.sni_start)
+    edits = [(layout.sni_start, layout.sni_end, extension)]
+    if layout.padding_start is not None:
+        padding_len = layout.padding_end - layout.padding_start - 4
+        if padding_len >= delta:
+            padding_len -= delta
+            edits.append((layout.padding_start, layout.padding_end,
+                          TLS_EXTENSION_HEADER.pack(TLS_EXTENSION_PADDING, padding_len) +
+                          bytes(padding_len)))
+            delta = 0
+    edits.sort()
+
+    out = bytearray()
+    pos = 0
+    for start, end, value in edits:
+        out += data[pos:start]
+        out += value
+        pos = end
+    out += data[pos:]
+
+    if delta:
+        TLS_LENGTH.pack_into(out, 3, len(out) - 5)
+        out[6:9] = (len(out) - 9).to_bytes(3, 'big')
+        position = layout.extensions_len_pos
+        TLS_LENGTH.pack_into(out, position, len(out) - position - 2)
+    return bytes(out)
+
+
+def _file_template(data: bytes, layout: Optional[ClientHelloLayout],
+                   sni: Optional[str] = None) -> bytes:
+    """Генератор для шаблона из файла: копия с заменой SNI, если он задан"""
+    if sni is None or layout is None:
+        return data
+    return rewrite_sni(data, layout, sni)
+
+
+class FakeTemplateCache:
+    """LRU-кэш готовых фейковых payload
+    
+    Ключ - (имя шаблона, SNI, число повторов). В кэше хранится уже собранный
+    bytearray из repeats копий шаблона; при выдаче в нём заново заполняются
+    только случайные поля (random TLS, CID QUIC), остальное не пересобирается.
+    """
+    
+    def __init__(self, generators: Dict[str, Callable[..., bytes]],
+                 random_fields: Dict[str, Tuple[Tuple[int, int], ...]],
+                 max_entries: int = TEMPLATE_CACHE_SIZE):
+        self.generators = generators
+        self.random_fields = random_fields
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    
+    def __getitem__(self, name: str) -> Callable[..., bytes]:
+        return self.generators[name]
+    
+    def __contains__(self, name: str) -> bool:
+        return name in self.generators
+    
+    def _build(self, name: str, sni: Optional[str], repeats: int):
+        generator = self.generators[name]
+        template = generator(sni) if sni is not None else generator()
+        return bytearray(template * repeats), len(template)
+    
+    def get(self, name: str, sni: Optional[str] = None, repeats: int = 1) -> bytes:
+        """Фейковый payload: repeats копий шаблона со свежими случайными полями"""
+        key = (name, sni, repeats)
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+        
+        if entry is None:
+            # Сборка вне блокировки: генератор может быть медленным
+            entry = self._build(name, sni, repeats)
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.stats['evictions'] += 1
+        
+        buffer, template_len = entry
+        fields = self.random_fields.get(name, ())
+        
+        with self._lock:
+            # Все копии получают одинаковые случайные поля, как и раньше,
+            # когда один сгенерированный шаблон повторялся repeats раз
+            for offset, length in fields:
+                value = random.randbytes(length)
+                for base in range(0, len(buffer), template_len):
+                    buffer[base + offset:base + offset + length] = value
+            return bytes(buffer)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики кэша шаблонов"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._entries)
+        
+        requests = stats['hits'] + stats['misses']
+        stats['max_entries'] = self.max_entries
+        stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+        return stats
+
+
 class DPIBypass:
     """Основной класс для обхода DPI"""
     
-    def __init__(self):
-        # Шаблоны для подмены (аналоги Windows версии)
-        self.templates = {
+    def __init__(self, template_dir: str = TEMPLATE_DIR):
+        # Шаблоны для подмены (аналоги Windows версии): файлы из bin/,
+        # генераторы - только для тех, что в каталоге не нашлись
+        generators = {
             'tls_clienthello_www_google_com': self._generate_tls_client_hello,
             'quic_initial_www_google_com': self._generate_quic_initial,
             'tls_clienthello_4pda_to': self._generate_tls_4pda,
         }
+        random_fields = {
+            'tls_clienthello_www_google_com': TLS_RANDOM_FIELDS,
+            'quic_initial_www_google_com': QUIC_RANDOM_FIELDS,
+            'tls_clienthello_4pda_to': TLS_RANDOM_FIELDS,
+        }
+        self.template_files = load_template_files(template_dir)
+        for name, data in self.template_files.items():
+            layout = client_hello_layout(data)
+            generators[name] = partial(_file_template, data, layout)
+            # Настоящий QUIC Initial зашифрован ключом от DCID: его не трогаем
+            random_fields[name] = TLS_RANDOM_FIELDS if layout is not None else ()
+        self.templates = FakeTemplateCache(generators, random_fields)
         
         # Конфигурация стратегий
         self.strategy_configs = {
@@ -55,6 +401,11 @@ class DPIBypass:
                 'repeats': 4,
                 'fooling': ['ts', 'md5sig'],
                 'mod': 'host=ozon.ru'
+            },
+            DPIStrategy.FAKE_DSPLIT: {
+                # Фейки идут с настоящими seq: без обмана сервер примет их
+                'fooling': ['badseq'],
+                'autottl': 2
             }
         }
         
@@ -63,16 +414,14 @@ class DPIBypass:
         
     def _generate_tls_client_hello(self, sni: str = "www.google.com") -> bytes:
         """Генерация TLS ClientHello пакета"""
-        # Упрощённая версия TLS ClientHello
-        # В реальной реализации нужно точное соответствие Windows-шаблонам
+        # Запасной вариант, если в bin/ нет снятого шаблона
         
         # TLS Record Layer
         record_type = b'\x16'  # Handshake
-        version = b'\x03\x03'  # TLS 1.2
+        version = b'\x03\x01'  # TLS 1.0 в заголовке записи, как у браузеров
         
         # Handshake Protocol
         handshake_type = b'\x01'  # ClientHello
-        length = b'\x00\x00\xa0'  # Длина
         
         # Client Version
         client_version = b'\x03\x03'  # TLS 1.2
@@ -84,25 +433,21 @@ class DPIBypass:
         session_id_len = b'\x00'
         
         # Cipher Suites
-        cipher_suites = b'\x00\x2a'  # 42 cipher suites
         cipher_list = b'\x13\x02\x13\x03\x13\x01\xc0\x2c\xc0\x30\xcc\xa9\xcc\xa8\xc0\x2b\xc0\x2f'
+        cipher_suites = TLS_LENGTH.pack(len(cipher_list))
         
         # Compression Methods
         compression = b'\x01\x00'
         
-        # Extensions
-        extensions_len = b'\x00\x5c'  # 92 bytes
-        
-        # SNI Extension
-        sni_ext = b'\x00\x00'  # server_name extension
-        sni_len = b'\x00\x18'  # 24 bytes
-        sni_list_len = b'\x00\x16'  # 22 bytes
-        sni_type = b'\x00'  # host_name
-        sni_host_len = b'\x00\x13'  # 19 bytes
-        sni_host = sni.encode('utf-8').ljust(19, b'\x00')
-        
-        # Assemble packet
-        extensions = sni_ext + sni_len + sni_list_len + sni_type + sni_host_len + sni_host
+        # Extensions: server_name, supported_groups (x25519),
+        # signature_algorithms, supported_versions (TLS 1.3, 1.2)
+        extensions = (
+            sni_extension(sni) +
+            b'\x00\x0a\x00\x04\x00\x02\x00\x1d' +
+            b'\x00\x0d\x00\x08\x00\x06\x04\x03\x08\x04\x04\x01' +
+            b'\x00\x2b\x00\x05\x04\x03\x04\x03\x03'
+        )
+        extensions_len = TLS_LENGTH.pack(len(extensions))
         
         # Build ClientHello
         client_hello = (
@@ -176,17 +521,36 @@ class DPIBypass:
         if value <= 63:
             return bytes([value])
         elif value <= 16383:
-            return struct.pack('!H', value | 0x4000)
+            return VARINT_16.pack(value | 0x4000)
         elif value <= 1073741823:
-            return struct.pack('!I', value | 0x80000000)
+            return VARINT_32.pack(value | 0x80000000)
         else:
-            return struct.pack('!Q', value | 0xC000000000000000)
+            return VARINT_64.pack(value | 0xC000000000000000)
     
     def apply_strategy(self, data: bytes, strategy: DPIStrategy, 
                       params: Optional[Dict[str, Any]] = None) -> bytes:
         """Применение стратегии обхода к данным"""
+        return b''.join(flatten_segments(
+            self.apply_strategy_segments(data, strategy, params)
+        ))
+    
+    def apply_strategy_segments(self, data: bytes, strategy: DPIStrategy,
+                                params: Optional[Dict[str, Any]] = None) -> List[Segment]:
+        """Применение стратегии обхода с результатом в виде TCP-сегментов
+        
+        Буферы сегментов ссылаются на исходные данные без копирования и
+        передаются в socket.sendmsg как есть (scatter-gather). Сегменты с
+        flush=True уходят в сеть отдельно (TCP_NODELAY), с паузой delay.
+        
+        params['flight'] - готовый результат FirstFlightClassifier, тогда
+        данные повторно не разбираются; params['flight_offset'] - позиция
+        data в потоке соединения.
+        """
+        if params is None:
+            params = {}
+        
         if strategy == DPIStrategy.AUTO:
-            strategy = self._detect_best_strategy(data)
+            strategy = self._detect_best_strategy(data, params.get('flight'))
         
         if strategy == DPIStrategy.FAKE_TLS:
             return self._apply_fake_tls(data, params)
@@ -203,325 +567,1394 @@ class DPIBypass:
         elif strategy == DPIStrategy.MULTIDISORDER:
             return self._apply_multidisorder(data, params)
         else:
-            return data
+            return [Segment([data])]
     
-    def _detect_best_strategy(self, data: bytes) -> DPIStrategy:
+    def _detect_best_strategy(self, data: bytes,
+                              flight: Optional[FlightInfo] = None) -> DPIStrategy:
         """Автоматическое определение лучшей стратегии"""
-        # Анализируем данные для определения типа трафика
+        # Тип трафика берём из классификатора первого полёта
+        if flight is None:
+            flight = classify_flight(data)
         
-        if len(data) < 10:
-            return DPIStrategy.FAKE_TLS
-        
-        # Проверяем на TLS
-        if data[0] == 0x16 and data[1:3] in [b'\x03\x01', b'\x03\x02', b'\x03\x03']:
+        if flight.protocol == Protocol.TLS:
             return DPIStrategy.FAKE_TLS
-        
-        # Проверяем на QUIC
-        if data[0] & 0x80 and (data[0] & 0x30) == 0x00:
+        if flight.protocol == Protocol.QUIC:
             return DPIStrategy.FAKE_QUIC
-        
-        # Проверяем на HTTP
-        if b'HTTP' in data[:10] or b'GET' in data[:10] or b'POST' in data[:10]:
+        if flight.protocol == Protocol.HTTP:
             return DPIStrategy.HOST_FAKE_SPLIT
         
+        if len(data) < 10:
+            return DPIStrategy.FAKE_TLS
+        
         # По умолчанию - MULTISPLIT
         return DPIStrategy.MULTISPLIT
     
-    def _apply_fake_tls(self, data: bytes, params: Optional[Dict[str, Any]]) -> bytes:
-        """Применение стратегии FAKE TLS"""
-        config = self.strategy_configs[DPIStrategy.FAKE_TLS]
-        
-        if params and 'sni' in params:
-            sni = params['sni']
-        else:
-            sni = "www.google.com"
-        
-        # Генерируем фейковый TLS ClientHello
-        fake_tls = self._generate_tls_client_hello(sni)
-        
-        # Определяем сколько раз повторить
-        repeats = params.get('repeats', config['repeats'])
-        
-        # Для TCP пакетов вставляем фейковый TLS перед данными
-        result = b''
-        for _ in range(repeats):
-            result += fake_tls
-        
-        # Добавляем оригинальные данные
-        result += data
-        
-        # Применяем дополнительные техники обмана
-        if 'fooling' in config and 'ts' in config['fooling']:
-            result = self._apply_timestamp_fooling(result)
-        
-        return result
+    def _split_delay(self, config: Dict[str, Any], params: Dict[str, Any]) -> float:
+        """Пауза между частями split-стратегий, сек"""
+        return params.get('split_delay', config.get('split_delay', 0.0))
+    
+    def _sni_positions(self, data: bytes, params: Dict[str, Any]) -> List[int]:
+        """Разрез посреди имени в SNI; без SNI - после первого байта"""
+        flight = params.get('flight')
+        if flight is None:
+            flight = classify_flight(data)
+        if flight.sni:
+            name = flight.sni.encode('ascii', 'ignore')
+            index = bytes(data).lower().find(name) if name else -1
+            if index >= 0:
+                return [index + max(len(name) // 2, 1)]
+        return [1]
+    
+    def _apply_fake_tls(self, data: bytes, params: Optional[Dict[str, Any]]) -> List[Segment]:
+        """Применение стратегии FAKE TLS
+        
+        Фейк без пониженного TTL или fooling сервер примет как данные
+        потока, а сокет их не даёт: фейки отправляет пакетный движок
+        (packet_engine). Через сокет уходит сам ClientHello, разрезанный
+        посреди SNI.
+        """
+        return self._split_segments(data, self._sni_positions(data, params))
     
-    def _apply_fake_quic(self, data: bytes, params: Optional[Dict[str, Any]]) -> bytes:
+    def _apply_fake_quic(self, data: bytes, params: Optional[Dict[str, Any]]) -> List[Segment]:
         """Применение стратегии FAKE QUIC"""
-        config = self.strategy_configs[DPIStrategy.FAKE_QUIC]
-        
-        # Генерируем фейковый QUIC пакет
-        fake_quic = self._generate_quic_initial()
-        
-        repeats = params.get('repeats', config['repeats'])
-        
-        result = b''
-        for _ in range(repeats):
-            result += fake_quic
-        
-        result += data
-        
-        # Применяем TTL манипуляции
-        if config.get('autottl'):
-            result = self._apply_ttl_manipulation(result, config['autottl'])
-        
-        return result
+        # Фейковые QUIC Initial с пониженным TTL - в udp_relay и packet_engine;
+        # в TCP-потоке данные не меняются
+        return [Segment([data])]
+    
+    def _split_positions(self, data: bytes, config: Dict[str, Any],
+                         params: Dict[str, Any], default: int) -> List[int]:
+        """Позиции разреза из split_pos (число или список)"""
+        positions = params.get('split_pos', config.get('split_pos', default))
+        if isinstance(positions, int):
+            positions = [positions]
+        return list(positions)
     
-    def _apply_multisplit(self, data: bytes, params: Optional[Dict[str, Any]]) -> bytes:
+    def _split_segments(self, data: bytes, positions: List[int],
+                        delay: float = 0.0) -> List[Segment]:
+        """Части data по позициям в исходном порядке, каждая - отдельный сегмент
+        
+        В сокет уходят только байты самих данных: сервер получает поток
+        без изменений, DPI видит его разрезанным на TCP-сегменты.
+        Позиции вне (0, len(data)) и повторы отбрасываются.
+        """
+        view = memoryview(data)
+        inner = sorted({pos for pos in positions if 0 < pos < len(data)})
+        bounds = [0] + inner + [len(data)]
+        return [Segment([view[start:end]], flush=True, delay=delay if index else 0.0)
+                for index, (start, end) in enumerate(zip(bounds, bounds[1:]))]
+    
+    def _apply_multisplit(self, data: bytes, params: Optional[Dict[str, Any]]) -> List[Segment]:
         """Применение стратегии MULTISPLIT"""
         config = self.strategy_configs[DPIStrategy.MULTISPLIT]
+        # split_seqovl и повторы требуют своих TCP-заголовков - это делает
+        # пакетный движок (packet_engine), в сокет идут только части данных
+        positions = self._split_positions(data, config, params, 1)
+        return self._split_segments(data, positions, self._split_delay(config, params))
+    
+    def _apply_host_fake_split(self, data: bytes, params: Optional[Dict[str, Any]]) -> List[Segment]:
+        """Применение стратегии HOST FAKE SPLIT
         
-        split_seqovl = params.get('split_seqovl', config.get('split_seqovl', 681))
-        split_pos = params.get('split_pos', config.get('split_pos', 1))
+        Фейковая строка Host (mod=host=...) с fooling уходит только из
+        пакетного движка. В сокет идёт исходный запрос, разрезанный до и
+        после заголовка Host.
+        """
+        config = self.strategy_configs[DPIStrategy.HOST_FAKE_SPLIT]
         
-        # Разбиваем данные на части
-        parts = []
-        pos = 0
-        data_len = len(data)
+        # Положение заголовка Host - из классификатора первого полёта
+        flight = params.get('flight')
+        if flight is None:
+            flight = classify_flight(data)
         
-        while pos < data_len:
-            # Определяем размер части
-            part_size = min(split_seqovl, data_len - pos)
-            
-            # Извлекаем часть
-            part = data[pos:pos + part_size]
-            
-            # Применяем смещение если нужно
-            if split_pos > 1 and len(parts) > 0:
-                # Добавляем overlap с предыдущей частью
-                overlap = min(split_pos, len(parts[-1]))
-                part = parts[-1][-overlap:] + part
+        if flight.host_span is not None:
+            # Смещения заданы от начала потока, data может быть не первой порцией
+            offset = params.get('flight_offset', 0)
+            host_start = flight.host_span[0] - offset
+            host_end = flight.host_span[1] - offset
             
-            parts.append(part)
-            pos += part_size
-        
-        # Собираем обратно с дополнительными заголовками
-        result = b''
-        for i, part in enumerate(parts):
-            # Добавляем номер последовательности
-            seq_header = struct.pack('!I', i)
-            result += seq_header + part
-            
-            # Добавляем дублирование если нужно
-            if config.get('repeats', 1) > 1:
-                for _ in range(config['repeats'] - 1):
-                    result += seq_header + part
-        
-        return result
+            if 0 <= host_start and host_end <= len(data):
+                return self._split_segments(data, [host_start, host_end],
+                                            self._split_delay(config, params))
+            return [Segment([data])]
+        if flight.protocol == Protocol.HTTP:
+            # Заголовок Host ещё не пришёл или отсутствует
+            return [Segment([data])]
+        # Для HTTPS - разрез посреди SNI
+        return self._split_segments(data, self._sni_positions(data, params))
     
-    def _apply_host_fake_split(self, data: bytes, params: Optional[Dict[str, Any]]) -> bytes:
-        """Применение стратегии HOST FAKE SPLIT"""
-        config = self.strategy_configs[DPIStrategy.HOST_FAKE_SPLIT]
+    def _apply_syndata(self, data: bytes, params: Optional[Dict[str, Any]]) -> List[Segment]:
+        """Применение стратегии SYNDATA"""
+        # Данные в SYN требуют своего TCP-заголовка; в установленном
+        # соединении поток не меняется
+        return [Segment([data])]
+    
+    def _apply_fake_dsplit(self, data: bytes, params: Optional[Dict[str, Any]]) -> List[Segment]:
+        """Применение стратегии FAKE DSPLIT"""
+        # Фейковые части отправляет пакетный движок, здесь - только разрез
+        split_point = min(len(data) // 2, 500)
+        return self._split_segments(data, [split_point] if split_point > 0 else [])
+    
+    def _apply_multidisorder(self, data: bytes, params: Optional[Dict[str, Any]]) -> List[Segment]:
+        """Применение стратегии MULTIDISORDER"""
+        config = self.strategy_configs.get(DPIStrategy.MULTIDISORDER, {})
+        # Сокет TCP отдаёт байты только по порядку: части уходят отдельными
+        # сегментами, а обратный порядок на проводе - в пакетном движке
+        positions = self._split_positions(data, config, params, 2)
+        return self._split_segments(data, positions, self._split_delay(config, params))
+    
+    def get_desync_cutoff(self, strategy: DPIStrategy) -> str:
+        """Граница десинхронизации стратегии (cutoff из strategy_configs)"""
+        config = self.strategy_configs.get(strategy, {})
+        return config.get('cutoff', DEFAULT_DESYNC_CUTOFF)
+    
+    def create_connection_desync(self, strategy: DPIStrategy,
+                                 cutoff: Optional[str] = None, dispatcher=None,
+                                 port: Optional[int] = None,
+                                 address: Optional[str] = None,
+                                 on_desync: Optional[Callable[[], None]] = None) -> 'ConnectionDesync':
+        """Состояние десинхронизации для нового соединения"""
+        if cutoff is None:
+            cutoff = self.get_desync_cutoff(strategy)
+        return ConnectionDesync(self, strategy, cutoff, dispatcher, port, address,
+                                on_desync)
+    
+    def create_proxy_server(self, listen_port: int, target_host: str, 
+                           target_port: int, strategy: DPIStrategy,
+                           mode: ProxyMode = ProxyMode.THREAD, **options):
+        """Создание прокси-сервера с обходом DPI
         
-        # Извлекаем хост из параметров
-        if params and 'mod' in params:
-            mod_parts = params['mod'].split('=')
-            if len(mod_parts) > 1 and mod_parts[0] == 'host':
-                fake_host = mod_parts[1]
+        options передаются конструктору сервера (например, zero_copy=False
+        или desync_cutoff='s1024').
+        """
+        mode = ProxyMode(mode)
+        
+        if mode == ProxyMode.ASYNCIO:
+            return AsyncDPIProxyServer(self, strategy, **options)
+        
+        # Создаём и возвращаем экземпляр прокси
+        proxy = DPIProxyServer(self, strategy, **options)
+        return proxy
+
+
+class BufferPool:
+    """Ограниченный пул заранее выделенных буферов для recv_into
+    
+    Буфер берётся на время жизни соединения и возвращается при его закрытии.
+    Если пул пуст, выделяется новый буфер (промах); лишние буферы сверх
+    ёмкости при возврате отбрасываются.
+    """
+    
+    def __init__(self, buffer_size: int = BUFFER_SIZE,
+                 capacity: int = BUFFER_POOL_CAPACITY):
+        self.buffer_size = buffer_size
+        self.capacity = capacity
+        self._free = [bytearray(buffer_size) for _ in range(capacity)]
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'returned': 0, 'dropped': 0}
+    
+    def acquire(self) -> bytearray:
+        """Получение буфера из пула"""
+        with self._lock:
+            if self._free:
+                self.stats['hits'] += 1
+                return self._free.pop()
+            self.stats['misses'] += 1
+        return bytearray(self.buffer_size)
+    
+    def release(self, buffer: bytearray):
+        """Возврат буфера в пул"""
+        with self._lock:
+            if len(self._free) < self.capacity and len(buffer) == self.buffer_size:
+                self._free.append(buffer)
+                self.stats['returned'] += 1
             else:
-                fake_host = "ozon.ru"
+                self.stats['dropped'] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики пула для подбора размера под нагрузкой"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['available'] = len(self._free)
+        
+        requests = stats['hits'] + stats['misses']
+        stats['capacity'] = self.capacity
+        stats['buffer_size'] = self.buffer_size
+        stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+        return stats
+
+
+def _advance_segments(pending: List[memoryview], index: int, sent: int) -> int:
+    """Сдвиг по списку сегментов после частичной отправки"""
+    while sent:
+        size = len(pending[index])
+        if sent >= size:
+            sent -= size
+            index += 1
+        else:
+            pending[index] = pending[index][sent:]
+            sent = 0
+    return index
+
+
+def send_buffers(sock: socket.socket, buffers: List[Buffer]):
+    """Отправка списка буферов через sendmsg (scatter-gather) без склейки"""
+    if not hasattr(sock, 'sendmsg'):
+        # Windows: sendmsg нет, отправляем по одному
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    
+    pending = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    index = 0
+    while index < len(pending):
+        sent = sock.sendmsg(pending[index:index + IOV_MAX])
+        index = _advance_segments(pending, index, sent)
+
+
+def set_nodelay(sock: socket.socket):
+    """TCP_NODELAY: каждый вызов send уходит в сеть отдельным сегментом"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        # Не TCP (например, socketpair в тестах)
+        pass
+
+
+def send_segments(sock: socket.socket, segments: List[Segment]):
+    """Отправка сегментов стратегии: каждая группа - отдельным sendmsg"""
+    groups = group_segments(segments)
+    if len(groups) > 1:
+        set_nodelay(sock)
+    
+    for delay, buffers in groups:
+        if delay:
+            time.sleep(delay)
+        send_buffers(sock, buffers)
+
+
+def parse_desync_cutoff(cutoff: str) -> Tuple[str, int]:
+    """Разбор границы десинхронизации в формате zapret: n2, d1, s4096
+    
+    n/d - номер порции данных клиента, s - относительная позиция в потоке.
+    Стратегия применяется, пока номер (позиция) меньше границы.
+    """
+    cutoff = cutoff.strip().lower()
+    mode = 'n'
+    if cutoff[:1] in ('n', 'd', 's'):
+        mode, cutoff = cutoff[0], cutoff[1:]
+    
+    try:
+        limit = int(cutoff)
+    except ValueError:
+        raise ValueError(f"Некорректная граница десинхронизации: {cutoff!r}")
+    
+    return mode, limit
+
+
+class DesyncState(Enum):
+    """Фаза соединения"""
+    FIRST_FLIGHT = "first_flight"
+    PASSTHROUGH = "passthrough"
+
+
+class ConnectionDesync:
+    """Состояние одного соединения: стратегия применяется только к первому полёту
+    
+    Как и zapret, обход DPI нужен только для ClientHello / HTTP-запроса.
+    После границы (cutoff) соединение переключается в режим прямой передачи
+    и больше не тратит время на генерацию фейков и перепаковку.
+    
+    Протокол, SNI и Host первого полёта разбираются один раз и доступны
+    в self.flight; последующие порции классификатор не просматривает.
+    
+    С dispatcher (strategy_rules.StrategyDispatcher) стратегия выбирается
+    по порту, адресу назначения и SNI/Host соединения. Пока первый полёт не разобран целиком,
+    данные придерживаются; соединение без подходящего правила сразу
+    переходит в режим прямой передачи.
+    
+    on_desync вызывается один раз, когда к соединению впервые применена
+    стратегия: прокси считает такие соединения в stats['desynced'].
+    """
+    
+    def __init__(self, bypass_engine: DPIBypass, strategy: DPIStrategy,
+                 cutoff: str = DEFAULT_DESYNC_CUTOFF, dispatcher=None,
+                 port: Optional[int] = None, address: Optional[str] = None,
+                 on_desync: Optional[Callable[[], None]] = None):
+        self.bypass = bypass_engine
+        self.strategy = strategy
+        self.cutoff_mode, self.cutoff_limit = parse_desync_cutoff(cutoff)
+        self.packets = 0
+        self.bytes = 0
+        self.state = DesyncState.FIRST_FLIGHT
+        self.classifier = FirstFlightClassifier()
+        self.dispatcher = dispatcher
+        self.port = port
+        self.address = address
+        self.rule = None
+        self.on_desync = on_desync
+        self._held = None
+        self._check_cutoff()
+    
+    @property
+    def flight(self) -> FlightInfo:
+        return self.classifier.info
+    
+    @property
+    def passthrough(self) -> bool:
+        return self.state == DesyncState.PASSTHROUGH
+    
+    def _check_cutoff(self):
+        if self.cutoff_mode == 's':
+            # Относительная позиция следующего байта (нумерация с 1)
+            position = self.bytes + 1
         else:
-            fake_host = config.get('mod', 'host=ozon.ru').split('=')[1]
+            position = self.packets + 1
         
-        # Для HTTP трафика подменяем Host header
-        if b'Host:' in data:
-            # Находим и заменяем Host header
-            host_start = data.find(b'Host:')
-            host_end = data.find(b'\r\n', host_start)
-            
-            if host_end > host_start:
-                original_host_line = data[host_start:host_end]
-                new_host_line = f"Host: {fake_host}".encode('utf-8')
+        if position >= self.cutoff_limit:
+            self.state = DesyncState.PASSTHROUGH
+    
+    def process(self, data) -> List[Segment]:
+        """Обработка порции данных клиента, результат - список сегментов"""
+        if self.state == DesyncState.PASSTHROUGH:
+            return [Segment([data])]
+        
+        data = bytes(data)
+        flight = self.classifier.feed(data)
+        params = {'flight': flight, 'flight_offset': self.bytes}
+        
+        if self.dispatcher is not None:
+            if self.rule is None:
+                if not flight.complete:
+                    # Выбор зависит от SNI/Host - ждём остаток первого полёта
+                    if self._held is None:
+                        self._held = bytearray()
+                    self._held += data
+                    return []
+                if self._held is not None:
+                    self._held += data
+                    data = bytes(self._held)
+                    self._held = None
                 
-                result = data[:host_start] + new_host_line + data[host_end:]
+                self.rule = self.dispatcher.match(self.port, flight.sni or flight.host,
+                                                  l7=flight.protocol.value,
+                                                  address=self.address)
+                if self.rule is None:
+                    self.state = DesyncState.PASSTHROUGH
+                    return [Segment([data])]
+                self.strategy = self.rule.strategy
+            params.update(self.rule.params)
+        
+        segments = self.bypass.apply_strategy_segments(data, self.strategy, params)
+        if self.packets == 0 and self.on_desync is not None:
+            self.on_desync()
+        
+        self.packets += 1
+        self.bytes += len(data)
+        self._check_cutoff()
+        
+        return segments
+
+
+def is_plain_http(data) -> bool:
+    """Начинается ли первый полёт с запроса обычного HTTP"""
+    # CONNECT в HTTP_METHODS нет: туннель не переиспользуем
+    return bytes(data[:8]).startswith(HTTP_METHODS)
+
+
+class HttpFramer:
+    """Границы сообщений HTTP/1.x в одном направлении соединения
+    
+    Разбирает только заголовки и длину тела (Content-Length или chunked),
+    само тело пропускается. Сообщение без явной длины (ответ до закрытия
+    соединения), Connection: close и смена протокола делают соединение
+    непригодным для пула.
+    """
+    
+    def __init__(self, exchange: 'HttpExchange', response: bool):
+        self.exchange = exchange
+        self.response = response
+        self.count = 0
+        self._state = 'head'
+        self._head = bytearray()
+        self._line = bytearray()
+        self._remaining = 0
+    
+    @property
+    def at_boundary(self) -> bool:
+        """Последнее сообщение получено целиком, следующее не начато"""
+        return self._state == 'head' and not self._head and not self._line
+    
+    def feed(self, data):
+        if not self.exchange.reusable:
+            return
+        data = bytes(data)
+        pos = 0
+        while pos < len(data) and self.exchange.reusable:
+            if self._state in ('body', 'chunk_data'):
+                take = min(self._remaining, len(data) - pos)
+                pos += take
+                self._remaining -= take
+                if not self._remaining:
+                    if self._state == 'body':
+                        self._finish()
+                    else:
+                        self._state = 'chunk_end'
+                continue
+            
+            end = data.find(b'\n', pos)
+            if end < 0:
+                self._line += data[pos:]
+                pos = len(data)
+            else:
+                self._line += data[pos:end + 1]
+                pos = end + 1
+                line = bytes(self._line)
+                self._line.clear()
+                self._on_line(line)
+            if len(self._line) + len(self._head) > HTTP_MAX_HEAD:
+                self.exchange.reusable = False
+    
+    def _on_line(self, line: bytes):
+        blank = not line.strip()
+        if self._state == 'head':
+            if not blank:
+                self._head += line
+            elif self._head:
+                head = bytes(self._head)
+                self._head.clear()
+                self._on_head(head)
+        elif self._state == 'chunk_size':
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                self.exchange.reusable = False
+                return
+            if size:
+                self._state, self._remaining = 'chunk_data', size
             else:
-                result = data
+                self._state = 'trailer'
+        elif self._state == 'chunk_end':
+            self._state = 'chunk_size'
+        elif self._state == 'trailer' and blank:
+            self._finish()
+    
+    def _on_head(self, head: bytes):
+        lines = head.splitlines()
+        start = lines[0].split()
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip().lower()
+        
+        connection = headers.get(b'connection', b'')
+        if b'close' in connection or b'upgrade' in connection:
+            self.exchange.reusable = False
+            return
+        
+        no_body = False
+        if self.response:
+            try:
+                status = int(start[1])
+            except (IndexError, ValueError):
+                self.exchange.reusable = False
+                return
+            if 100 <= status < 200:
+                # Промежуточный ответ (100 Continue): окончательный ещё впереди
+                return
+            methods = self.exchange.methods
+            method = methods.popleft() if methods else b''
+            if start[0] == b'HTTP/1.0' and b'keep-alive' not in connection:
+                self.exchange.reusable = False
+                return
+            no_body = method == b'HEAD' or status in (204, 304)
         else:
-            # Для HTTPS подменяем SNI в TLS
-            result = self._apply_fake_tls(data, {'sni': fake_host})
-        
-        # Применяем дополнительные техники обмана
-        if 'fooling' in config:
-            for fooling_tech in config['fooling']:
-                if fooling_tech == 'ts':
-                    result = self._apply_timestamp_fooling(result)
-                elif fooling_tech == 'md5sig':
-                    result = self._apply_md5_signature(result)
-        
-        return result
+            method = start[0] if start else b''
+            if method == b'CONNECT':
+                self.exchange.reusable = False
+                return
+            self.exchange.methods.append(method)
+        
+        encoding = headers.get(b'transfer-encoding')
+        length = headers.get(b'content-length')
+        if no_body:
+            self._finish()
+        elif encoding is not None:
+            if encoding.endswith(b'chunked'):
+                self._state = 'chunk_size'
+            else:
+                self.exchange.reusable = False
+        elif length is not None:
+            try:
+                self._remaining = int(length)
+            except ValueError:
+                self.exchange.reusable = False
+                return
+            if self._remaining:
+                self._state = 'body'
+            else:
+                self._finish()
+        elif self.response:
+            # Тело до закрытия соединения
+            self.exchange.reusable = False
+        else:
+            self._finish()
     
-    def _apply_syndata(self, data: bytes, params: Optional[Dict[str, Any]]) -> bytes:
-        """Применение стратегии SYNDATA"""
-        # Генерируем синтетические данные для заполнения
-        syn_data = random.randbytes(random.randint(100, 500))
-        
-        # Вставляем синтетические данные перед реальными
-        result = syn_data + data
-        
-        # Добавляем случайные задержки между пакетами
-        if params and params.get('add_delay'):
-            delay_header = struct.pack('!I', random.randint(1, 100))
-            result = delay_header + result
+    def _finish(self):
+        self.count += 1
+        self._state = 'head'
+
+
+class HttpExchange:
+    """Учёт запросов и ответов HTTP в соединении, которое может попасть в пул
+    
+    Upstream можно отдать другому клиенту, только когда на каждый запрос
+    пришёл полный ответ: иначе хвост ответа или ответ на конвейерный запрос
+    достанется чужому клиенту.
+    """
+    
+    def __init__(self):
+        self.reusable = True
+        # Методы запросов, ждущих ответа: на HEAD ответ приходит без тела
+        self.methods = deque()
+        self.requests = HttpFramer(self, response=False)
+        self.responses = HttpFramer(self, response=True)
+    
+    def feed_request(self, data):
+        self.requests.feed(data)
+    
+    def feed_response(self, data):
+        self.responses.feed(data)
+    
+    @property
+    def idle(self) -> bool:
+        """Все ответы получены, сокет к upstream можно вернуть в пул"""
+        return (self.reusable and self.requests.at_boundary
+                and self.responses.at_boundary
+                and self.requests.count == self.responses.count)
+
+
+class UpstreamPool:
+    """Пул keep-alive соединений к upstream для обычного HTTP
+    
+    Когда клиент закрывает соединение, а upstream остаётся открытым, сокет
+    возвращается в пул и достаётся следующему HTTP-клиенту без TCP-рукопожатия.
+    Прокси возвращает сокет, только если HttpExchange видел полный ответ на
+    каждый запрос; TLS и прочие протоколы в пул не попадают.
+    Перед выдачей и при возврате сокет проверяется: если сервер закрыл его
+    или прислал непрочитанные данные, сокет отбрасывается.
+    """
+    
+    def __init__(self, idle_timeout: float = UPSTREAM_IDLE_TIMEOUT,
+                 max_per_host: int = UPSTREAM_MAX_PER_HOST):
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.stats = {'created': 0, 'reused': 0, 'released': 0,
+                      'discarded': 0, 'expired': 0}
+    
+    @staticmethod
+    def _is_healthy(sock: socket.socket) -> bool:
+        """Сокет открыт и в нём нет неожиданных данных"""
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        # Простаивающий keep-alive сокет читаться не должен: готовность к
+        # чтению означает FIN/RST или остаток предыдущего ответа
+        return not readable
+    
+    def _prune_locked(self, now: float) -> List[socket.socket]:
+        expired = []
+        for key, entries in list(self._idle.items()):
+            fresh = [(sock, since) for sock, since in entries
+                     if now - since < self.idle_timeout]
+            expired.extend(sock for sock, since in entries
+                           if now - since >= self.idle_timeout)
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+        self.stats['expired'] += len(expired)
+        return expired
+    
+    def acquire(self, host: str, port: int) -> Optional[socket.socket]:
+        """Исправный простаивающий сокет к host:port или None
+        
+        None означает, что вызывающий должен открыть новое соединение.
+        """
+        key = (host, port)
+        now = time.monotonic()
+        rejected = []
+        
+        with self._lock:
+            rejected.extend(self._prune_locked(now))
+            entries = self._idle.get(key, [])
+            sock = None
+            while entries:
+                candidate, _ = entries.pop()
+                if self._is_healthy(candidate):
+                    sock = candidate
+                    break
+                rejected.append(candidate)
+                self.stats['discarded'] += 1
+            
+            if sock is not None:
+                self.stats['reused'] += 1
+            else:
+                self.stats['created'] += 1
         
-        return result
+        for stale in rejected:
+            stale.close()
+        return sock
     
-    def _apply_fake_dsplit(self, data: bytes, params: Optional[Dict[str, Any]]) -> bytes:
-        """Применение стратегии FAKE DSPLIT"""
-        # Комбинация FAKE и DSPLIT
-        fake_part = self._generate_tls_client_hello()
+    def release(self, host: str, port: int, sock: socket.socket):
+        """Возврат сокета в пул после того, как клиент закрыл соединение"""
+        key = (host, port)
+        now = time.monotonic()
+        rejected = []
+        
+        with self._lock:
+            rejected.extend(self._prune_locked(now))
+            entries = self._idle.setdefault(key, [])
+            if len(entries) < self.max_per_host and self._is_healthy(sock):
+                entries.append((sock, now))
+                self.stats['released'] += 1
+            else:
+                rejected.append(sock)
+                self.stats['discarded'] += 1
         
-        # Разбиваем данные
-        split_point = min(len(data) // 2, 500)
-        part1 = data[:split_point]
-        part2 = data[split_point:]
+        for stale in rejected:
+            stale.close()
+    
+    def close(self):
+        """Закрытие всех простаивающих сокетов"""
+        with self._lock:
+            entries = [sock for socks in self._idle.values() for sock, _ in socks]
+            self._idle.clear()
+        for sock in entries:
+            sock.close()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики пула, включая долю переиспользованных соединений"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['idle'] = sum(len(entries) for entries in self._idle.values())
+        
+        total = stats['created'] + stats['reused']
+        stats['reuse_ratio'] = stats['reused'] / total if total else 0.0
+        return stats
+
+
+class SocketRelay:
+    """Перекачка данных между сокетами без создания объектов на каждую порцию
+    
+    Используется для направлений, которые стратегии не изменяют: server→client
+    и client→server после первого полёта. В Linux данные идут через os.splice
+    (сокет → pipe → сокет) и не копируются в userspace. Где splice недоступен,
+    используется recv_into в буфер из пула (или в переданный буфер).
+    
+    observer получает каждую порцию перед отправкой (учёт HTTP-ответов для
+    пула); данные ему нужны в userspace, поэтому splice с ним отключается.
+    """
+    
+    def __init__(self, pool: Optional[BufferPool] = None, zero_copy: bool = True,
+                 buffer: Optional[bytearray] = None,
+                 observer: Optional[Callable[[memoryview], None]] = None):
+        self.pool = pool
+        self.chunk_size = pool.buffer_size if pool else BUFFER_SIZE
+        self.pipe = None
+        self.buffer = None
+        self.view = None
+        self.observer = observer
+        # Чужой буфер не возвращается в пул при закрытии
+        self._external_buffer = buffer
+        
+        if zero_copy and SPLICE_AVAILABLE and observer is None:
+            try:
+                self.pipe = os.pipe()
+            except OSError:
+                self.pipe = None
+        
+        if self.pipe is None:
+            self._init_buffer()
+    
+    def _init_buffer(self):
+        if self._external_buffer is not None:
+            self.buffer = self._external_buffer
+        elif self.pool:
+            self.buffer = self.pool.acquire()
+        else:
+            self.buffer = bytearray(self.chunk_size)
+        self.view = memoryview(self.buffer)
+    
+    @property
+    def zero_copy(self) -> bool:
+        return self.pipe is not None
+    
+    def relay(self, src: socket.socket, dst: socket.socket) -> int:
+        """Перекачка одной порции из готового к чтению src в dst
+        
+        Возвращает число переданных байт, 0 - src закрыт.
+        """
+        if self.pipe is not None:
+            try:
+                return self._relay_splice(src, dst)
+            except OSError as e:
+                # Сокет не поддерживает splice - переходим на копирование
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                self._close_pipe()
+                self._init_buffer()
+        
+        return self._relay_copy(src, dst)
+    
+    def _relay_splice(self, src: socket.socket, dst: socket.socket) -> int:
+        read_fd, write_fd = self.pipe
+        moved = os.splice(src.fileno(), write_fd, self.chunk_size,
+                          flags=os.SPLICE_F_MOVE)
         
-        # Чередуем фейковые и реальные части
-        result = fake_part + part1 + fake_part + part2
+        remaining = moved
+        while remaining:
+            remaining -= os.splice(read_fd, dst.fileno(), remaining,
+                                   flags=os.SPLICE_F_MOVE)
         
-        return result
+        return moved
     
-    def _apply_multidisorder(self, data: bytes, params: Optional[Dict[str, Any]]) -> bytes:
-        """Применение стратегии MULTIDISORDER"""
-        # Разбиваем на части и перемешиваем порядок
-        part_size = 100
-        parts = [data[i:i+part_size] for i in range(0, len(data), part_size)]
-        
-        # Перемешиваем части
-        random.shuffle(parts)
-        
-        # Добавляем номер последовательности к каждой части
-        result = b''
-        for i, part in enumerate(parts):
-            seq_num = struct.pack('!H', i)
-            result += seq_num + part
-        
-        return result
-    
-    def _apply_timestamp_fooling(self, data: bytes) -> bytes:
-        """Добавление манипуляций с временными метками"""
-        # Добавляем фейковые TCP timestamp options
-        timestamp_option = b'\x08\x0a' + struct.pack('!II', 
-            int(time.time() * 1000), 
-            int(time.time() * 1000) - 1000
-        )
-        
-        # Вставляем в начало пакета
-        return timestamp_option + data
+    def _relay_copy(self, src: socket.socket, dst: socket.socket) -> int:
+        received = src.recv_into(self.buffer)
+        if received:
+            if self.observer is not None:
+                self.observer(self.view[:received])
+            dst.sendall(self.view[:received])
+        return received
     
-    def _apply_md5_signature(self, data: bytes) -> bytes:
-        """Добавление MD5 подписи"""
-        # Создаём MD5 хэш от данных
-        md5_hash = hashlib.md5(data).digest()
-        
-        # Добавляем как заголовок
-        return md5_hash + data
+    def _close_pipe(self):
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
     
-    def _apply_ttl_manipulation(self, data: bytes, ttl_value: int) -> bytes:
-        """Манипуляции с TTL (Time To Live)"""
-        # Для IP пакетов можно манипулировать TTL полем
-        # В упрощённой реализации добавляем TTL как заголовок
-        ttl_header = struct.pack('!B', ttl_value)
-        return ttl_header + data
+    def close(self):
+        self._close_pipe()
+        
+        if self.buffer is not None:
+            self.view.release()
+            if self.pool and self.buffer is not self._external_buffer:
+                self.pool.release(self.buffer)
+            self.buffer = None
+            self.view = None
+
+
+def create_listen_socket(listen_port: int, backlog: int,
+                         reuse_port: bool = False) -> socket.socket:
+    """Слушающий сокет прокси на 127.0.0.1
     
-    def create_proxy_server(self, listen_port: int, target_host: str, 
-                           target_port: int, strategy: DPIStrategy):
-        """Создание прокси-сервера с обходом DPI"""
-        
-        class DPIProxyServer:
-            def __init__(self, bypass_engine, strategy):
-                self.bypass = bypass_engine
-                self.strategy = strategy
-                self.running = False
-                self.server_socket = None
+    С reuse_port несколько процессов слушают один порт, а ядро
+    распределяет между ними входящие соединения (SO_REUSEPORT).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('127.0.0.1', listen_port))
+    sock.listen(backlog)
+    return sock
+
+
+def original_destination(sock: socket.socket) -> Tuple[str, int]:
+    """Исходный адрес назначения соединения, перенаправленного iptables REDIRECT"""
+    raw = sock.getsockopt(socket.SOL_IP, SO_ORIGINAL_DST, 16)
+    port, = struct.unpack_from('!H', raw, 2)
+    return socket.inet_ntoa(raw[4:8]), port
+
+
+def shed_connection(sock: socket.socket):
+    """Сброс соединения при перегрузке: RST вместо долгого ожидания клиента"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
+    sock.close()
+
+
+class DPIProxyServer:
+    """Прокси-сервер с обходом DPI: отдельный поток на каждое соединение
+    
+    Число потоков ограничено max_connections. Соединения сверх лимита ждут
+    в очереди (до max_queued) и обслуживаются освободившимися потоками,
+    остальные сбрасываются.
+    
+    Если target_host равен None, прокси работает прозрачно: цель каждого
+    соединения берётся из SO_ORIGINAL_DST (трафик, перенаправленный iptables).
+    С dispatcher стратегия выбирается по правилам фильтров для каждого
+    соединения, а strategy не используется.
+    """
+    
+    def __init__(self, bypass_engine: DPIBypass, strategy: DPIStrategy,
+                 zero_copy: bool = True, buffer_size: int = BUFFER_SIZE,
+                 buffer_pool_capacity: int = BUFFER_POOL_CAPACITY,
+                 desync_cutoff: Optional[str] = None,
+                 upstream_pool: Optional[UpstreamPool] = None,
+                 backlog: int = LISTEN_BACKLOG,
+                 max_connections: int = MAX_CONNECTIONS,
+                 max_queued: int = MAX_QUEUED,
+                 reuse_port: bool = False,
+                 dispatcher=None):
+        self.bypass = bypass_engine
+        self.strategy = strategy
+        self.desync_cutoff = desync_cutoff
+        self.zero_copy = zero_copy
+        self.buffer_pool = BufferPool(buffer_size, buffer_pool_capacity)
+        # Пул keep-alive соединений к upstream (только для обычного HTTP)
+        self.upstream_pool = upstream_pool
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.max_queued = max_queued
+        self.reuse_port = reuse_port
+        # Правила фильтров: стратегия выбирается для каждого соединения
+        self.dispatcher = dispatcher
+        self.running = False
+        self.server_socket = None
+        self.listen_port = None
+        self.ready = threading.Event()
+        self.stats = {'connections': 0, 'active': 0, 'desynced': 0,
+                      'accepted': 0, 'queued': 0, 'rejected': 0}
+        self._stats_lock = threading.Lock()
+        self._workers = 0
+        self._pending = deque()
+    
+    def start(self, listen_port, target_host, target_port):
+        self.running = True
+        self.server_socket = create_listen_socket(listen_port, self.backlog, self.reuse_port)
+        self.listen_port = self.server_socket.getsockname()[1]
+        self.ready.set()
+        
+        print(f"DPI Proxy запущен на порту {self.listen_port}")
+        
+        while self.running:
+            try:
+                client_socket, addr = self.server_socket.accept()
+            except:
+                break
+            self._admit(client_socket, target_host, target_port)
+        
+        self._drop_pending()
+    
+    def _admit(self, client_socket, target_host, target_port):
+        """Допуск соединения: свободный поток, очередь или сброс"""
+        with self._stats_lock:
+            if self._workers < self.max_connections:
+                self._workers += 1
+                self.stats['accepted'] += 1
+                action = 'start'
+            elif len(self._pending) < self.max_queued:
+                self._pending.append(client_socket)
+                self.stats['queued'] += 1
+                action = 'queued'
+            else:
+                self.stats['rejected'] += 1
+                action = 'rejected'
+        
+        if action == 'start':
+            thread = threading.Thread(
+                target=self._worker,
+                args=(client_socket, target_host, target_port)
+            )
+            thread.daemon = True
+            thread.start()
+        elif action == 'rejected':
+            shed_connection(client_socket)
+    
+    def _worker(self, client_socket, target_host, target_port):
+        """Поток обслуживает соединение, затем забирает следующее из очереди"""
+        while client_socket is not None:
+            self.handle_client(client_socket, target_host, target_port)
+            
+            with self._stats_lock:
+                if self._pending and self.running:
+                    client_socket = self._pending.popleft()
+                    self.stats['accepted'] += 1
+                else:
+                    client_socket = None
+                    self._workers -= 1
+    
+    def _drop_pending(self):
+        with self._stats_lock:
+            pending = list(self._pending)
+            self._pending.clear()
+        for client_socket in pending:
+            shed_connection(client_socket)
+    
+    def handle_client(self, client_socket, target_host, target_port):
+        remote_socket = None
+        buffer = self.buffer_pool.acquire()
+        view = memoryview(buffer)
+        self._count_connection(1)
+        try:
+            # Получаем данные от клиента
+            received = client_socket.recv_into(buffer)
             
-            def start(self, listen_port, target_host, target_port):
-                self.running = True
-                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self.server_socket.bind(('127.0.0.1', listen_port))
-                self.server_socket.listen(5)
+            if received:
+                # Прозрачный режим: цель берётся из исходного адреса соединения
+                if target_host is None:
+                    target_host, target_port = original_destination(client_socket)
                 
-                print(f"DPI Proxy запущен на порту {listen_port}")
+                # Применяем DPI обход
+                desync = self.bypass.create_connection_desync(self.strategy,
+                                                              self.desync_cutoff,
+                                                              self.dispatcher, target_port,
+                                                              target_host,
+                                                              self._count_desynced)
+                exchange = None
+                if self.upstream_pool is not None and is_plain_http(view[:received]):
+                    exchange = HttpExchange()
+                    exchange.feed_request(view[:received])
+                segments = desync.process(view[:received])
                 
-                while self.running:
-                    try:
-                        client_socket, addr = self.server_socket.accept()
-                        thread = threading.Thread(
-                            target=self.handle_client,
-                            args=(client_socket, target_host, target_port)
-                        )
-                        thread.daemon = True
-                        thread.start()
-                    except:
-                        break
-            
-            def handle_client(self, client_socket, target_host, target_port):
-                try:
-                    # Получаем данные от клиента
-                    client_data = client_socket.recv(4096)
-                    
-                    if client_data:
-                        # Применяем DPI обход
-                        bypassed_data = self.bypass.apply_strategy(
-                            client_data, self.strategy
-                        )
-                        
-                        # Устанавливаем соединение с целевым сервером
-                        remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        remote_socket.connect((target_host, target_port))
-                        
-                        # Отправляем модифицированные данные
-                        remote_socket.send(bypassed_data)
-                        
-                        # Проксируем данные в обе стороны
-                        self._proxy_loop(client_socket, remote_socket)
+                # Устанавливаем соединение с целевым сервером
+                if exchange is not None:
+                    remote_socket = self.upstream_pool.acquire(target_host, target_port)
+                if remote_socket is None:
+                    remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    remote_socket.connect((target_host, target_port))
                 
-                except Exception as e:
-                    print(f"Ошибка обработки клиента: {e}")
-                finally:
-                    client_socket.close()
-            
-            def _proxy_loop(self, client_socket, remote_socket):
-                """Проксирование данных между клиентом и сервером"""
-                sockets = [client_socket, remote_socket]
+                # Отправляем модифицированные данные
+                send_segments(remote_socket, segments)
+                
+                # Проксируем данные в обе стороны
+                closed_by = self._proxy_loop(client_socket, remote_socket, buffer, desync,
+                                             exchange)
                 
-                while self.running:
-                    try:
-                        # Используем select для мультиплексирования
-                        readable, _, _ = select.select(sockets, [], [], 1)
-                        
-                        for sock in readable:
-                            data = sock.recv(4096)
+                if (exchange is not None and closed_by == CLOSED_BY_CLIENT
+                        and exchange.idle):
+                    # Upstream ещё открыт - оставляем его следующему клиенту
+                    self.upstream_pool.release(target_host, target_port, remote_socket)
+                    remote_socket = None
+        
+        except Exception as e:
+            print(f"Ошибка обработки клиента: {e}")
+        finally:
+            client_socket.close()
+            if remote_socket:
+                remote_socket.close()
+            view.release()
+            self.buffer_pool.release(buffer)
+            self._count_connection(-1)
+    
+    def _proxy_loop(self, client_socket, remote_socket, buffer, desync,
+                    exchange: Optional[HttpExchange] = None) -> Optional[str]:
+        """Проксирование данных между клиентом и сервером
+        
+        Возвращает, какая сторона закрыла соединение (None - ошибка или стоп).
+        С exchange запросы и ответы учитываются для возврата upstream в пул.
+        """
+        sockets = [client_socket, remote_socket]
+        view = memoryview(buffer)
+        feed_request = exchange.feed_request if exchange is not None else None
+        feed_response = exchange.feed_response if exchange is not None else None
+        downstream = SocketRelay(self.buffer_pool, zero_copy=self.zero_copy,
+                                 observer=feed_response)
+        upstream = None
+        
+        try:
+            while self.running:
+                try:
+                    # Используем select для мультиплексирования
+                    readable, _, _ = select.select(sockets, [], [], 1)
+                    
+                    for sock in readable:
+                        if sock is client_socket:
+                            if upstream is None and desync.passthrough:
+                                # Первый полёт позади - дальше прямая передача
+                                upstream = SocketRelay(self.buffer_pool,
+                                                       zero_copy=self.zero_copy,
+                                                       buffer=buffer,
+                                                       observer=feed_request)
                             
-                            if not data:
-                                return
+                            if upstream is not None:
+                                if not upstream.relay(client_socket, remote_socket):
+                                    return CLOSED_BY_CLIENT
+                                continue
                             
-                            if sock is client_socket:
-                                # Данные от клиента - применяем DPI обход
-                                bypassed_data = self.bypass.apply_strategy(data, self.strategy)
-                                remote_socket.send(bypassed_data)
-                            else:
-                                # Данные от сервера - отправляем как есть
-                                client_socket.send(data)
-                    
-                    except:
-                        break
+                            received = sock.recv_into(view)
+                            
+                            if not received:
+                                return CLOSED_BY_CLIENT
+                            
+                            if feed_request is not None:
+                                feed_request(view[:received])
+                            # Данные от клиента - применяем DPI обход
+                            send_segments(remote_socket, desync.process(view[:received]))
+                        else:
+                            # Данные от сервера - передаём как есть, без копирования
+                            if not downstream.relay(remote_socket, client_socket):
+                                return CLOSED_BY_REMOTE
+                
+                except:
+                    break
+        finally:
+            downstream.close()
+            if upstream is not None:
+                upstream.close()
+            view.release()
+    
+    def _count_connection(self, delta: int):
+        with self._stats_lock:
+            if delta > 0:
+                self.stats['connections'] += 1
+            self.stats['active'] += delta
+    
+    def _count_desynced(self):
+        with self._stats_lock:
+            self.stats['desynced'] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Снимок счётчиков прокси"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+            stats['waiting'] = len(self._pending)
+        stats['buffer_pool'] = self.buffer_pool.get_stats()
+        stats['templates'] = self.bypass.templates.get_stats()
+        if self.dispatcher is not None:
+            stats['dispatcher'] = self.dispatcher.get_stats()
+        if self.upstream_pool is not None:
+            stats['upstream_pool'] = self.upstream_pool.get_stats()
+        return stats
+    
+    def stop(self):
+        self.running = False
+        if self.server_socket:
+            # shutdown будит поток, заблокированный в accept()
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+        if self.upstream_pool is not None:
+            self.upstream_pool.close()
+
+
+class AsyncDPIProxyServer:
+    """Прокси-сервер с обходом DPI: все соединения на одном event loop (asyncio)
+    
+    Вместо потока на клиента все пары клиент/сервер мультиплексируются
+    одним циклом событий, что экономит память на стеках потоков и убирает
+    конкуренцию за GIL при сотнях одновременных соединений.
+    """
+    
+    def __init__(self, bypass_engine: DPIBypass, strategy: DPIStrategy,
+                 zero_copy: bool = True, buffer_size: int = BUFFER_SIZE,
+                 buffer_pool_capacity: int = BUFFER_POOL_CAPACITY,
+                 desync_cutoff: Optional[str] = None,
+                 upstream_pool: Optional[UpstreamPool] = None,
+                 backlog: int = LISTEN_BACKLOG,
+                 max_connections: int = MAX_CONNECTIONS,
+                 max_queued: int = MAX_QUEUED,
+                 reuse_port: bool = False,
+                 dispatcher=None):
+        self.bypass = bypass_engine
+        self.strategy = strategy
+        self.desync_cutoff = desync_cutoff
+        self.upstream_pool = upstream_pool
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.max_queued = max_queued
+        self.reuse_port = reuse_port
+        # Правила фильтров: стратегия выбирается для каждого соединения
+        self.dispatcher = dispatcher
+        # splice не сочетается с неблокирующими сокетами цикла событий,
+        # поэтому здесь server→client всегда идёт через recv_into
+        self.zero_copy = False
+        self.buffer_pool = BufferPool(buffer_size, buffer_pool_capacity)
+        self.running = False
+        self.server_socket = None
+        self.listen_port = None
+        self.ready = threading.Event()
+        self.stats = {'connections': 0, 'active': 0, 'desynced': 0,
+                      'accepted': 0, 'queued': 0, 'rejected': 0}
+        self.loop = None
+        self._stop_event = None
+        self._slots = None
+        # Допущенные соединения: ждущие слота и все, кроме закрытых
+        self._waiting = 0
+        self._admitted = 0
+        self._tasks = set()
+    
+    def start(self, listen_port, target_host, target_port):
+        """Блокирующий запуск: цикл событий работает в текущем потоке"""
+        asyncio.run(self._serve(listen_port, target_host, target_port))
+    
+    async def _serve(self, listen_port, target_host, target_port):
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_connections)
+        
+        self.server_socket = create_listen_socket(listen_port, self.backlog, self.reuse_port)
+        self.server_socket.setblocking(False)
+        self.listen_port = self.server_socket.getsockname()[1]
+        self.running = True
+        self.ready.set()
+        
+        print(f"DPI Proxy (asyncio) запущен на порту {self.listen_port}")
+        
+        accept_task = self.loop.create_task(
+            self._accept_loop(target_host, target_port)
+        )
+        try:
+            await self._stop_event.wait()
+        finally:
+            self.running = False
+            accept_task.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(accept_task, *self._tasks, return_exceptions=True)
+            self.server_socket.close()
+            if self.upstream_pool is not None:
+                self.upstream_pool.close()
+    
+    async def _accept_loop(self, target_host, target_port):
+        while self.running:
+            try:
+                client_socket, addr = await self.loop.sock_accept(self.server_socket)
+            except OSError:
+                break
+            client_socket.setblocking(False)
+            
+            # Допуск соединения: свободный слот, очередь или сброс. Счётчики
+            # растут здесь, до запуска задачи: при пачке готовых соединений
+            # sock_accept не уступает цикл и задачи ещё не начали работу
+            if self._admitted >= self.max_connections:
+                if self._admitted - self.max_connections >= self.max_queued:
+                    self.stats['rejected'] += 1
+                    shed_connection(client_socket)
+                    continue
+                self.stats['queued'] += 1
+            self._admitted += 1
+            self._waiting += 1
+            
+            task = self.loop.create_task(
+                self._admitted_client(client_socket, target_host, target_port)
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _admitted_client(self, client_socket, target_host, target_port):
+        """Ожидание свободного слота и обслуживание соединения"""
+        try:
+            try:
+                await self._slots.acquire()
+            except asyncio.CancelledError:
+                client_socket.close()
+                raise
+            finally:
+                self._waiting -= 1
             
-            def stop(self):
-                self.running = False
-                if self.server_socket:
-                    self.server_socket.close()
+            try:
+                self.stats['accepted'] += 1
+                await self.handle_client(client_socket, target_host, target_port)
+            finally:
+                self._slots.release()
+        finally:
+            self._admitted -= 1
+    
+    def _count_desynced(self):
+        # Вызывается из цикла событий - блокировка не нужна
+        self.stats['desynced'] += 1
+    
+    async def handle_client(self, client_socket, target_host, target_port):
+        remote_socket = None
+        buffer = self.buffer_pool.acquire()
+        view = memoryview(buffer)
+        self.stats['connections'] += 1
+        self.stats['active'] += 1
+        try:
+            # Получаем данные от клиента
+            received = await self.loop.sock_recv_into(client_socket, buffer)
+            
+            if received:
+                # Прозрачный режим: цель берётся из исходного адреса соединения
+                if target_host is None:
+                    target_host, target_port = original_destination(client_socket)
+                
+                # Применяем DPI обход
+                desync = self.bypass.create_connection_desync(self.strategy,
+                                                              self.desync_cutoff,
+                                                              self.dispatcher, target_port,
+                                                              target_host,
+                                                              self._count_desynced)
+                exchange = None
+                if self.upstream_pool is not None and is_plain_http(view[:received]):
+                    exchange = HttpExchange()
+                    exchange.feed_request(view[:received])
+                segments = desync.process(view[:received])
+                
+                # Устанавливаем соединение с целевым сервером
+                if exchange is not None:
+                    remote_socket = self.upstream_pool.acquire(target_host, target_port)
+                if remote_socket is None:
+                    remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    remote_socket.setblocking(False)
+                    await self.loop.sock_connect(remote_socket, (target_host, target_port))
+                
+                # Отправляем модифицированные данные
+                await self._send_segments(remote_socket, segments)
+                
+                # Проксируем данные в обе стороны
+                closed_by = await self._proxy_loop(client_socket, remote_socket, view, desync,
+                                                   exchange)
+                
+                if (exchange is not None and closed_by == CLOSED_BY_CLIENT
+                        and exchange.idle):
+                    # Upstream ещё открыт - оставляем его следующему клиенту
+                    self.upstream_pool.release(target_host, target_port, remote_socket)
+                    remote_socket = None
+        
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Ошибка обработки клиента: {e}")
+        finally:
+            client_socket.close()
+            if remote_socket:
+                remote_socket.close()
+            view.release()
+            self.buffer_pool.release(buffer)
+            self.stats['active'] -= 1
+    
+    async def _proxy_loop(self, client_socket, remote_socket, view, desync,
+                          exchange: Optional[HttpExchange] = None) -> Optional[str]:
+        """Проксирование данных между клиентом и сервером
+        
+        Возвращает, какая сторона закрыла соединение (None - ошибка).
+        С exchange запросы и ответы учитываются для возврата upstream в пул.
+        """
+        upstream = self.loop.create_task(
+            self._pump(client_socket, remote_socket, view, desync,
+                       exchange.feed_request if exchange is not None else None)
+        )
+        downstream = self.loop.create_task(
+            self._relay(remote_socket, client_socket,
+                        exchange.feed_response if exchange is not None else None)
+        )
         
-        # Создаём и возвращаем экземпляр прокси
-        proxy = DPIProxyServer(self, strategy)
-        return proxy
\ No newline at end of file
+        # Как и в поточном режиме, соединение завершается по EOF с любой стороны
+        done, pending = await asyncio.wait(
+            {upstream, downstream}, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        
+        if upstream in done and upstream.result():
+            return CLOSED_BY_CLIENT
+        if downstream in done and downstream.result():
+            return CLOSED_BY_REMOTE
+        return None
+    
+    async def _pump(self, src, dst, view, desync,
+                    observer: Optional[Callable[[memoryview], None]] = None) -> bool:
+        """Перекачка client→server с применением DPI обхода к первому полёту
+        
+        True - клиент закрыл соединение, False - ошибка сокета.
+        """
+        try:
+            while True:
+                received = await self.loop.sock_recv_into(src, view)
+                if not received:
+                    return True
+                
+                if observer is not None:
+                    observer(view[:received])
+                if desync.passthrough:
+                    # После первого полёта данные идут без изменений
+                    await self.loop.sock_sendall(dst, view[:received])
+                else:
+                    await self._send_segments(dst, desync.process(view[:received]))
+        except OSError:
+            return False
+    
+    async def _send_segments(self, sock, segments: List[Segment]):
+        """Неблокирующая отправка сегментов стратегии"""
+        groups = group_segments(segments)
+        if len(groups) > 1:
+            set_nodelay(sock)
+        
+        for delay, buffers in groups:
+            if delay:
+                await asyncio.sleep(delay)
+            await self._send_buffers(sock, buffers)
+    
+    async def _send_buffers(self, sock, buffers: List[Buffer]):
+        """Неблокирующая отправка буферов через sendmsg"""
+        if not hasattr(sock, 'sendmsg'):
+            for buffer in buffers:
+                await self.loop.sock_sendall(sock, buffer)
+            return
+        
+        pending = [memoryview(buffer) for buffer in buffers if len(buffer)]
+        index = 0
+        while index < len(pending):
+            try:
+                sent = sock.sendmsg(pending[index:index + IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                await self._wait_writable(sock)
+                continue
+            index = _advance_segments(pending, index, sent)
+    
+    async def _wait_writable(self, sock):
+        waiter = self.loop.create_future()
+        
+        def on_writable():
+            if not waiter.done():
+                waiter.set_result(None)
+        
+        fd = sock.fileno()
+        self.loop.add_writer(fd, on_writable)
+        try:
+            await waiter
+        finally:
+            self.loop.remove_writer(fd)
+    
+    async def _relay(self, src, dst,
+                     observer: Optional[Callable[[memoryview], None]] = None) -> bool:
+        """Перекачка server→client через буфер из пула
+        
+        True - сервер закрыл соединение, False - ошибка сокета.
+        """
+        buffer = self.buffer_pool.acquire()
+        view = memoryview(buffer)
+        try:
+            while True:
+                received = await self.loop.sock_recv_into(src, buffer)
+                if not received:
+                    return True
+                if observer is not None:
+                    observer(view[:received])
+                await self.loop.sock_sendall(dst, view[:received])
+        except OSError:
+            return False
+        finally:
+            view.release()
+            self.buffer_pool.release(buffer)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Снимок счётчиков прокси"""
+        stats = dict(self.stats)
+        stats['waiting'] = self._waiting
+        stats['buffer_pool'] = self.buffer_pool.get_stats()
+        stats['templates'] = self.bypass.templates.get_stats()
+        if self.dispatcher is not None:
+            stats['dispatcher'] = self.dispatcher.get_stats()
+        if self.upstream_pool is not None:
+            stats['upstream_pool'] = self.upstream_pool.get_stats()
+        return stats
+    
+    def stop(self):
+        self.running = False
+        loop = self.loop
+        if loop and self._stop_event and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                # Цикл уже завершился
+                pass
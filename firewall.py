@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import socket
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterable, List, Optional, Sequence
+
+from ip_index import parse_network
+from strategy_rules import parse_ports
+
+# Собственная цепочка: правила zapret не смешиваются с чужими
+IPTABLES_CHAIN = 'ZAPRET'
+IPTABLES_TABLE = 'nat'
+
+# Не больше 15 портов в одном -m multiport (диапазон занимает два)
+MULTIPORT_LIMIT = 15
+
+# Набор адресов в ядре для отбора трафика, который идёт в прокси
+IPSET_NAME = 'zapret'
+IPSET_MAXELEM = 65536
+
+# UDP: TPROXY в mangle, локальный трафик помечается в OUTPUT и по
+# policy routing возвращается через lo в PREROUTING
+TPROXY_TABLE = 'mangle'
+TPROXY_CHAIN = 'ZAPRET_UDP'
+TPROXY_MARK = 0x1
+TPROXY_ROUTE_TABLE = 100
+
+# Пакетный движок: первые пакеты соединений идут в NFQUEUE, пакеты самого
+# движка (с меткой) - мимо очереди
+NFQUEUE_CHAIN = 'ZAPRET_NFQ'
+NFQUEUE_CONNBYTES = '1:6'
+NFQUEUE_MARK = 0x40000000
+
+
+def multiport_groups(spec: str) -> List[str]:
+    """Список портов zapret (80,443,50000-50100) в группы для --dports"""
+    groups = []
+    current = []
+    used = 0
+    for low, high in parse_ports(spec):
+        item, cost = (str(low), 1) if low == high else (f'{low}:{high}', 2)
+        if used + cost > MULTIPORT_LIMIT:
+            groups.append(','.join(current))
+            current, used = [], 0
+        current.append(item)
+        used += cost
+    if current:
+        groups.append(','.join(current))
+    return groups
+
+
+def build_redirect_rules(proxy_port: int, tcp_ports: str,
+                         ipsets: Sequence[str] = (),
+                         exclude_uid: Optional[int] = None,
+                         chain: str = IPTABLES_CHAIN,
+                         jump: bool = True) -> str:
+    """Транзакция iptables-restore: цепочка chain с REDIRECT на прокси
+
+    Объявление цепочки при --noflush создаёт её или очищает, поэтому
+    повторная установка заменяет правила целиком. С ipsets перенаправляется
+    только трафик к адресам из этих наборов (-m set --match-set).
+    jump=False - переход из OUTPUT уже есть и не добавляется второй раз.
+    """
+    lines = [f'*{IPTABLES_TABLE}', f':{chain} - [0:0]']
+    lines.append(f'-A {chain} -d 127.0.0.0/8 -j RETURN')
+    if exclude_uid is not None:
+        # Исходящие соединения самого прокси не заворачиваются обратно в него
+        lines.append(f'-A {chain} -m owner --uid-owner {exclude_uid} -j RETURN')
+
+    matches = [f'-m set --match-set {name} dst ' for name in ipsets] or ['']
+    for match in matches:
+        for ports in multiport_groups(tcp_ports):
+            lines.append(f'-A {chain} -p tcp {match}-m multiport --dports {ports} '
+                         f'-j REDIRECT --to-ports {proxy_port}')
+
+    if jump:
+        lines.append(f'-A OUTPUT -j {chain}')
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def build_teardown_rules(chain: str = IPTABLES_CHAIN, jump: bool = True) -> str:
+    """Транзакция удаления цепочки chain (остальные правила не трогаются)"""
+    lines = [f'*{IPTABLES_TABLE}', f':{chain} - [0:0]']
+    if jump:
+        lines.append(f'-D OUTPUT -j {chain}')
+    lines += [f'-X {chain}', 'COMMIT']
+    return '\n'.join(lines) + '\n'
+
+
+def build_tproxy_rules(proxy_port: int, udp_ports: str,
+                       ipsets: Sequence[str] = (),
+                       exclude_uid: Optional[int] = None,
+                       chain: str = TPROXY_CHAIN,
+                       mark: int = TPROXY_MARK,
+                       jump: bool = True) -> str:
+    """Транзакция iptables-restore: UDP на порты стратегии в TPROXY
+
+    В chain (из OUTPUT) датаграммы помечаются mark, в {chain}_TPROXY (из
+    PREROUTING) помеченные отдаются слушающему сокету с IP_TRANSPARENT,
+    который видит исходный адрес назначения.
+    """
+    tproxy = f'{chain}_TPROXY'
+    lines = [f'*{TPROXY_TABLE}', f':{chain} - [0:0]', f':{tproxy} - [0:0]']
+    lines.append(f'-A {chain} -d 127.0.0.0/8 -j RETURN')
+    if exclude_uid is not None:
+        lines.append(f'-A {chain} -m owner --uid-owner {exclude_uid} -j RETURN')
+
+    matches = [f'-m set --match-set {name} dst ' for name in ipsets] or ['']
+    for match in matches:
+        for ports in multiport_groups(udp_ports):
+            lines.append(f'-A {chain} -p udp {match}-m multiport --dports {ports} '
+                         f'-j MARK --set-mark {mark:#x}')
+    lines.append(f'-A {tproxy} -p udp -m mark --mark {mark:#x} '
+                 f'-j TPROXY --on-ip 127.0.0.1 --on-port {proxy_port} '
+                 f'--tproxy-mark {mark:#x}')
+
+    if jump:
+        lines.append(f'-A OUTPUT -j {chain}')
+        lines.append(f'-A PREROUTING -j {tproxy}')
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def build_tproxy_teardown(chain: str = TPROXY_CHAIN, jump: bool = True) -> str:
+    """Транзакция удаления цепочек TPROXY"""
+    tproxy = f'{chain}_TPROXY'
+    lines = [f'*{TPROXY_TABLE}', f':{chain} - [0:0]', f':{tproxy} - [0:0]']
+    if jump:
+        lines += [f'-D OUTPUT -j {chain}', f'-D PREROUTING -j {tproxy}']
+    lines += [f'-X {chain}', f'-X {tproxy}', 'COMMIT']
+    return '\n'.join(lines) + '\n'
+
+
+def build_nfqueue_rules(queue_num: int, tcp_ports: str, udp_ports: str = '',
+                        ipsets: Sequence[str] = (),
+                        chain: str = NFQUEUE_CHAIN,
+                        mark: int = NFQUEUE_MARK,
+                        jump: bool = True) -> str:
+    """Транзакция iptables-restore: первые пакеты соединений в NFQUEUE
+
+    connbytes ограничивает очередь первым полётом, остальной трафик ядро
+    пропускает само. --queue-bypass: без движка пакеты идут как обычно.
+    """
+    lines = [f'*{TPROXY_TABLE}', f':{chain} - [0:0]']
+    lines.append(f'-A {chain} -m mark --mark {mark:#x}/{mark:#x} -j RETURN')
+    matches = [f'-m set --match-set {name} dst ' for name in ipsets] or ['']
+    for proto, spec in (('tcp', tcp_ports), ('udp', udp_ports)):
+        if not spec:
+            continue
+        for match in matches:
+            for ports in multiport_groups(spec):
+                lines.append(f'-A {chain} -p {proto} {match}-m multiport --dports {ports} '
+                             f'-m connbytes --connbytes-dir=original --connbytes-mode=packets '
+                             f'--connbytes {NFQUEUE_CONNBYTES} '
+                             f'-j NFQUEUE --queue-num {queue_num} --queue-bypass')
+    if jump:
+        lines.append(f'-A POSTROUTING -j {chain}')
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def build_nfqueue_teardown(chain: str = NFQUEUE_CHAIN, jump: bool = True) -> str:
+    """Транзакция удаления цепочки NFQUEUE"""
+    lines = [f'*{TPROXY_TABLE}', f':{chain} - [0:0]']
+    if jump:
+        lines.append(f'-D POSTROUTING -j {chain}')
+    lines += [f'-X {chain}', 'COMMIT']
+    return '\n'.join(lines) + '\n'
+
+
+def build_tproxy_routes(add: bool = True, mark: int = TPROXY_MARK,
+                        table: int = TPROXY_ROUTE_TABLE) -> str:
+    """Пакет ip -batch: помеченные датаграммы доставляются локально"""
+    action = 'add' if add else 'del'
+    return (f'rule {action} fwmark {mark:#x} lookup {table}\n'
+            f'route {action} local 0.0.0.0/0 dev lo table {table}\n')
+
+
+def ipv4_networks(networks: Iterable[str]) -> List[str]:
+    """Подсети IPv4 в каноническом виде без повторов (IPv6 и мусор пропускаются)"""
+    result = set()
+    for network in networks:
+        try:
+            width, key, length = parse_network(network)
+        except ValueError:
+            continue
+        if width != 32:
+            continue
+        key &= ((1 << length) - 1) << (32 - length) if length else 0
+        result.add(f'{socket.inet_ntoa(key.to_bytes(4, "big"))}/{length}')
+    return sorted(result)
+
+
+def resolve_ipv4(domains: Iterable[str], max_workers: int = 16) -> List[str]:
+    """Адреса IPv4 доменов из hostlist (параллельно, неразрешённые пропускаются)"""
+    def resolve(domain):
+        try:
+            return {info[4][0] for info in socket.getaddrinfo(domain, None, socket.AF_INET)}
+        except (OSError, UnicodeError):
+            return set()
+
+    domains = sorted(set(domains))
+    if not domains:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(domains))) as executor:
+        return sorted(set().union(*executor.map(resolve, domains)))
+
+
+def build_ipset_restore(name: str, networks: Sequence[str]) -> str:
+    """Пакет ipset restore: временный набор заполняется и подменяет рабочий
+
+    swap атомарен: правила iptables, ссылающиеся на name, всё время видят
+    либо старый, либо новый набор целиком.
+    """
+    maxelem = max(IPSET_MAXELEM, len(networks))
+    temp = f'{name}-tmp'
+    lines = [f'create {temp} hash:net family inet maxelem {maxelem} -exist',
+             f'flush {temp}']
+    lines += [f'add {temp} {network}' for network in networks]
+    lines += [f'create {name} hash:net family inet maxelem {maxelem} -exist',
+              f'swap {temp} {name}',
+              f'destroy {temp}']
+    return '\n'.join(lines) + '\n'
+
+
+class KernelIpset:
+    """Набор подсетей назначения в ядре (ipset hash:net)
+
+    Загружается одним вызовом ipset restore; правила REDIRECT с
+    -m set --match-set отправляют в прокси только трафик к этим адресам.
+    """
+
+    def __init__(self, ipset: str = 'ipset', name: str = IPSET_NAME):
+        self.ipset = ipset
+        self.name = name
+        self.stats = {'load_ms': 0.0, 'entries': 0, 'errors': 0}
+
+    def _run(self, args: List[str], batch: Optional[str] = None) -> bool:
+        try:
+            result = subprocess.run([self.ipset] + args, input=batch, capture_output=True,
+                                    text=True, check=False)
+        except OSError as e:
+            print(f"ipset недоступен: {e}")
+            self.stats['errors'] += 1
+            return False
+        if result.returncode != 0:
+            print(f"Ошибка ipset: {result.stderr.strip()}")
+            self.stats['errors'] += 1
+            return False
+        return True
+
+    def load(self, networks: Iterable[str]) -> bool:
+        """Замена содержимого набора; networks - подсети и адреса IPv4"""
+        started = time.perf_counter()
+        networks = ipv4_networks(networks)
+        success = self._run(['restore'], build_ipset_restore(self.name, networks))
+        self.stats['load_ms'] = (time.perf_counter() - started) * 1000.0
+        if success:
+            self.stats['entries'] = len(networks)
+        return success
+
+    def destroy(self) -> bool:
+        """Удаление набора (после снятия правил iptables, которые на него ссылаются)"""
+        success = self._run(['destroy', self.name])
+        if success:
+            self.stats['entries'] = 0
+        return success
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self.stats)
+
+
+class IptablesRedirect:
+    """Перенаправление трафика на прокси одной транзакцией iptables-restore
+
+    Вместо запуска iptables на каждое правило весь набор применяется
+    атомарно (iptables-restore --noflush), а при остановке удаляется только
+    цепочка ZAPRET. Пути к iptables настраиваются, в тестах их заменяет
+    фиктивный скрипт.
+    """
+
+    def __init__(self, iptables: str = 'iptables',
+                 iptables_restore: str = 'iptables-restore',
+                 chain: str = IPTABLES_CHAIN, ip: str = 'ip',
+                 udp_chain: str = TPROXY_CHAIN, nfqueue_chain: str = NFQUEUE_CHAIN):
+        self.iptables = iptables
+        self.iptables_restore = iptables_restore
+        self.chain = chain
+        self.ip = ip
+        self.udp_chain = udp_chain
+        self.nfqueue_chain = nfqueue_chain
+        self.stats = {'setup_ms': 0.0, 'teardown_ms': 0.0, 'rules': 0, 'udp_rules': 0,
+                      'nfqueue_rules': 0, 'errors': 0}
+
+    def _run(self, args: List[str], rules: Optional[str] = None) -> bool:
+        try:
+            result = subprocess.run(args, input=rules, capture_output=True, text=True,
+                                    check=False)
+        except OSError as e:
+            # Нет iptables или прав root
+            print(f"iptables недоступен: {e}")
+            self.stats['errors'] += 1
+            return False
+        if result.returncode != 0:
+            print(f"Ошибка iptables: {result.stderr.strip()}")
+            self.stats['errors'] += 1
+            return False
+        return True
+
+    def _jump_installed(self, table: str = IPTABLES_TABLE,
+                        chain: Optional[str] = None, parent: str = 'OUTPUT') -> bool:
+        try:
+            result = subprocess.run(
+                [self.iptables, '-t', table, '-C', parent, '-j', chain or self.chain],
+                capture_output=True, check=False
+            )
+        except OSError:
+            return False
+        return result.returncode == 0
+
+    def _restore(self, rules: str) -> bool:
+        return self._run([self.iptables_restore, '--noflush'], rules)
+
+    def setup(self, proxy_port: int, tcp_ports: str, ipsets: Sequence[str] = (),
+              exclude_uid: Optional[int] = None) -> bool:
+        """Установка (или замена) правил перенаправления"""
+        started = time.perf_counter()
+        rules = build_redirect_rules(proxy_port, tcp_ports, ipsets, exclude_uid,
+                                     self.chain, jump=not self._jump_installed())
+        success = self._restore(rules)
+        self.stats['setup_ms'] = (time.perf_counter() - started) * 1000.0
+        if success:
+            self.stats['rules'] = sum(1 for line in rules.splitlines()
+                                      if line.startswith(f'-A {self.chain} '))
+        return success
+
+    def teardown(self) -> bool:
+        """Удаление цепочки ZAPRET и перехода в неё"""
+        started = time.perf_counter()
+        success = self._restore(build_teardown_rules(self.chain, self._jump_installed()))
+        self.stats['teardown_ms'] = (time.perf_counter() - started) * 1000.0
+        if success:
+            self.stats['rules'] = 0
+        return success
+
+    def setup_udp(self, proxy_port: int, udp_ports: str, ipsets: Sequence[str] = (),
+                  exclude_uid: Optional[int] = None) -> bool:
+        """Установка TPROXY для UDP и маршрута помеченных датаграмм через lo"""
+        started = time.perf_counter()
+        jump = not self._jump_installed(TPROXY_TABLE, self.udp_chain)
+        rules = build_tproxy_rules(proxy_port, udp_ports, ipsets, exclude_uid,
+                                   self.udp_chain, jump=jump)
+        success = self._restore(rules)
+        if success and jump:
+            # Маршрут добавляется вместе с переходами, при замене правил он уже есть
+            success = self._run([self.ip, '-batch', '-'], build_tproxy_routes(True))
+        self.stats['setup_ms'] = (time.perf_counter() - started) * 1000.0
+        if success:
+            self.stats['udp_rules'] = sum(1 for line in rules.splitlines()
+                                          if line.startswith(f'-A {self.udp_chain}'))
+        return success
+
+    def teardown_udp(self) -> bool:
+        """Удаление цепочек TPROXY и маршрута"""
+        started = time.perf_counter()
+        jump = self._jump_installed(TPROXY_TABLE, self.udp_chain)
+        success = self._restore(build_tproxy_teardown(self.udp_chain, jump))
+        if jump:
+            success = self._run([self.ip, '-force', '-batch', '-'],
+                                build_tproxy_routes(False)) and success
+        self.stats['teardown_ms'] = (time.perf_counter() - started) * 1000.0
+        if success:
+            self.stats['udp_rules'] = 0
+        return success
+
+    def setup_nfqueue(self, queue_num: int, tcp_ports: str, udp_ports: str = '',
+                      ipsets: Sequence[str] = ()) -> bool:
+        """Установка правил NFQUEUE для пакетного движка"""
+        started = time.perf_counter()
+        jump = not self._jump_installed(TPROXY_TABLE, self.nfqueue_chain, 'POSTROUTING')
+        rules = build_nfqueue_rules(queue_num, tcp_ports, udp_ports, ipsets,
+                                    self.nfqueue_chain, jump=jump)
+        success = self._restore(rules)
+        self.stats['setup_ms'] = (time.perf_counter() - started) * 1000.0
+        if success:
+            self.stats['nfqueue_rules'] = sum(1 for line in rules.splitlines()
+                                              if line.startswith(f'-A {self.nfqueue_chain} '))
+        return success
+
+    def teardown_nfqueue(self) -> bool:
+        """Удаление цепочки NFQUEUE"""
+        started = time.perf_counter()
+        jump = self._jump_installed(TPROXY_TABLE, self.nfqueue_chain, 'POSTROUTING')
+        success = self._restore(build_nfqueue_teardown(self.nfqueue_chain, jump))
+        self.stats['teardown_ms'] = (time.perf_counter() - started) * 1000.0
+        if success:
+            self.stats['nfqueue_rules'] = 0
+        return success
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self.stats)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ipaddress
+import socket
+import struct
+from array import array
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple, Union
+
+# Заголовок сериализованного индекса: сигнатура, версия, число подсетей,
+# длина списка имён
+INDEX_HEADER = struct.Struct('=4sIII')
+INDEX_MAGIC = b'ZIPX'
+INDEX_VERSION = 1
+# Заголовок дерева: разрядность адреса и число узлов
+TRIE_HEADER = struct.Struct('=II')
+
+NO_NODE = -1
+
+Address = Union[str, bytes, int]
+
+
+def read_ipset(path: str) -> Iterator[str]:
+    """Подсети из файла ipset: по одной в строке, # - комментарий"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    yield line
+    except OSError:
+        return
+
+
+def parse_network(network: str) -> Tuple[int, int, int]:
+    """Разбор подсети '10.0.0.0/8' или адреса: (разрядность, ключ, длина префикса)
+
+    Работает через inet_pton и в разы быстрее ipaddress на больших списках.
+    """
+    address, _, length = network.partition('/')
+    if ':' in address:
+        width, family = 128, socket.AF_INET6
+    else:
+        width, family = 32, socket.AF_INET
+    try:
+        key = int.from_bytes(socket.inet_pton(family, address), 'big')
+        length = int(length) if length else width
+    except (OSError, ValueError):
+        raise ValueError(f"Некорректная подсеть: {network!r}")
+    if not 0 <= length <= width:
+        raise ValueError(f"Некорректная подсеть: {network!r}")
+    return width, key, length
+
+
+def _align(offset: int, size: int = 8) -> int:
+    return (offset + size - 1) // size * size
+
+
+class PrefixTrie:
+    """Сжатое двоичное дерево префиксов (Patricia) для адресов одной разрядности
+
+    Узлы лежат в плоских массивах: длина префикса, левый и правый потомок,
+    маска списков и ключ (одно или два 64-битных слова). Цепочки узлов с одним
+    потомком не хранятся, поэтому глубина поиска - число развилок, а не 32/128.
+    Массивы могут быть memoryview поверх готового буфера (from_buffer).
+    """
+
+    def __init__(self, width: int):
+        self.width = width
+        self.words = 1 if width <= 64 else 2
+        self.lengths = array('B', [0])
+        self.left = array('i', [NO_NODE])
+        self.right = array('i', [NO_NODE])
+        self.values = array('Q', [0])
+        self.keys = array('Q', [0] * self.words)
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def _key(self, node: int) -> int:
+        if self.words == 1:
+            return self.keys[node]
+        return self.keys[2 * node] << 64 | self.keys[2 * node + 1]
+
+    def _new_node(self, key: int, length: int, value: int = 0) -> int:
+        self.lengths.append(length)
+        self.left.append(NO_NODE)
+        self.right.append(NO_NODE)
+        self.values.append(value)
+        if self.words == 1:
+            self.keys.append(key)
+        else:
+            self.keys.append(key >> 64)
+            self.keys.append(key & 0xFFFFFFFFFFFFFFFF)
+        return len(self.lengths) - 1
+
+    def _child(self, node: int, bit: int) -> int:
+        return self.right[node] if bit else self.left[node]
+
+    def _set_child(self, node: int, bit: int, child: int):
+        if bit:
+            self.right[node] = child
+        else:
+            self.left[node] = child
+
+    def _bit(self, key: int, position: int) -> int:
+        return (key >> (self.width - 1 - position)) & 1
+
+    def insert(self, key: int, length: int, value: int):
+        """Добавление префикса key/length с маской списков value"""
+        width = self.width
+        lengths, left, right = self.lengths, self.left, self.right
+        key &= ((1 << length) - 1) << (width - length) if length else 0
+        node = 0
+
+        while True:
+            node_length = lengths[node]
+            if node_length == length:
+                self.values[node] |= value
+                return
+
+            bit = (key >> (width - 1 - node_length)) & 1
+            child = right[node] if bit else left[node]
+            if child == NO_NODE:
+                self._set_child(node, bit, self._new_node(key, length, value))
+                return
+
+            child_key = self._key(child)
+            child_length = lengths[child]
+            common = min(child_length, length, width - (child_key ^ key).bit_length())
+            if common == child_length:
+                node = child
+                continue
+
+            # Развилка: общий префикс становится новым узлом
+            mask = ((1 << common) - 1) << (width - common) if common else 0
+            middle = self._new_node(key & mask, common)
+            self._set_child(node, bit, middle)
+            self._set_child(middle, self._bit(child_key, common), child)
+            if common == length:
+                self.values[middle] = value
+            else:
+                self._set_child(middle, self._bit(key, common),
+                                self._new_node(key, length, value))
+            return
+
+    def lookup(self, address: int) -> int:
+        """Объединение масок всех префиксов, содержащих адрес"""
+        width = self.width
+        lengths, left, right, values = self.lengths, self.left, self.right, self.values
+        keys = self.keys
+        single = self.words == 1
+        mask = 0
+        node = 0
+
+        while node != NO_NODE:
+            length = lengths[node]
+            key = keys[node] if single else keys[2 * node] << 64 | keys[2 * node + 1]
+            if length and (address ^ key) >> (width - length):
+                break
+            mask |= values[node]
+            if length == width:
+                break
+            node = right[node] if (address >> (width - 1 - length)) & 1 else left[node]
+        return mask
+
+    def longest_prefix(self, address: int) -> Optional[Tuple[int, int, int]]:
+        """Самый длинный префикс с адресом: (ключ, длина, маска) или None"""
+        width = self.width
+        best = None
+        node = 0
+
+        while node != NO_NODE:
+            length = self.lengths[node]
+            key = self._key(node)
+            if length and (address ^ key) >> (width - length):
+                break
+            if self.values[node]:
+                best = (key, length, self.values[node])
+            if length == width:
+                break
+            node = self._child(node, (address >> (width - 1 - length)) & 1)
+        return best
+
+    def to_bytes(self) -> bytes:
+        """Плоское представление: заголовок и массивы, выровненные на 8 байт"""
+        count = len(self.lengths)
+        parts = [TRIE_HEADER.pack(self.width, count)]
+        offset = TRIE_HEADER.size
+        for chunk in (self.lengths.tobytes(), self.left.tobytes(), self.right.tobytes(),
+                      self.values.tobytes(), self.keys.tobytes()):
+            padding = _align(offset) - offset
+            parts.append(b'\0' * padding + chunk)
+            offset += padding + len(chunk)
+        return b''.join(parts)
+
+    @classmethod
+    def from_buffer(cls, buffer, offset: int = 0) -> Tuple['PrefixTrie', int]:
+        """Дерево поверх буфера без копирования; возвращает (дерево, конец)"""
+        view = memoryview(buffer)
+        width, count = TRIE_HEADER.unpack_from(view, offset)
+        trie = cls.__new__(cls)
+        trie.width = width
+        trie.words = 1 if width <= 64 else 2
+        offset += TRIE_HEADER.size
+
+        fields = []
+        for fmt, size in (('B', 1), ('i', 4), ('i', 4), ('Q', 8), ('Q', 8 * trie.words)):
+            offset = _align(offset)
+            end = offset + count * size
+            fields.append(view[offset:end].cast(fmt))
+            offset = end
+        trie.lengths, trie.left, trie.right, trie.values, trie.keys = fields
+        return trie, offset
+
+
+class IPPrefixIndex:
+    """Индекс подсетей IPv4/IPv6 из ipset-файлов
+
+    Как и DomainSuffixIndex, каждый список получает бит; поиск возвращает
+    маску списков, содержащих адрес, за один проход по дереву.
+    Индекс, загруженный через from_bytes, доступен только для чтения.
+    """
+
+    def __init__(self):
+        self._bits: Dict[str, int] = {}
+        self.v4 = PrefixTrie(32)
+        self.v6 = PrefixTrie(128)
+        self.prefixes = 0
+
+    def add_list(self, name: str, networks: Iterable[str]) -> int:
+        """Добавление списка подсетей; возвращает его бит"""
+        bit = self._bits.get(name)
+        if bit is None:
+            bit = 1 << len(self._bits)
+            self._bits[name] = bit
+
+        for network in networks:
+            try:
+                width, key, length = parse_network(network)
+            except ValueError:
+                continue
+            trie = self.v4 if width == 32 else self.v6
+            trie.insert(key, length, bit)
+            self.prefixes += 1
+        return bit
+
+    def add_file(self, path: str, name: Optional[str] = None) -> int:
+        name = name or path
+        if name in self._bits:
+            return self._bits[name]
+        return self.add_list(name, read_ipset(path))
+
+    def bit(self, name: str) -> int:
+        return self._bits.get(name, 0)
+
+    @property
+    def lists(self) -> List[str]:
+        return list(self._bits)
+
+    def _resolve(self, address: Address) -> Tuple[PrefixTrie, int]:
+        # Целое число меньше 2^32 считается адресом IPv4
+        if isinstance(address, str):
+            if ':' in address:
+                return self.v6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address), 'big')
+            return self.v4, int.from_bytes(socket.inet_aton(address), 'big')
+        if isinstance(address, int):
+            return (self.v4 if address < 1 << 32 else self.v6), address
+        # Упакованный адрес (4 или 16 байт), например из SO_ORIGINAL_DST
+        return (self.v4 if len(address) == 4 else self.v6), int.from_bytes(address, 'big')
+
+    def lookup(self, address: Address) -> int:
+        """Маска всех списков с подсетью, содержащей адрес"""
+        trie, value = self._resolve(address)
+        return trie.lookup(value)
+
+    def matches(self, address: Address, include: int, exclude: int = 0) -> bool:
+        """Адрес входит в include и не входит в exclude (исключения важнее)"""
+        mask = self.lookup(address)
+        return bool(mask & include) and not mask & exclude
+
+    def longest_prefix(self, address: Address) -> Optional[Tuple[str, int]]:
+        """Самая точная подсеть с адресом: ('10.0.0.0/8', маска) или None"""
+        trie, value = self._resolve(address)
+        found = trie.longest_prefix(value)
+        if found is None:
+            return None
+        key, length, mask = found
+        network_class = ipaddress.IPv4Network if trie.width == 32 else ipaddress.IPv6Network
+        return str(network_class((key, length))), mask
+
+    def to_bytes(self) -> bytes:
+        names = '\n'.join(self._bits).encode('utf-8')
+        header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.prefixes, len(names)) + names
+        header += b'\0' * (_align(len(header)) - len(header))
+        v4 = self.v4.to_bytes()
+        v4 += b'\0' * (_align(len(v4)) - len(v4))
+        return header + v4 + self.v6.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, buffer, offset: int = 0) -> 'IPPrefixIndex':
+        """Загрузка без разбора текста: массивы дерева ссылаются на buffer"""
+        magic, version, prefixes, names_size = INDEX_HEADER.unpack_from(buffer, offset)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Неверный формат индекса подсетей")
+        offset += INDEX_HEADER.size
+        names = bytes(buffer[offset:offset + names_size]).decode('utf-8')
+        offset = _align(offset + names_size)
+
+        index = cls.__new__(cls)
+        index._bits = {name: 1 << number
+                       for number, name in enumerate(names.split('\n') if names else [])}
+        index.v4, offset = PrefixTrie.from_buffer(buffer, offset)
+        index.v6, offset = PrefixTrie.from_buffer(buffer, _align(offset))
+        index.prefixes = prefixes
+        return index
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'lists': len(self._bits), 'prefixes': self.prefixes,
+                'nodes_v4': len(self.v4), 'nodes_v6': len(self.v6)}
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from typing import Dict, Any, List
+
+from domain_index import DomainSuffixIndex, CompiledDomainIndex
+from ip_index import IPPrefixIndex
+
+SNAPSHOT_NAME = 'compiled.bin'
+
+# Заголовок снимка: сигнатура, версия, длина описания источников,
+# смещение и длина индекса доменов, смещение и длина индекса подсетей
+SNAPSHOT_HEADER = struct.Struct('=4sIIQQQQ')
+SNAPSHOT_MAGIC = b'ZLST'
+SNAPSHOT_VERSION = 1
+
+
+def _align(offset: int, size: int = 8) -> int:
+    return (offset + size - 1) // size * size
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_sources(base_dir: str, lists_dir: str = 'lists') -> List[str]:
+    """Текстовые списки для снимка: пути относительно base_dir, как в фильтрах"""
+    try:
+        files = sorted(name for name in os.listdir(os.path.join(base_dir, lists_dir))
+                       if name.endswith('.txt'))
+    except OSError:
+        return []
+    return [os.path.join(lists_dir, name) for name in files]
+
+
+def describe_source(base_dir: str, name: str) -> Dict[str, Any]:
+    """Отпечаток источника: mtime и размер для быстрой проверки, хэш - для точной"""
+    path = os.path.join(base_dir, name)
+    stat = os.stat(path)
+    return {'name': name, 'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size, 'hash': _file_hash(path)}
+
+
+def _write_snapshot(path: str, sources: List[Dict[str, Any]],
+                    domain_bytes: bytes, ip_bytes: bytes):
+    """Запись снимка во временный файл и атомарная подмена path"""
+    sources = json.dumps(sources).encode('utf-8')
+    domain_offset = _align(SNAPSHOT_HEADER.size + len(sources))
+    ip_offset = _align(domain_offset + len(domain_bytes))
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(sources),
+                                  domain_offset, len(domain_bytes),
+                                  ip_offset, len(ip_bytes))
+
+    # Своё имя временного файла у каждой сборки: параллельные сборки
+    # (обновление списков и ListWatcher) не пишут в один файл
+    fd, temp_path = tempfile.mkstemp(prefix=SNAPSHOT_NAME + '.', suffix='.tmp',
+                                     dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header + sources)
+            f.write(b'\0' * (domain_offset - f.tell()))
+            f.write(domain_bytes)
+            f.write(b'\0' * (ip_offset - f.tell()))
+            f.write(ip_bytes)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def build_snapshot(base_dir: str, lists_dir: str = 'lists') -> str:
+    """Компиляция списков в lists/compiled.bin; возвращает путь к снимку
+
+    Файлы ipset-*.txt попадают в индекс подсетей, остальные - в индекс
+    доменов. Имена списков в индексах совпадают с путями в --hostlist/--ipset.
+    Снимок записывается во временный файл и подменяется атомарно, поэтому
+    процессы, уже открывшие старый снимок, продолжают работать с ним.
+    Отпечаток файла снимается до его чтения в индекс: правка во время
+    сборки оставит снимок устаревшим, и следующее открытие его пересоберёт.
+    """
+    names = list_sources(base_dir, lists_dir)
+    domains = DomainSuffixIndex()
+    ips = IPPrefixIndex()
+    sources = []
+    for name in names:
+        path = os.path.join(base_dir, name)
+        sources.append(describe_source(base_dir, name))
+        if os.path.basename(name).startswith('ipset'):
+            ips.add_file(path, name)
+        else:
+            domains.add_file(path, name)
+
+    path = os.path.join(base_dir, lists_dir, SNAPSHOT_NAME)
+    _write_snapshot(path, sources, domains.to_bytes(), ips.to_bytes())
+    return path
+
+
+class ListSnapshot:
+    """Скомпилированные списки, отображённые в память только для чтения
+
+    Индексы доменов и подсетей читаются прямо из mmap без десериализации,
+    а страницы файла делятся между всеми процессами-воркерами прокси.
+    """
+
+    def __init__(self, path: str, base_dir: str):
+        self.path = path
+        self.base_dir = base_dir
+        # Время сборки в open(); 0 - снимок был актуален
+        self.build_time = 0.0
+        # Источники, у которых после сборки изменился только mtime (touch)
+        self._touched = {}
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (magic, version, sources_size, domain_offset, domain_size,
+             ip_offset, ip_size) = SNAPSHOT_HEADER.unpack_from(self._mmap, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError("Неверный формат снимка списков")
+            self._domain_span = (domain_offset, domain_offset + domain_size)
+            self._ip_span = (ip_offset, ip_offset + ip_size)
+            sources = self._mmap[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + sources_size]
+            self.sources = json.loads(sources.decode('utf-8'))
+            self.domains = CompiledDomainIndex(self._mmap, domain_offset)
+            self.ips = IPPrefixIndex.from_bytes(self._mmap, ip_offset)
+        except (struct.error, ValueError):
+            self._mmap.close()
+            raise ValueError(f"Повреждённый снимок списков: {path}")
+
+    @classmethod
+    def open(cls, base_dir: str, lists_dir: str = 'lists') -> 'ListSnapshot':
+        """Открытие снимка; при отсутствии или устаревании он пересобирается"""
+        path = os.path.join(base_dir, lists_dir, SNAPSHOT_NAME)
+        try:
+            snapshot = cls(path, base_dir)
+        except (OSError, ValueError):
+            snapshot = None
+
+        if snapshot is not None and not snapshot.is_stale(lists_dir):
+            if snapshot._touched:
+                snapshot.refresh_sources()
+            return snapshot
+        if snapshot is not None:
+            snapshot.close()
+
+        started = time.perf_counter()
+        build_snapshot(base_dir, lists_dir)
+        snapshot = cls(path, base_dir)
+        snapshot.build_time = time.perf_counter() - started
+        return snapshot
+
+    def is_stale(self, lists_dir: str = 'lists') -> bool:
+        """Изменился ли набор списков или их содержимое с момента сборки"""
+        names = list_sources(self.base_dir, lists_dir)
+        if names != [source['name'] for source in self.sources]:
+            return True
+
+        self._touched = {}
+        for source in self.sources:
+            path = os.path.join(self.base_dir, source['name'])
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime_ns == source['mtime_ns'] and stat.st_size == source['size']:
+                    continue
+                # mtime изменился - сравниваем содержимое (touch без правок не в счёт)
+                if stat.st_size != source['size'] or _file_hash(path) != source['hash']:
+                    return True
+                self._touched[source['name']] = stat.st_mtime_ns
+            except OSError:
+                return True
+        return False
+
+    def refresh_sources(self):
+        """Запись новых mtime источников, изменённых только touch
+
+        Индексы копируются из текущего снимка без пересборки; иначе каждое
+        следующее открытие заново хэшировало бы эти файлы.
+        """
+        sources = [dict(source, mtime_ns=self._touched.get(source['name'],
+                                                             source['mtime_ns']))
+                   for source in self.sources]
+        _write_snapshot(self.path, sources,
+                        self._mmap[self._domain_span[0]:self._domain_span[1]],
+                        self._mmap[self._ip_span[0]:self._ip_span[1]])
+        # Индексы в новом файле те же, текущий mmap остаётся рабочим
+        self.sources = sources
+        self._touched = {}
+
+    def close(self):
+        # Индексы ссылаются на mmap, без них его можно закрыть
+        self.domains = self.ips = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self._mmap),
+            'domains': len(self.domains),
+            'prefixes': self.ips.prefixes,
+            'lists': len(self.sources),
+            'build_time': self.build_time,
+        }
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Период опроса каталога списков, секунды
+WATCH_INTERVAL = 1.0
+
+
+class ListWatcher:
+    """Слежение за файлами списков по mtime и размеру
+
+    inotify на Android доступен не везде, поэтому каталог опрашивается:
+    один stat на файл раз в interval секунд. При изменении, появлении или
+    удалении подходящих файлов вызывается callback(список изменённых путей).
+    """
+
+    def __init__(self, directory: str, callback: Callable[[List[str]], None],
+                 interval: float = WATCH_INTERVAL, pattern: str = '*.txt'):
+        self.directory = directory
+        self.callback = callback
+        self.interval = interval
+        self.pattern = pattern
+        self.changes = 0
+        self._state = self._scan()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        state = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return state
+        for name in fnmatch.filter(names, self.pattern):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def check(self) -> List[str]:
+        """Один опрос: изменённые пути (callback вызывается, если они есть)"""
+        state = self._scan()
+        changed = sorted(path for path in state.keys() | self._state.keys()
+                         if state.get(path) != self._state.get(path))
+        self._state = state
+        if changed:
+            self.changes += 1
+            try:
+                self.callback(changed)
+            except Exception as e:
+                print(f"Ошибка перезагрузки списков: {e}")
+        return changed
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self) -> 'ListWatcher':
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
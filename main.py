@@ -334,6 +334,7 @@ class MainScreen(BoxLayout):
         
         # Привязка описания
         self.strategy_spinner.bind(text=self.update_strategy_desc)
+        self.strategy_spinner.bind(text=self.switch_strategy)
         
         # Тестирование стратегий
         test_box = BoxLayout(size_hint_y=0.15, spacing=10)
@@ -661,6 +662,22 @@ class MainScreen(BoxLayout):
         }
         self.strategy_desc.text = descriptions.get(text, 'Описание стратегии')
     
+    def switch_strategy(self, spinner, text):
+        """Смена стратегии на ходу, без остановки обхода"""
+        if not self.is_running:
+            return
+        
+        thread = threading.Thread(target=self._switch_strategy_thread, args=(text,))
+        thread.daemon = True
+        thread.start()
+    
+    def _switch_strategy_thread(self, strategy):
+        """Поток смены стратегии"""
+        if self.core.switch_strategy(strategy):
+            self.log(f"Стратегия изменена: {strategy}")
+        else:
+            self.log("Ошибка смены стратегии")
+    
     def update_lists(self, instance):
         """Обновление списков доменов и IP"""
         self.log("Обновление списков...")
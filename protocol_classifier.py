@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from enum import Enum
+from typing import Optional, Tuple, NamedTuple
+
+# Методы, с которых начинается обычный HTTP-запрос
+HTTP_METHODS = (b'GET ', b'POST ', b'HEAD ', b'PUT ', b'DELETE ', b'OPTIONS ', b'PATCH ')
+
+# Больше этого первый полёт не накапливается: классификация завершается
+# с тем, что удалось разобрать (ClientHello укладывается в одну TLS-запись)
+MAX_FLIGHT_SIZE = 16384 + 5
+
+TLS_CONTENT_HANDSHAKE = 0x16
+TLS_HANDSHAKE_CLIENT_HELLO = 0x01
+TLS_EXTENSION_SERVER_NAME = 0x0000
+
+STUN_MAGIC_COOKIE = b'\x21\x12\xa4\x42'
+# Discord voice: запрос IP discovery (тип 1, длина 70) и RTP с типом 120
+DISCORD_IP_DISCOVERY = b'\x00\x01\x00\x46'
+DISCORD_IP_DISCOVERY_SIZE = 74
+DISCORD_RTP_PAYLOAD_TYPE = 0x78
+
+
+class Protocol(Enum):
+    """Протокол первого полёта соединения"""
+    UNKNOWN = "unknown"
+    TLS = "tls"
+    QUIC = "quic"
+    HTTP = "http"
+    STUN = "stun"
+    DISCORD = "discord"
+
+
+class FlightInfo(NamedTuple):
+    """Результат разбора первого полёта
+
+    host_span - смещения строки заголовка Host от начала потока
+    (начало 'Host:' и конец перед \\r\\n).
+    complete=False - данных пока не хватает, ждём следующую порцию.
+    """
+    protocol: Protocol = Protocol.UNKNOWN
+    complete: bool = False
+    sni: Optional[str] = None
+    host: Optional[str] = None
+    host_span: Optional[Tuple[int, int]] = None
+    quic_version: Optional[int] = None
+
+
+def _be16(data, pos: int) -> int:
+    return data[pos] << 8 | data[pos + 1]
+
+
+def _parse_sni(hello) -> Optional[str]:
+    """SNI из тела ClientHello (без заголовка handshake)"""
+    try:
+        # version(2) + random(32), затем session_id, cipher_suites, compression
+        pos = 34
+        pos += 1 + hello[pos]
+        pos += 2 + _be16(hello, pos)
+        pos += 1 + hello[pos]
+
+        end = min(len(hello), pos + 2 + _be16(hello, pos))
+        pos += 2
+        while pos + 4 <= end:
+            ext_type = _be16(hello, pos)
+            ext_len = _be16(hello, pos + 2)
+            pos += 4
+            if ext_type == TLS_EXTENSION_SERVER_NAME:
+                # server_name_list(2), name_type(1) = host_name, длина(2), имя
+                if hello[pos + 2] != 0:
+                    return None
+                name_len = _be16(hello, pos + 3)
+                name = bytes(hello[pos + 5:pos + 5 + name_len])
+                return name.decode('ascii', 'replace').lower()
+            pos += ext_len
+    except IndexError:
+        pass
+    return None
+
+
+def _classify_tls(view) -> FlightInfo:
+    """TLS: записи handshake, ClientHello может быть разбит на несколько записей"""
+    size = len(view)
+    if size >= 2 and view[1] != 0x03:
+        return FlightInfo(Protocol.UNKNOWN, True)
+
+    fragments = []
+    pos = 0
+    while pos + 5 <= size and view[pos] == TLS_CONTENT_HANDSHAKE:
+        start = pos + 5
+        pos = start + _be16(view, pos + 3)
+        fragments.append((start, min(pos, size)))
+
+    if len(fragments) == 1:
+        # Обычный случай: разбор прямо в буфере, без копирования
+        start, end = fragments[0]
+        handshake = view[start:end]
+    else:
+        handshake = memoryview(b''.join(view[start:end] for start, end in fragments))
+
+    if len(handshake) < 4:
+        return FlightInfo(Protocol.TLS)
+    if handshake[0] != TLS_HANDSHAKE_CLIENT_HELLO:
+        return FlightInfo(Protocol.TLS, True)
+
+    needed = 4 + (handshake[1] << 16 | _be16(handshake, 2))
+    if len(handshake) < needed:
+        return FlightInfo(Protocol.TLS)
+
+    return FlightInfo(Protocol.TLS, True, sni=_parse_sni(handshake[4:needed]))
+
+
+def _classify_http(data) -> FlightInfo:
+    """HTTP: поиск заголовка Host только в пределах заголовков запроса"""
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    headers_end = data.find(b'\r\n\r\n')
+    limit = headers_end if headers_end >= 0 else len(data)
+
+    for marker in (b'\r\nHost:', b'\r\nhost:', b'\r\nHOST:'):
+        start = data.find(marker, 0, limit)
+        if start >= 0:
+            break
+    else:
+        return FlightInfo(Protocol.HTTP, headers_end >= 0)
+
+    start += 2
+    end = data.find(b'\r\n', start)
+    if end < 0:
+        return FlightInfo(Protocol.HTTP)
+
+    host = bytes(data[start + 5:end]).decode('ascii', 'replace').strip().lower()
+    if host.startswith('['):
+        host = host[1:host.find(']')]
+    else:
+        host = host.split(':', 1)[0]
+    return FlightInfo(Protocol.HTTP, True, host=host, host_span=(start, end))
+
+
+def classify_flight(data) -> FlightInfo:
+    """Разовая классификация данных, начинающихся с начала потока"""
+    if not data:
+        return FlightInfo()
+
+    first = data[0]
+    if first == TLS_CONTENT_HANDSHAKE:
+        return _classify_tls(memoryview(data))
+
+    # QUIC: длинный заголовок, пакет Initial
+    if first & 0x80 and (first & 0x30) == 0x00:
+        if len(data) < 5:
+            return FlightInfo(Protocol.QUIC)
+        version = int.from_bytes(bytes(data[1:5]), 'big')
+        return FlightInfo(Protocol.QUIC, True, quic_version=version)
+
+    head = bytes(data[:8])
+    if head.startswith(HTTP_METHODS):
+        return _classify_http(data)
+    if len(head) < 8 and any(method.startswith(head) for method in HTTP_METHODS):
+        # Начало метода пришло отдельной порцией
+        return FlightInfo()
+
+    return FlightInfo(Protocol.UNKNOWN, True)
+
+
+def classify_datagram(data) -> Protocol:
+    """Протокол UDP-датаграммы (первой в потоке) для --filter-l7"""
+    if len(data) < 5:
+        return Protocol.UNKNOWN
+
+    first = data[0]
+    if (first & 0xF0) == 0xC0 and bytes(data[1:5]) != b'\0\0\0\0':
+        return Protocol.QUIC
+    if len(data) >= 20 and bytes(data[4:8]) == STUN_MAGIC_COOKIE and not first & 0xC0:
+        return Protocol.STUN
+    if len(data) == DISCORD_IP_DISCOVERY_SIZE and bytes(data[:4]) == DISCORD_IP_DISCOVERY:
+        return Protocol.DISCORD
+    if first >> 6 == 2 and (data[1] & 0x7F) == DISCORD_RTP_PAYLOAD_TYPE:
+        return Protocol.DISCORD
+    return Protocol.UNKNOWN
+
+
+class FirstFlightClassifier:
+    """Потоковый классификатор первого полёта одного соединения
+
+    Порции разбираются на месте; копия накапливается, только если
+    ClientHello или заголовки HTTP пришли не целиком. После завершения
+    результат кэшируется и последующие порции не просматриваются.
+    """
+
+    def __init__(self, max_size: int = MAX_FLIGHT_SIZE):
+        self.max_size = max_size
+        self.info = FlightInfo()
+        self._buffer = None
+
+    @property
+    def done(self) -> bool:
+        return self.info.complete
+
+    def feed(self, data) -> FlightInfo:
+        """Очередная порция данных клиента; возвращает текущий результат"""
+        if self.info.complete:
+            return self.info
+
+        if self._buffer is None:
+            info = classify_flight(data)
+        else:
+            self._buffer += data
+            info = classify_flight(self._buffer)
+
+        if not info.complete:
+            if self._buffer is None:
+                self._buffer = bytearray(data)
+            if len(self._buffer) >= self.max_size:
+                info = info._replace(complete=True)
+
+        if info.complete:
+            self._buffer = None
+        self.info = info
+        return info
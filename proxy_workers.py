@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from dpi_bypass import DPIBypass, DPIStrategy, ProxyMode
+
+# Период отправки статистики воркером и проверки воркеров супервизором
+WORKER_STATS_INTERVAL = 0.5
+WORKER_CHECK_INTERVAL = 0.5
+
+# Перезапуск упавших воркеров: падение раньше WORKER_FAST_FAILURE секунд
+# после запуска удваивает задержку (от WORKER_RESTART_DELAY до
+# WORKER_RESTART_MAX_DELAY), после WORKER_MAX_FAST_FAILURES таких падений
+# подряд воркер больше не запускается
+WORKER_FAST_FAILURE = 5.0
+WORKER_RESTART_DELAY = 0.5
+WORKER_RESTART_MAX_DELAY = 30.0
+WORKER_MAX_FAST_FAILURES = 5
+
+# Накопительные счётчики воркера (сохраняются при его перезапуске)
+# и мгновенные значения (учитываются только у живых воркеров)
+WORKER_COUNTERS = ('connections', 'desynced', 'accepted', 'queued', 'rejected')
+WORKER_GAUGES = ('active', 'waiting')
+
+
+def _worker_main(index: int, listen_port: int, target_host: Optional[str],
+                 target_port: Optional[int], strategy: DPIStrategy, mode: ProxyMode,
+                 options: Dict[str, Any], stats_queue, stats_interval: float,
+                 control_queue=None):
+    """Процесс-воркер: свой прокси на общем порту, статистика - в очередь
+
+    Из control_queue приходят команды супервизора: ('rules', [FilterRule])
+    подменяет правила диспетчера, не трогая слушающий сокет.
+    """
+    dispatcher = options.get('dispatcher')
+    if dispatcher is not None:
+        # Каждый воркер сам подхватывает пересобранные списки
+        dispatcher.watch()
+
+    bypass = DPIBypass()
+    proxy = bypass.create_proxy_server(listen_port, target_host, target_port, strategy,
+                                       mode=mode, reuse_port=True, **options)
+    thread = threading.Thread(target=proxy.start,
+                              args=(listen_port, target_host, target_port), daemon=True)
+    thread.start()
+
+    while thread.is_alive():
+        if proxy.ready.is_set():
+            stats_queue.put((index, os.getpid(), proxy.get_stats()))
+        if control_queue is None:
+            thread.join(stats_interval)
+            continue
+        try:
+            command, payload = control_queue.get(timeout=stats_interval)
+        except queue.Empty:
+            continue
+        if command == 'rules' and dispatcher is not None:
+            dispatcher.replace_rules(payload)
+
+
+class ProxyWorkerSupervisor:
+    """Несколько процессов прокси на одном порту (SO_REUSEPORT)
+
+    Ядро распределяет входящие соединения между воркерами, поэтому работа
+    стратегий не упирается в GIL одного процесса. Супервизор перезапускает
+    упавшие воркеры и суммирует их статистику. Воркер, который падает сразу
+    после запуска (порт занят, ошибка в параметрах), перезапускается с
+    растущей задержкой, а после max_fast_failures падений подряд - бросается.
+    """
+
+    def __init__(self, listen_port: int, target_host: Optional[str],
+                 target_port: Optional[int], strategy: DPIStrategy,
+                 workers: Optional[int] = None, mode: ProxyMode = ProxyMode.THREAD,
+                 stats_interval: float = WORKER_STATS_INTERVAL,
+                 check_interval: float = WORKER_CHECK_INTERVAL,
+                 restart_delay: float = WORKER_RESTART_DELAY,
+                 max_fast_failures: int = WORKER_MAX_FAST_FAILURES, **options):
+        self.listen_port = listen_port
+        self.target_host = target_host
+        self.target_port = target_port
+        self.strategy = strategy
+        self.workers = workers or os.cpu_count() or 1
+        self.mode = ProxyMode(mode)
+        self.stats_interval = stats_interval
+        self.check_interval = check_interval
+        self.restart_delay = restart_delay
+        self.max_fast_failures = max_fast_failures
+        # Параметры конструктора прокси; передаются в дочерние процессы
+        self.options = options
+        self.running = False
+        self.restarts = 0
+        self.abandoned = 0
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self._stats_queue = self._ctx.Queue()
+        self._processes = [None] * self.workers
+        self._controls = [None] * self.workers
+        self._started = [0.0] * self.workers
+        self._failures = [0] * self.workers
+        self._respawn_at = [None] * self.workers
+        self._reports = {}
+        self._retired = dict.fromkeys(WORKER_COUNTERS, 0)
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._monitor = None
+        self._reserved = None
+
+    def start(self) -> int:
+        """Запуск воркеров; возвращает порт, который они слушают"""
+        # Порт занимается заранее, чтобы все воркеры получили один и тот же
+        self._reserved = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._reserved.bind(('127.0.0.1', self.listen_port))
+        self.listen_port = self._reserved.getsockname()[1]
+
+        self.running = True
+        for index in range(self.workers):
+            self._spawn(index)
+
+        self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+        self._monitor.start()
+
+        print(f"DPI Proxy: {self.workers} воркеров на порту {self.listen_port}")
+        return self.listen_port
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Ожидание, пока каждый воркер начнёт принимать соединения
+
+        False - истёк timeout или упавший воркер больше не перезапускается.
+        """
+        return self._ready.wait(timeout) and not self.abandoned
+
+    def _spawn(self, index: int):
+        control_queue = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self.listen_port, self.target_host, self.target_port,
+                  self.strategy, self.mode, self.options, self._stats_queue,
+                  self.stats_interval, control_queue),
+            daemon=True
+        )
+        process.start()
+        self._started[index] = time.monotonic()
+        self._processes[index] = process
+        self._controls[index] = control_queue
+
+    def replace_rules(self, rules) -> bool:
+        """Новые правила диспетчера во всех воркерах без их перезапуска
+
+        Правила применяются и к диспетчеру в options, поэтому воркеры,
+        перезапущенные позже, стартуют уже с ними.
+        """
+        dispatcher = self.options.get('dispatcher')
+        if dispatcher is None:
+            return False
+        dispatcher.replace_rules(rules)
+        for control_queue in list(self._controls):
+            if control_queue is not None:
+                control_queue.put(('rules', list(rules)))
+        return True
+
+    def _monitor_loop(self):
+        while self.running:
+            deadline = time.monotonic() + self.check_interval
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    index, pid, stats = self._stats_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                self._record(index, pid, stats)
+
+            for index, process in enumerate(self._processes):
+                if not self.running:
+                    break
+                if process is not None and not process.is_alive():
+                    self._retire(index)
+                respawn_at = self._respawn_at[index]
+                if respawn_at is not None and time.monotonic() >= respawn_at:
+                    self._respawn_at[index] = None
+                    self._spawn(index)
+
+    def _record(self, index: int, pid: int, stats: Dict[str, Any]):
+        with self._lock:
+            # Запоздавший отчёт уже перезапущенного воркера не учитываем
+            process = self._processes[index]
+            if process is None or process.pid != pid:
+                return
+            self._reports[index] = stats
+            if len(self._reports) == self.workers:
+                self._ready.set()
+
+    def _retire(self, index: int):
+        """Учёт упавшего воркера: его счётчики сохраняются, перезапуск
+        планируется с задержкой или не планируется вовсе"""
+        self._processes[index].join()
+        lived = time.monotonic() - self._started[index]
+        with self._lock:
+            stats = self._reports.pop(index, None)
+            if stats:
+                for key in WORKER_COUNTERS:
+                    self._retired[key] += stats.get(key, 0)
+            self._processes[index] = None
+            self._controls[index] = None
+
+        if lived < WORKER_FAST_FAILURE:
+            self._failures[index] += 1
+        else:
+            self._failures[index] = 0
+        failures = self._failures[index]
+
+        if failures >= self.max_fast_failures:
+            with self._lock:
+                self.abandoned += 1
+            print(f"Воркер прокси {index} падает сразу после запуска, "
+                  f"перезапуски прекращены")
+            # wait_ready() не должен ждать воркер, который уже не запустится
+            self._ready.set()
+            return
+
+        delay = 0.0
+        if failures:
+            delay = min(self.restart_delay * 2 ** (failures - 1), WORKER_RESTART_MAX_DELAY)
+        with self._lock:
+            self.restarts += 1
+        print(f"Воркер прокси {index} завершился, перезапуск через {delay:.1f} с")
+        self._respawn_at[index] = time.monotonic() + delay
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Суммарная статистика всех воркеров"""
+        with self._lock:
+            reports = dict(self._reports)
+            stats = dict(self._retired)
+            stats['restarts'] = self.restarts
+            stats['abandoned'] = self.abandoned
+
+        for key in WORKER_GAUGES:
+            stats[key] = 0
+        for report in reports.values():
+            for key in WORKER_COUNTERS + WORKER_GAUGES:
+                stats[key] += report.get(key, 0)
+
+        stats['workers'] = self.workers
+        stats['alive'] = sum(1 for process in self._processes
+                             if process is not None and process.is_alive())
+        stats['per_worker'] = [reports.get(index) for index in range(self.workers)]
+        return stats
+
+    def stop(self):
+        self.running = False
+        if self._monitor:
+            self._monitor.join()
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join(5)
+        if self._reserved:
+            self._reserved.close()
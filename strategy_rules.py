@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shlex
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple, NamedTuple, FrozenSet
+
+from dpi_bypass import DPIStrategy
+from domain_index import DomainSuffixIndex
+from ip_index import IPPrefixIndex
+from list_snapshot import ListSnapshot
+from list_watcher import ListWatcher, WATCH_INTERVAL
+
+# Режимы --dpi-desync zapret и соответствующие стратегии движка
+DESYNC_MODES = {
+    'fake': DPIStrategy.FAKE_TLS,
+    'split': DPIStrategy.MULTISPLIT,
+    'split2': DPIStrategy.MULTISPLIT,
+    'multisplit': DPIStrategy.MULTISPLIT,
+    'disorder': DPIStrategy.MULTIDISORDER,
+    'disorder2': DPIStrategy.MULTIDISORDER,
+    'multidisorder': DPIStrategy.MULTIDISORDER,
+    'hostfakesplit': DPIStrategy.HOST_FAKE_SPLIT,
+    'fakedsplit': DPIStrategy.FAKE_DSPLIT,
+    'syndata': DPIStrategy.SYNDATA,
+}
+
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_UDP = 'udp'
+
+# Общие исключения: хосты и адреса из них не обрабатываются ни одним правилом
+DEFAULT_EXCLUDE_LISTS = ('lists/list-exclude.txt',)
+DEFAULT_IPSET_EXCLUDE_LISTS = ('lists/ipset-exclude.txt',)
+
+
+def parse_ports(spec: str) -> Tuple[Tuple[int, int], ...]:
+    """Разбор списка портов zapret: 80,443,50000-50100"""
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        low, _, high = part.partition('-')
+        try:
+            ranges.append((int(low), int(high or low)))
+        except ValueError:
+            raise ValueError(f"Некорректный список портов: {spec!r}")
+    return tuple(ranges)
+
+
+class FilterRule(NamedTuple):
+    """Одна строка фильтра zapret (--filter-tcp=... --dpi-desync=...)"""
+    transport: str
+    ports: Tuple[Tuple[int, int], ...]
+    strategy: DPIStrategy
+    params: Dict[str, Any]
+    hostlists: Tuple[str, ...] = ()
+    domains: FrozenSet[str] = frozenset()
+    l7: Tuple[str, ...] = ()
+    excludes: Tuple[str, ...] = ()
+    ipsets: Tuple[str, ...] = ()
+    ipset_excludes: Tuple[str, ...] = ()
+
+    @property
+    def any_host(self) -> bool:
+        """Правило без hostlist применяется ко всем хостам"""
+        return not self.hostlists and not self.domains
+
+    def matches_port(self, port: int) -> bool:
+        return any(low <= port <= high for low, high in self.ports)
+
+
+def parse_filter(line: str) -> FilterRule:
+    """Разбор строки параметров стратегии из get_strategy_params
+
+    Движок применяет к соединению одну стратегию, поэтому из комбинации
+    режимов (fake,multidisorder) берётся последний. 'fake' для UDP
+    означает фейковый QUIC.
+    """
+    options = {}
+    for token in shlex.split(line):
+        if not token.startswith('--'):
+            continue
+        name, _, value = token[2:].partition('=')
+        options[name] = value
+
+    if 'filter-udp' in options:
+        transport, ports = TRANSPORT_UDP, options['filter-udp']
+    elif 'filter-tcp' in options:
+        transport, ports = TRANSPORT_TCP, options['filter-tcp']
+    else:
+        raise ValueError(f"В фильтре нет --filter-tcp/--filter-udp: {line!r}")
+
+    modes = [mode for mode in options.get('dpi-desync', '').split(',') if mode]
+    if not modes or modes[-1] not in DESYNC_MODES:
+        raise ValueError(f"Неизвестный режим --dpi-desync: {line!r}")
+    strategy = DESYNC_MODES[modes[-1]]
+    if transport == TRANSPORT_UDP and strategy == DPIStrategy.FAKE_TLS:
+        strategy = DPIStrategy.FAKE_QUIC
+
+    params = {}
+    if 'dpi-desync-repeats' in options:
+        params['repeats'] = int(options['dpi-desync-repeats'])
+    # Техники обмана фейков и их TTL применяет пакетный движок (packet_engine)
+    if options.get('dpi-desync-fooling'):
+        params['fooling'] = tuple(name for name in options['dpi-desync-fooling'].split(',')
+                                  if name)
+    if 'dpi-desync-ttl' in options:
+        params['ttl'] = int(options['dpi-desync-ttl'])
+
+    hostlists = tuple(value for value in (options.get('hostlist'),) if value)
+    excludes = tuple(value for value in (options.get('hostlist-exclude'),) if value)
+    ipsets = tuple(value for value in (options.get('ipset'),) if value)
+    ipset_excludes = tuple(value for value in (options.get('ipset-exclude'),) if value)
+    domains = frozenset(
+        domain.strip().lower()
+        for domain in options.get('hostlist-domains', '').split(',') if domain.strip()
+    )
+    l7 = tuple(name for name in options.get('filter-l7', '').split(',') if name)
+
+    return FilterRule(transport, parse_ports(ports), strategy, params,
+                      hostlists, domains, l7, excludes, ipsets, ipset_excludes)
+
+
+def parse_strategy_params(strategy_params: Dict[str, Any]) -> List[FilterRule]:
+    """Правила из результата ZapretCore.get_strategy_params"""
+    return [parse_filter(line) for line in strategy_params['params']]
+
+
+class MatchTables(NamedTuple):
+    """Неизменяемый набор правил, индексов и масок одного поколения"""
+    rules: List[FilterRule]
+    index: Any
+    local_index: DomainSuffixIndex
+    ip_index: IPPrefixIndex
+    local_ip_index: IPPrefixIndex
+    masks: List[Tuple[int, int, int, int]]
+    ip_masks: List[Tuple[int, int, int, int]]
+    snapshot: Optional[ListSnapshot] = None
+
+
+class StrategyDispatcher:
+    """Выбор стратегии для соединения по правилам фильтров zapret
+
+    Правила проверяются по порядку, как в zapret: первое совпавшее по
+    транспорту, порту, протоколу (--filter-l7) и hostlist задаёт стратегию.
+    Если не совпало ни одно, соединение идёт без обхода DPI.
+    
+    Все списки собраны в один DomainSuffixIndex: хост ищется один раз,
+    а правила сравнивают полученную маску со своими битами. Исключения
+    (--hostlist-exclude и exclude_lists) важнее включающих списков.
+    Подсети --ipset так же собраны в IPPrefixIndex и проверяются по адресу
+    назначения; правило с hostlist и ipset требует совпадения обоих.
+    С готовым снимком (ListSnapshot) файлы списков не читаются: индексы
+    берутся из mmap lists/compiled.bin. reload() и watch() подменяют индексы
+    на ходу, не прерывая уже открытые соединения.
+    """
+
+    def __init__(self, rules: List[FilterRule], base_dir: str = '.',
+                 exclude_lists: Tuple[str, ...] = DEFAULT_EXCLUDE_LISTS,
+                 ipset_exclude_lists: Tuple[str, ...] = DEFAULT_IPSET_EXCLUDE_LISTS,
+                 snapshot: Optional[ListSnapshot] = None):
+        self.base_dir = base_dir
+        self.exclude_lists = tuple(exclude_lists)
+        self.ipset_exclude_lists = tuple(ipset_exclude_lists)
+        self.stats = {'matched': 0, 'unmatched': 0, 'reloads': 0, 'switches': 0,
+                      'reload_ms': 0.0, 'reload_latency_ms': 0.0}
+        self._stats_lock = threading.Lock()
+        # reload() и replace_rules() читают текущие таблицы и собирают новые:
+        # без блокировки одна из подмен может потерять другую
+        self._build_lock = threading.Lock()
+        self._watcher = None
+        self.tables = self._build_tables(list(rules), snapshot)
+
+    def _build_tables(self, rules: List[FilterRule],
+                      snapshot: Optional[ListSnapshot]) -> MatchTables:
+        """Правила, индексы и маски; готовый набор подменяется одной ссылкой"""
+        # Списки из снимка берутся из mmap; в локальные индексы попадают только
+        # --hostlist-domains и файлы вне снимка. Без снимка локальный индекс
+        # единственный, и каждый файл читается один раз на все правила.
+        local_index = DomainSuffixIndex()
+        local_ip_index = IPPrefixIndex()
+        if snapshot is None:
+            index, ip_index = local_index, local_ip_index
+        else:
+            index, ip_index = snapshot.domains, snapshot.ips
+
+        common_exclude = self._collect(index, local_index, self.exclude_lists)
+        masks = []
+        for number, rule in enumerate(rules):
+            include = self._collect(index, local_index, rule.hostlists)
+            if rule.domains:
+                bit = local_index.add_list(f'hostlist-domains:{number}', rule.domains)
+                include = self._merge(include, (0, bit) if snapshot else (bit, 0))
+            exclude = self._merge(common_exclude,
+                                  self._collect(index, local_index, rule.excludes))
+            masks.append(include + exclude)
+
+        common_exclude = self._collect(ip_index, local_ip_index, self.ipset_exclude_lists)
+        ip_masks = []
+        for rule in rules:
+            include = self._collect(ip_index, local_ip_index, rule.ipsets)
+            exclude = self._merge(common_exclude,
+                                  self._collect(ip_index, local_ip_index, rule.ipset_excludes))
+            ip_masks.append(include + exclude)
+
+        return MatchTables(rules, index, local_index, ip_index, local_ip_index,
+                           masks, ip_masks, snapshot)
+
+    @property
+    def rules(self) -> List[FilterRule]:
+        return self.tables.rules
+
+    @property
+    def snapshot(self) -> Optional[ListSnapshot]:
+        return self.tables.snapshot
+
+    @property
+    def index(self):
+        return self.tables.index
+
+    @property
+    def ip_index(self):
+        return self.tables.ip_index
+
+    def reload(self, snapshot: Optional[ListSnapshot] = None,
+               changed_at: Optional[float] = None):
+        """Перестроение индексов без остановки прокси
+
+        Новые таблицы собираются в стороне и подменяются одним присваиванием:
+        match() берёт ссылку на таблицы один раз, поэтому текущие проверки
+        дорабатывают со старыми, а новые соединения видят уже новые списки.
+        changed_at - время изменения файлов для учёта задержки перезагрузки.
+        """
+        with self._build_lock:
+            started = time.perf_counter()
+            self.tables = self._build_tables(self.rules, snapshot)
+            finished = time.perf_counter()
+        with self._stats_lock:
+            self.stats['reloads'] += 1
+            self.stats['reload_ms'] = (finished - started) * 1000.0
+            if changed_at is not None:
+                self.stats['reload_latency_ms'] = max(0.0, time.time() - changed_at) * 1000.0
+
+    def replace_rules(self, rules: List[FilterRule]):
+        """Смена правил (другая стратегия) без остановки прокси
+
+        Как и reload(), новые таблицы подменяются одной ссылкой: соединения,
+        уже выбравшие правило, продолжают работать с ним.
+        """
+        with self._build_lock:
+            self.tables = self._build_tables(list(rules), self.snapshot)
+        with self._stats_lock:
+            self.stats['switches'] += 1
+
+    def watch(self, interval: float = WATCH_INTERVAL) -> ListWatcher:
+        """Перезагрузка при изменении списков на диске
+
+        Со снимком отслеживается сам lists/compiled.bin (его пересобирает
+        ZapretCore), без снимка - текстовые списки в каталоге base_dir/lists.
+        """
+        snapshot = self.snapshot
+        if snapshot is not None:
+            directory, pattern = os.path.split(snapshot.path)
+        else:
+            directory, pattern = os.path.join(self.base_dir, 'lists'), '*.txt'
+        self.stop_watching()
+        self._watcher = ListWatcher(directory, self._on_lists_changed, interval, pattern)
+        return self._watcher.start()
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def _on_lists_changed(self, changed: List[str]):
+        changed_at = max((os.path.getmtime(path) for path in changed
+                          if os.path.exists(path)), default=None)
+        snapshot = self.snapshot
+        if snapshot is not None:
+            # Старый mmap освобождается сборщиком, когда его перестанут читать
+            snapshot = ListSnapshot(snapshot.path, snapshot.base_dir)
+        self.reload(snapshot, changed_at)
+
+    def _collect(self, shared, local, names) -> Tuple[int, int]:
+        """Биты файлов списков: (в общем индексе, в локальном)"""
+        shared_mask = local_mask = 0
+        for name in names:
+            if shared is not local:
+                bit = shared.bit(os.path.normpath(name))
+                if bit:
+                    shared_mask |= bit
+                    continue
+                local_mask |= local.add_file(os.path.join(self.base_dir, name), name)
+            else:
+                shared_mask |= local.add_file(os.path.join(self.base_dir, name), name)
+        return shared_mask, local_mask
+
+    @staticmethod
+    def _merge(first: Tuple[int, int], second: Tuple[int, int]) -> Tuple[int, int]:
+        return first[0] | second[0], first[1] | second[1]
+
+    def __getstate__(self):
+        # Диспетчер передаётся в процессы-воркеры, блокировки не сериализуются
+        if self.snapshot is not None:
+            # mmap не сериализуется: воркер откроет тот же снимок сам
+            return {'rules': self.rules, 'base_dir': self.base_dir,
+                    'exclude_lists': self.exclude_lists,
+                    'ipset_exclude_lists': self.ipset_exclude_lists,
+                    'snapshot_path': self.snapshot.path}
+        state = self.__dict__.copy()
+        del state['_stats_lock']
+        del state['_build_lock']
+        state['_watcher'] = None
+        return state
+
+    def __setstate__(self, state):
+        if 'snapshot_path' in state:
+            snapshot = ListSnapshot(state.pop('snapshot_path'), state['base_dir'])
+            self.__init__(snapshot=snapshot, **state)
+            return
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    @classmethod
+    def from_strategy_params(cls, strategy_params: Dict[str, Any],
+                             base_dir: str = '.',
+                             snapshot: Optional[ListSnapshot] = None) -> 'StrategyDispatcher':
+        """Правила из результата ZapretCore.get_strategy_params"""
+        return cls(parse_strategy_params(strategy_params), base_dir, snapshot=snapshot)
+
+    @staticmethod
+    def _address_mask(tables: MatchTables, address: Optional[str]) -> Tuple[int, int]:
+        if not address:
+            return 0, 0
+        try:
+            local = 0
+            if tables.local_ip_index is not tables.ip_index and tables.local_ip_index.prefixes:
+                local = tables.local_ip_index.lookup(address)
+            return tables.ip_index.lookup(address), local
+        except (OSError, ValueError):
+            # Не IP-адрес (имя хоста в режиме с фиксированной целью)
+            return 0, 0
+
+    @staticmethod
+    def _host_mask(tables: MatchTables, host: Optional[str]) -> Tuple[int, int]:
+        local = 0
+        if tables.local_index is not tables.index and len(tables.local_index):
+            local = tables.local_index.lookup(host)
+        return tables.index.lookup(host), local
+
+    @staticmethod
+    def _check(masks: Tuple[int, int], include: int, local_include: int,
+               exclude: int, local_exclude: int, required: bool) -> bool:
+        if masks[0] & exclude or masks[1] & local_exclude:
+            return False
+        # Правило со списками требует совпадения, даже если списки пусты
+        return not required or bool(masks[0] & include or masks[1] & local_include)
+
+    def match(self, port: int, host: Optional[str] = None,
+              transport: str = TRANSPORT_TCP,
+              l7: Optional[str] = None,
+              address: Optional[str] = None) -> Optional[FilterRule]:
+        """Первое правило, подходящее соединению, или None"""
+        tables = self.tables
+        host_mask = None
+        address_mask = None
+        for rule, masks, ip_masks in zip(tables.rules, tables.masks, tables.ip_masks):
+            if rule.transport != transport or not rule.matches_port(port):
+                continue
+            if rule.l7 and l7 not in rule.l7:
+                continue
+            if rule.ipsets or any(ip_masks):
+                if address_mask is None:
+                    address_mask = self._address_mask(tables, address)
+                if not self._check(address_mask, *ip_masks, bool(rule.ipsets)):
+                    continue
+            if not rule.any_host or any(masks):
+                if host_mask is None:
+                    host_mask = self._host_mask(tables, host)
+                if not self._check(host_mask, *masks, not rule.any_host):
+                    continue
+            self._count('matched')
+            return rule
+
+        self._count('unmatched')
+        return None
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        tables = self.tables
+        stats['rules'] = len(tables.rules)
+        stats['domains'] = len(tables.index)
+        stats['prefixes'] = tables.ip_index.prefixes
+        stats['snapshot'] = tables.snapshot is not None
+        return stats
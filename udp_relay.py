@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from dpi_bypass import DPIBypass, DPIStrategy
+from protocol_classifier import Protocol, classify_datagram
+
+# Поток без датаграмм дольше этого закрывается, секунды
+UDP_IDLE_TIMEOUT = 60.0
+UDP_MAX_FLOWS = 4096
+# Сколько датаграмм читается за одно срабатывание сокета: пачка
+# обрабатывается без возврата в цикл событий и без передачи между потоками
+UDP_BATCH = 64
+DATAGRAM_SIZE = 65535
+
+# Linux: TPROXY-сокет и адрес назначения в ancillary data
+IP_TRANSPARENT = 19
+IP_RECVORIGDSTADDR = 20
+IP_ORIGDSTADDR = 20
+
+# Стратегии, для которых перед первой датаграммой уходят фейковые QUIC Initial
+UDP_FAKE_STRATEGIES = (DPIStrategy.FAKE_QUIC, DPIStrategy.FAKE_TLS)
+
+Address = Tuple[str, int]
+
+
+def _original_destination(ancdata) -> Optional[Address]:
+    """Исходный адрес назначения из IP_ORIGDSTADDR (sockaddr_in)"""
+    for level, kind, data in ancdata:
+        if level == socket.SOL_IP and kind == IP_ORIGDSTADDR and len(data) >= 8:
+            port, = struct.unpack_from('!H', data, 2)
+            return socket.inet_ntoa(data[4:8]), port
+    return None
+
+
+class UDPFlow:
+    """Состояние одного UDP-потока (клиент, адрес назначения)"""
+
+    __slots__ = ('client', 'target', 'upstream', 'reply', 'strategy', 'protocol',
+                 'last_active', 'datagrams_out', 'datagrams_in')
+
+    def __init__(self, client: Address, target: Address, upstream: socket.socket,
+                 reply: socket.socket, strategy: Optional[DPIStrategy], protocol: Protocol,
+                 now: float):
+        self.client = client
+        self.target = target
+        self.upstream = upstream
+        self.reply = reply
+        self.strategy = strategy
+        self.protocol = protocol
+        self.last_active = now
+        self.datagrams_out = 0
+        self.datagrams_in = 0
+
+
+class UDPRelay:
+    """UDP-ретранслятор для QUIC и голосовых портов Discord
+
+    Все потоки обслуживает один цикл событий: сокеты читаются пачками
+    прямо в обработчиках готовности (add_reader), без задачи или потока
+    на датаграмму. Таблица потоков упорядочена по активности, поэтому
+    вытеснение простаивающих потоков просматривает только самые старые.
+    Стратегия выбирается для потока один раз по первой датаграмме
+    (порт, --filter-l7, ipset); фейковые QUIC Initial с пониженным TTL
+    отправляются только перед ней.
+
+    transparent=True - режим TPROXY: адрес назначения берётся из
+    IP_ORIGDSTADDR, ответы уходят клиенту с исходного адреса сервера.
+    """
+
+    def __init__(self, bypass_engine: DPIBypass, strategy: DPIStrategy = DPIStrategy.FAKE_QUIC,
+                 dispatcher=None, idle_timeout: float = UDP_IDLE_TIMEOUT,
+                 max_flows: int = UDP_MAX_FLOWS, fake_ttl: Optional[int] = None,
+                 transparent: bool = False):
+        self.bypass = bypass_engine
+        self.strategy = strategy
+        self.dispatcher = dispatcher
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        config = self.bypass.strategy_configs.get(DPIStrategy.FAKE_QUIC, {})
+        # Фейки должны пройти DPI, но не дойти до сервера
+        self.fake_ttl = fake_ttl if fake_ttl is not None else config.get('autottl')
+        self.fake_repeats = config.get('repeats', 1)
+        self.transparent = transparent
+        self.flows: 'OrderedDict[Tuple[Address, Address], UDPFlow]' = OrderedDict()
+        self.running = False
+        self.socket = None
+        self.listen_port = None
+        self.ready = threading.Event()
+        self.stats = {'flows': 0, 'opened': 0, 'idle_evicted': 0, 'full_evicted': 0,
+                      'datagrams_out': 0, 'datagrams_in': 0, 'bytes_out': 0, 'bytes_in': 0,
+                      'fakes': 0, 'dropped': 0}
+        self.loop = None
+        self._stop_event = None
+        self._target = None
+
+    def start(self, listen_port, target_host=None, target_port=None):
+        """Блокирующий запуск: цикл событий работает в текущем потоке"""
+        asyncio.run(self._serve(listen_port, target_host, target_port))
+
+    async def _serve(self, listen_port, target_host, target_port):
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        if target_host is not None:
+            # Фиксированная цель разрешается один раз, а не на каждый поток
+            infos = await self.loop.getaddrinfo(target_host, target_port,
+                                                family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            self._target = infos[0][4][:2]
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.transparent:
+            self.socket.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+            self.socket.setsockopt(socket.SOL_IP, IP_RECVORIGDSTADDR, 1)
+        self.socket.setblocking(False)
+        self.socket.bind(('127.0.0.1', listen_port))
+        self.listen_port = self.socket.getsockname()[1]
+        self.loop.add_reader(self.socket.fileno(), self._on_client_readable)
+        self.running = True
+        self.ready.set()
+
+        print(f"UDP relay запущен на порту {self.listen_port}")
+
+        eviction = self.loop.create_task(self._evict_loop())
+        try:
+            await self._stop_event.wait()
+        finally:
+            self.running = False
+            eviction.cancel()
+            await asyncio.gather(eviction, return_exceptions=True)
+            self.loop.remove_reader(self.socket.fileno())
+            for key in list(self.flows):
+                self._close_flow(key)
+            self.socket.close()
+
+    def _on_client_readable(self):
+        sock = self.socket
+        flows = self.flows
+        now = time.monotonic()
+        for _ in range(UDP_BATCH):
+            try:
+                if self.transparent:
+                    data, ancdata, _, client = sock.recvmsg(DATAGRAM_SIZE, 64)
+                    target = _original_destination(ancdata) or self._target
+                else:
+                    data, client = sock.recvfrom(DATAGRAM_SIZE)
+                    target = self._target
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            if target is None:
+                self.stats['dropped'] += 1
+                continue
+
+            key = (client, target)
+            flow = flows.get(key)
+            if flow is None:
+                flow = self._open_flow(key, data, now)
+                if flow is None:
+                    self.stats['dropped'] += 1
+                    continue
+            else:
+                flows.move_to_end(key)
+            flow.last_active = now
+
+            try:
+                flow.upstream.send(data)
+            except OSError:
+                # UDP: переполненный буфер сокета означает потерю датаграммы
+                self.stats['dropped'] += 1
+                continue
+            flow.datagrams_out += 1
+            self.stats['datagrams_out'] += 1
+            self.stats['bytes_out'] += len(data)
+
+    def _open_flow(self, key, data, now: float) -> Optional[UDPFlow]:
+        client, target = key
+        if len(self.flows) >= self.max_flows:
+            self._close_flow(next(iter(self.flows)))
+            self.stats['full_evicted'] += 1
+
+        protocol = classify_datagram(data)
+        strategy = self.strategy
+        repeats = self.fake_repeats
+        if self.dispatcher is not None:
+            rule = self.dispatcher.match(target[1], None, 'udp', protocol.value, target[0])
+            strategy = rule.strategy if rule is not None else None
+            if rule is not None:
+                repeats = rule.params.get('repeats', repeats)
+
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        reply = self.socket
+        try:
+            upstream.setblocking(False)
+            upstream.connect(target)
+            if self.transparent:
+                # Ответ клиенту должен прийти с адреса, куда он отправлял
+                reply = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                reply.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+                reply.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                reply.bind(target)
+        except OSError:
+            upstream.close()
+            if reply is not self.socket:
+                reply.close()
+            return None
+
+        flow = UDPFlow(client, target, upstream, reply, strategy, protocol, now)
+        self.flows[key] = flow
+        self.loop.add_reader(upstream.fileno(), self._on_upstream_readable, flow)
+        self.stats['opened'] += 1
+        self.stats['flows'] = len(self.flows)
+
+        if strategy in UDP_FAKE_STRATEGIES:
+            self._send_fakes(flow, repeats)
+        return flow
+
+    def _send_fakes(self, flow: UDPFlow, repeats: int):
+        """Фейковые QUIC Initial перед первой датаграммой потока"""
+        fake = self.bypass.templates.get('quic_initial_www_google_com')
+        upstream = flow.upstream
+        ttl = None
+        try:
+            if self.fake_ttl:
+                ttl = upstream.getsockopt(socket.IPPROTO_IP, socket.IP_TTL)
+                upstream.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, self.fake_ttl)
+            for _ in range(repeats):
+                upstream.send(fake)
+                self.stats['fakes'] += 1
+        except OSError:
+            pass
+        finally:
+            if ttl is not None:
+                upstream.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+
+    def _on_upstream_readable(self, flow: UDPFlow):
+        now = time.monotonic()
+        for _ in range(UDP_BATCH):
+            try:
+                data = flow.upstream.recv(DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # ICMP port unreachable и т.п.: поток больше не нужен
+                self._close_flow((flow.client, flow.target))
+                return
+            try:
+                flow.reply.sendto(data, flow.client)
+            except OSError:
+                self.stats['dropped'] += 1
+                continue
+            flow.datagrams_in += 1
+            self.stats['datagrams_in'] += 1
+            self.stats['bytes_in'] += len(data)
+        # Одно обновление таблицы на пачку, а не на датаграмму
+        key = (flow.client, flow.target)
+        if key in self.flows:
+            self.flows.move_to_end(key)
+            flow.last_active = now
+
+    def _close_flow(self, key):
+        flow = self.flows.pop(key, None)
+        if flow is None:
+            return
+        self.loop.remove_reader(flow.upstream.fileno())
+        flow.upstream.close()
+        if flow.reply is not self.socket:
+            flow.reply.close()
+        self.stats['flows'] = len(self.flows)
+
+    async def _evict_loop(self):
+        interval = max(min(self.idle_timeout / 4, 5.0), 0.01)
+        while self.running:
+            await asyncio.sleep(interval)
+            self.evict_idle()
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """Закрытие потоков без датаграмм дольше idle_timeout"""
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        # Самые давно активные потоки - в начале таблицы
+        while self.flows:
+            key, flow = next(iter(self.flows.items()))
+            if now - flow.last_active < self.idle_timeout:
+                break
+            self._close_flow(key)
+            evicted += 1
+        self.stats['idle_evicted'] += evicted
+        return evicted
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Снимок счётчиков ретранслятора"""
+        stats = dict(self.stats)
+        stats['flows'] = len(self.flows)
+        if self.dispatcher is not None:
+            stats['dispatcher'] = self.dispatcher.get_stats()
+        return stats
+
+    def stop(self):
+        self.running = False
+        loop = self.loop
+        if loop and self._stop_event and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                # Цикл уже завершился
+                pass
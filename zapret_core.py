@@ -1,17 +1,36 @@
 import os
 import json
+import hashlib
 import subprocess
 import threading
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 import socket
 
+from dpi_bypass import DPIBypass, DPIStrategy, ProxyMode, LISTEN_BACKLOG, MAX_CONNECTIONS, MAX_QUEUED
+from proxy_workers import ProxyWorkerSupervisor
+from strategy_rules import StrategyDispatcher, parse_strategy_params, TRANSPORT_TCP
+from list_snapshot import ListSnapshot
+from list_watcher import ListWatcher, WATCH_INTERVAL
+from firewall import IptablesRedirect, KernelIpset, resolve_ipv4
+from udp_relay import UDPRelay, UDP_IDLE_TIMEOUT
+from packet_engine import PacketEngine, NFQUEUE_NUM
+from domain_index import read_hostlist
+from ip_index import read_ipset
+
 class ZapretCore:
     """Ядро системы обхода DPI"""
     
-    def __init__(self):
-        self.base_dir = os.path.dirname(os.path.abspath(__file__))
+    # Источники списков для update_lists
+    LIST_SOURCES = {
+        'list-general.txt': 'https://raw.githubusercontent.com/Flowseal/zapret-discord-youtube/main/lists/list-general.txt',
+        'ipset-all.txt': 'https://raw.githubusercontent.com/Flowseal/zapret-discord-youtube/main/lists/ipset-all.txt'
+    }
+    
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir or os.path.dirname(os.path.abspath(__file__))
         self.lists_dir = os.path.join(self.base_dir, 'lists')
         self.bin_dir = os.path.join(self.base_dir, 'bin')
         self.config_file = os.path.join(self.base_dir, 'config.json')
@@ -25,9 +44,29 @@ class ZapretCore:
         
         # Статус
         self.is_running = False
-        self.process = None
+        # Движок прокси работает в процессе ядра (или воркерах супервизора)
+        self.proxy = None
+        self.proxy_thread = None
+        self.udp_relay = None
+        self.udp_thread = None
+        self.packet_engine = None
+        self.dispatcher = None
+        self.supervisor = None
+        self.snapshot = None
+        # Сборку снимка запускают и update_lists, и поток ListWatcher
+        self._lists_lock = threading.Lock()
+        self.list_watcher = None
+        self.reload_stats = {'reloads': 0, 'build_ms': 0.0, 'latency_ms': 0.0}
         
-        # Инициализация списков
+        self.firewall = IptablesRedirect(
+            self.config.get('iptables', 'iptables'),
+            self.config.get('iptables_restore', 'iptables-restore'),
+            ip=self.config.get('ip', 'ip')
+        )
+        self.ipset = KernelIpset(self.config.get('ipset', 'ipset'))
+        self.strategy_params = None
+        
+        # Инициализация списков; снимок собирается при запуске движка
         self.init_lists()
     
     def load_config(self):
@@ -36,9 +75,36 @@ class ZapretCore:
             'strategy': 'AUTO',
             'dns_server': '8.8.8.8',
             'proxy_port': 8080,
+            'proxy_backlog': LISTEN_BACKLOG,
+            'proxy_max_connections': MAX_CONNECTIONS,
+            'proxy_max_queued': MAX_QUEUED,
+            # Число процессов прокси на одном порту (1 - один процесс)
+            'proxy_workers': 1,
+            # Модель ввода-вывода прокси в процессе ядра: thread или asyncio
+            'proxy_mode': ProxyMode.THREAD.value,
+            # UDP (QUIC, голос Discord) через TPROXY на том же номере порта
+            'udp_relay': False,
+            'udp_idle_timeout': UDP_IDLE_TIMEOUT,
+            # Пакетный режим (NFQUEUE) вместо прокси: TTL и опции TCP
+            # фейков меняются в самих пакетах, нужен root
+            'packet_engine': False,
+            'nfqueue_num': NFQUEUE_NUM,
             'game_filter': False,
             'update_interval': 86400,  # 24 часа
-            'last_update': 0
+            # Программы для правил перенаправления
+            'iptables': 'iptables',
+            'iptables_restore': 'iptables-restore',
+            'ipset': 'ipset',
+            'ip': 'ip',
+            # Перенаправлять в прокси только адреса из ipset и hostlist
+            # (набор в ядре); без него в прокси идёт весь трафик на порты стратегии
+            'ipset_filter': False,
+            'ipset_resolve_hosts': True,
+            # Период проверки списков на диске для перезагрузки на ходу
+            'list_watch_interval': WATCH_INTERVAL,
+            'last_update': 0,
+            # ETag, Last-Modified и хэш последней загрузки каждого списка
+            'list_validators': {}
         }
         
         try:
@@ -94,27 +160,108 @@ class ZapretCore:
                 with open(filepath, 'w', encoding='utf-8') as f:
                     f.write('\n'.join(content))
     
-    def update_lists(self):
-        """Автоматическое обновление списков из интернета"""
-        sources = {
-            'list-general.txt': 'https://raw.githubusercontent.com/Flowseal/zapret-discord-youtube/main/lists/list-general.txt',
-            'ipset-all.txt': 'https://raw.githubusercontent.com/Flowseal/zapret-discord-youtube/main/lists/ipset-all.txt'
-        }
+    def update_lists(self, sources=None, max_workers=4):
+        """Автоматическое обновление списков из интернета
         
-        for filename, url in sources.items():
-            try:
-                response = requests.get(url, timeout=10)
-                if response.status_code == 200:
-                    filepath = os.path.join(self.lists_dir, filename)
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.write(response.text)
-                    print(f"Updated {filename}")
-            except Exception as e:
-                print(f"Failed to update {filename}: {e}")
+        Запросы условные (If-None-Match/If-Modified-Since) и идут параллельно
+        через общую сессию. Снимок списков пересобирается, только если
+        содержимое хотя бы одного файла действительно изменилось.
+        Возвращает имена обновлённых файлов.
+        """
+        sources = sources or self.LIST_SOURCES
+        validators = self.config.setdefault('list_validators', {})
+        changed = []
+        
+        with requests.Session() as session:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(sources))) as executor:
+                futures = {
+                    executor.submit(self._fetch_list, session, filename, url,
+                                    validators.get(filename, {})): filename
+                    for filename, url in sources.items()
+                }
+                for future in as_completed(futures):
+                    filename = futures[future]
+                    try:
+                        updated, validators[filename] = future.result()
+                    except Exception as e:
+                        print(f"Failed to update {filename}: {e}")
+                        continue
+                    if updated:
+                        changed.append(filename)
+                        print(f"Updated {filename}")
+                    else:
+                        print(f"{filename} is up to date")
         
         # Обновляем время последнего обновления
         self.config['last_update'] = time.time()
         self.save_config()
+        if changed:
+            self.compile_lists()
+        return changed
+    
+    def _fetch_list(self, session, filename, url, validator):
+        """Условная загрузка одного списка: (изменился ли файл, новые валидаторы)
+        
+        Тело пишется во временный файл и подменяет список атомарно, поэтому
+        прокси никогда не читает наполовину записанный файл.
+        """
+        filepath = os.path.join(self.lists_dir, filename)
+        headers = {}
+        if os.path.exists(filepath):
+            if validator.get('etag'):
+                headers['If-None-Match'] = validator['etag']
+            if validator.get('last_modified'):
+                headers['If-Modified-Since'] = validator['last_modified']
+        
+        with session.get(url, headers=headers, timeout=10, stream=True) as response:
+            if response.status_code == 304:
+                return False, validator
+            response.raise_for_status()
+            
+            digest = hashlib.blake2b(digest_size=16)
+            temp_path = filepath + '.tmp'
+            try:
+                with open(temp_path, 'wb') as f:
+                    for chunk in response.iter_content(65536):
+                        digest.update(chunk)
+                        f.write(chunk)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+            
+            validator = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'hash': digest.hexdigest()
+            }
+        
+        if os.path.exists(filepath) and validator['hash'] == self._list_hash(filepath):
+            # Сервер не поддерживает условные запросы, но данные те же
+            os.remove(temp_path)
+            return False, validator
+        os.replace(temp_path, filepath)
+        return True, validator
+    
+    @staticmethod
+    def _list_hash(filepath):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def compile_lists(self):
+        """Сборка lists/compiled.bin, если списки изменились с прошлой сборки"""
+        with self._lists_lock:
+            try:
+                self.snapshot = ListSnapshot.open(self.base_dir)
+                if self.snapshot.build_time:
+                    print(f"Compiled lists in {self.snapshot.build_time * 1000:.1f} ms")
+            except (OSError, ValueError) as e:
+                # Без снимка диспетчер читает текстовые списки сам
+                print(f"Failed to compile lists: {e}")
+                self.snapshot = None
+            return self.snapshot
     
     def auto_detect_strategy(self, app_package):
         """Автоматическое определение стратегии для приложения"""
@@ -206,36 +353,125 @@ class ZapretCore:
         
         return strategies.get(strategy_name, strategies['AUTO'])
     
+    def reload_lists(self, changed=None):
+        """Перезагрузка изменённых списков в работающий прокси
+        
+        Снимок пересобирается здесь; прокси в процессе ядра получает новые
+        индексы сразу, а воркеры сами замечают новый lists/compiled.bin.
+        Открытые соединения не разрываются.
+        """
+        changed_at = max((os.path.getmtime(path) for path in changed or ()
+                          if os.path.exists(path)), default=time.time())
+        started = time.perf_counter()
+        self.compile_lists()
+        if self.dispatcher is not None and (self.supervisor is None or self.udp_relay):
+            # Прокси (или UDP-ретранслятор) в этом процессе: индексы подменяются сразу
+            self.dispatcher.reload(self.snapshot, changed_at)
+        if self.is_running and self.config.get('ipset_filter'):
+            self.load_ipset(self.strategy_params)
+        
+        self.reload_stats['reloads'] += 1
+        self.reload_stats['build_ms'] = (time.perf_counter() - started) * 1000.0
+        self.reload_stats['latency_ms'] = max(0.0, time.time() - changed_at) * 1000.0
+        print(f"Lists reloaded: build {self.reload_stats['build_ms']:.1f} ms, "
+              f"latency {self.reload_stats['latency_ms']:.1f} ms")
+        return self.reload_stats
+    
+    def watch_lists(self):
+        """Запуск слежения за каталогом списков"""
+        self.stop_watching_lists()
+        self.list_watcher = ListWatcher(
+            self.lists_dir, self.reload_lists,
+            self.config.get('list_watch_interval', WATCH_INTERVAL)
+        )
+        return self.list_watcher.start()
+    
+    def stop_watching_lists(self):
+        if self.list_watcher:
+            self.list_watcher.stop()
+            self.list_watcher = None
+    
+    def create_dispatcher(self, strategy_params):
+        """Правила выбора стратегии для каждого соединения по фильтрам"""
+        # Снимок собирается (или проверяется на актуальность) при запуске
+        # прокси или пакетного движка, а не при создании ядра
+        self.compile_lists()
+        return StrategyDispatcher.from_strategy_params(strategy_params, self.base_dir,
+                                                       snapshot=self.snapshot)
+    
     def create_local_proxy(self, strategy_params, dns_server, proxy_port):
-        """Создание локального прокси для обхода DPI"""
-        # Здесь будет реализация прокси на Python
-        # Это упрощённая версия для примера
+        """Создание скрипта автономного прокси для обхода DPI
+        
+        Ядро само запускает движок в своём процессе (start_proxy); скрипт
+        нужен только для запуска прокси отдельно от приложения.
+        """
+        
+        backlog = self.config.get('proxy_backlog', LISTEN_BACKLOG)
+        max_connections = self.config.get('proxy_max_connections', MAX_CONNECTIONS)
+        max_queued = self.config.get('proxy_max_queued', MAX_QUEUED)
         
         proxy_script = f'''
 import socket
+import struct
 import threading
 import ssl
 
 PROXY_PORT = {proxy_port}
 DNS_SERVER = '{dns_server}'
+BACKLOG = {backlog}
+MAX_CONNECTIONS = {max_connections}
+MAX_QUEUED = {max_queued}
 
 class DPIProxy:
     def __init__(self):
         self.running = True
+        self.slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.stats = {{'accepted': 0, 'queued': 0, 'rejected': 0}}
         
     def start(self):
         # Создаём сокет
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind(('127.0.0.1', PROXY_PORT))
-        server.listen(5)
+        server.listen(BACKLOG)
         
         print(f"Прокси запущен на порту {{PROXY_PORT}}")
         
         while self.running:
             client, addr = server.accept()
-            thread = threading.Thread(target=self.handle_client, args=(client,))
-            thread.start()
+            self.admit(client)
+    
+    def admit(self, client):
+        """Свободный слот, очередь или сброс соединения при перегрузке"""
+        if self.slots.acquire(blocking=False):
+            queued = False
+        else:
+            with self.lock:
+                if self.waiting >= MAX_QUEUED:
+                    self.stats['rejected'] += 1
+                    client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                    client.close()
+                    return
+                self.waiting += 1
+                self.stats['queued'] += 1
+            queued = True
+        
+        thread = threading.Thread(target=self.serve, args=(client, queued), daemon=True)
+        thread.start()
+    
+    def serve(self, client, queued):
+        if queued:
+            self.slots.acquire()
+            with self.lock:
+                self.waiting -= 1
+        with self.lock:
+            self.stats['accepted'] += 1
+        try:
+            self.handle_client(client)
+        finally:
+            self.slots.release()
     
     def handle_client(self, client):
         try:
@@ -288,24 +524,189 @@ if __name__ == '__main__':
         
         return proxy_path
     
-    def start(self, strategy='AUTO', dns_server='8.8.8.8', proxy_port=8080, game_filter=False):
-        """Запуск системы обхода"""
+    def start_proxy(self, strategy_params, proxy_port, workers=1, target=None):
+        """Запуск движка DPIBypass с правилами выбранной стратегии
+        
+        Без target прокси прозрачный: цель берётся из адреса до REDIRECT,
+        стратегия - по фильтрам для каждого соединения. target=(хост, порт)
+        задаёт фиксированную цель (проверка стратегии). При workers > 1
+        запускаются процессы на одном порту (SO_REUSEPORT), иначе прокси
+        работает в потоке ядра. Возвращает порт прокси.
+        """
+        self.stop_proxy()
+        target_host, target_port = target or (None, None)
+        self.dispatcher = self.create_dispatcher(strategy_params)
+        options = {
+            'dispatcher': self.dispatcher,
+            'backlog': self.config.get('proxy_backlog', LISTEN_BACKLOG),
+            'max_connections': self.config.get('proxy_max_connections', MAX_CONNECTIONS),
+            'max_queued': self.config.get('proxy_max_queued', MAX_QUEUED)
+        }
+        mode = self.config.get('proxy_mode', ProxyMode.THREAD.value)
+        
+        if workers > 1:
+            self.supervisor = ProxyWorkerSupervisor(
+                proxy_port, target_host, target_port, DPIStrategy.AUTO,
+                workers=workers, mode=mode, **options
+            )
+            port = self.supervisor.start()
+            if not self.supervisor.wait_ready(10):
+                # Воркеры не подняли слушающий сокет - не оставляем их перезапускаться
+                self.stop_proxy()
+                raise RuntimeError("Прокси не запустился")
+        else:
+            self.proxy = DPIBypass().create_proxy_server(
+                proxy_port, target_host, target_port, DPIStrategy.AUTO, mode=mode, **options
+            )
+            self.proxy_thread = threading.Thread(
+                target=self.proxy.start, args=(proxy_port, target_host, target_port),
+                daemon=True
+            )
+            self.proxy_thread.start()
+            if not self.proxy.ready.wait(5):
+                self.stop_proxy()
+                raise RuntimeError("Прокси не запустился")
+            port = self.proxy.listen_port
+        
+        if target is None and self.config.get('udp_relay'):
+            self.start_udp_relay(port)
+        self.watch_lists()
+        return port
+    
+    def start_udp_relay(self, port):
+        """Запуск UDP-ретранслятора в потоке ядра с общим диспетчером правил
+        
+        Один цикл событий обслуживает все UDP-потоки; датаграммы приходят
+        через TPROXY, поэтому адрес назначения известен для каждого потока.
+        """
+        self.udp_relay = UDPRelay(
+            DPIBypass(), dispatcher=self.dispatcher, transparent=True,
+            idle_timeout=self.config.get('udp_idle_timeout', UDP_IDLE_TIMEOUT)
+        )
+        self.udp_thread = threading.Thread(target=self.udp_relay.start, args=(port,),
+                                           daemon=True)
+        self.udp_thread.start()
+        if not self.udp_relay.ready.wait(5):
+            self.stop_udp_relay()
+            raise RuntimeError("UDP relay не запустился")
+        return self.udp_relay.listen_port
+    
+    def start_packet_engine(self, strategy_params):
+        """Запуск пакетного движка на очереди config['nfqueue_num']
+        
+        Правила выбираются тем же диспетчером, что и в прокси; списки
+        перезагружаются на ходу так же.
+        """
+        self.stop_proxy()
+        self.dispatcher = self.create_dispatcher(strategy_params)
+        self.packet_engine = PacketEngine(DPIBypass(), dispatcher=self.dispatcher).start(
+            self.config.get('nfqueue_num', NFQUEUE_NUM)
+        )
+        self.watch_lists()
+        return self.packet_engine
+    
+    def stop_udp_relay(self):
+        if self.udp_relay:
+            self.udp_relay.stop()
+            self.udp_thread.join(5)
+            self.udp_relay = None
+            self.udp_thread = None
+    
+    def stop_proxy(self):
+        """Остановка движка прокси; открытые соединения закрываются клиентами"""
+        self.stop_watching_lists()
+        self.stop_udp_relay()
+        if self.packet_engine:
+            self.packet_engine.stop()
+            self.packet_engine = None
+        if self.supervisor:
+            self.supervisor.stop()
+            self.supervisor = None
+        if self.proxy:
+            self.proxy.stop()
+            self.proxy_thread.join(5)
+            self.proxy = None
+            self.proxy_thread = None
+        self.dispatcher = None
+    
+    def get_proxy_stats(self):
+        """Статистика работающего прокси (None, если он не запущен)"""
+        stats = None
+        if self.supervisor:
+            stats = self.supervisor.get_stats()
+        elif self.proxy:
+            stats = self.proxy.get_stats()
+        elif self.packet_engine:
+            stats = {'packet': self.packet_engine.get_stats()}
+        if stats is not None and self.udp_relay:
+            stats['udp'] = self.udp_relay.get_stats()
+        return stats
+    
+    def switch_strategy(self, strategy):
+        """Смена стратегии без перезапуска
+        
+        Слушающий сокет и DNS остаются на месте: в прокси подменяется только
+        таблица правил, открытые соединения не рвутся. Если у новой стратегии
+        другие tcp_ports/udp_ports, цепочка перенаправления пересобирается
+        (одним iptables-restore).
+        """
+        if self.dispatcher is None:
+            return False
         try:
-            # Получаем параметры стратегии
             strategy_params = self.get_strategy_params(strategy)
+            rules = parse_strategy_params(strategy_params)
+            previous = self.strategy_params or {}
+            ports_changed = any(previous.get(key) != strategy_params.get(key)
+                                for key in ('tcp_ports', 'udp_ports'))
+            if self.supervisor:
+                self.supervisor.replace_rules(rules)
+            else:
+                self.dispatcher.replace_rules(rules)
+            self.strategy_params = strategy_params
+            if ports_changed:
+                # Набор в ядре перезагружается там же, вместе с цепочкой
+                if self.packet_engine:
+                    self.setup_packet_redirect(strategy_params)
+                else:
+                    self.setup_proxy_redirect(self.config.get('proxy_port', 8080),
+                                              strategy_params)
+            elif self.config.get('ipset_filter'):
+                # Набор в ядре подменяется атомарно, правила iptables те же
+                self.load_ipset(strategy_params)
             
-            # Создаём локальный прокси
-            proxy_script = self.create_local_proxy(strategy_params, dns_server, proxy_port)
+            self.config['strategy'] = strategy
+            self.save_config()
+            return True
             
-            # Запускаем прокси в отдельном процессе
-            self.process = subprocess.Popen(
-                ['python3', proxy_script],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
+        except Exception as e:
+            print(f"Ошибка смены стратегии: {e}")
+            return False
+    
+    def start(self, strategy='AUTO', dns_server='8.8.8.8', proxy_port=8080, game_filter=False,
+              workers=None):
+        """Запуск системы обхода
+        
+        workers > 1 запускает несколько процессов прокси на одном порту
+        (SO_REUSEPORT), по умолчанию берётся из config['proxy_workers'].
+        """
+        try:
+            # Получаем параметры стратегии
+            strategy_params = self.get_strategy_params(strategy)
+            
+            if workers is None:
+                workers = self.config.get('proxy_workers', 1)
             
-            # Настраиваем перенаправление трафика через прокси
-            self.setup_proxy_redirect(proxy_port)
+            if self.config.get('packet_engine'):
+                # Пакетный режим: первые пакеты соединений идут через NFQUEUE
+                self.start_packet_engine(strategy_params)
+                self.strategy_params = strategy_params
+                self.setup_packet_redirect(strategy_params)
+            else:
+                self.start_proxy(strategy_params, proxy_port, workers)
+                self.strategy_params = strategy_params
+                
+                # Настраиваем перенаправление трафика через прокси
+                self.setup_proxy_redirect(proxy_port, strategy_params)
             
             # Настраиваем DNS
             self.set_dns(dns_server)
@@ -317,6 +718,7 @@ if __name__ == '__main__':
             self.config['dns_server'] = dns_server
             self.config['proxy_port'] = proxy_port
             self.config['game_filter'] = game_filter
+            self.config['proxy_workers'] = workers
             self.save_config()
             
             return True
@@ -328,9 +730,7 @@ if __name__ == '__main__':
     def stop(self):
         """Остановка системы"""
         try:
-            if self.process:
-                self.process.terminate()
-                self.process.wait(timeout=5)
+            self.stop_proxy()
             
             # Восстанавливаем настройки сети
             self.restore_network_settings()
@@ -342,28 +742,73 @@ if __name__ == '__main__':
             print(f"Ошибка остановки: {e}")
             return False
     
-    def setup_proxy_redirect(self, port):
-        """Настройка перенаправления трафика через прокси"""
+    def setup_proxy_redirect(self, port, strategy_params=None):
+        """Настройка перенаправления трафика через прокси
+        
+        Порты TCP берутся из tcp_ports стратегии, правила ставятся одной
+        транзакцией iptables-restore в цепочку ZAPRET (требует root).
+        С config['ipset_filter'] в прокси идут только адреса из набора ядра;
+        если набор загрузить не удалось, перенаправляется весь трафик.
+        С config['udp_relay'] порты udp_ports уходят в UDP-ретранслятор
+        через TPROXY (цепочки ZAPRET_UDP в mangle).
+        """
         # В Android без root это делается через VPNService
-        # Здесь упрощённая реализация
+        tcp_ports = (strategy_params or {}).get('tcp_ports', '80,443')
+        ipsets = ()
+        if strategy_params and self.config.get('ipset_filter'):
+            if self.load_ipset(strategy_params):
+                ipsets = (self.ipset.name,)
+        success = self.firewall.setup(port, tcp_ports, ipsets, exclude_uid=os.getuid())
+        if self.config.get('udp_relay'):
+            udp_ports = (strategy_params or {}).get('udp_ports', '443')
+            success = self.firewall.setup_udp(port, udp_ports, ipsets,
+                                              exclude_uid=os.getuid()) and success
+        return success
+    
+    def setup_packet_redirect(self, strategy_params):
+        """Правила NFQUEUE для портов стратегии (TCP и UDP)"""
+        ipsets = ()
+        if self.config.get('ipset_filter') and self.load_ipset(strategy_params):
+            ipsets = (self.ipset.name,)
+        return self.firewall.setup_nfqueue(
+            self.config.get('nfqueue_num', NFQUEUE_NUM),
+            strategy_params.get('tcp_ports', '80,443'),
+            strategy_params.get('udp_ports', ''), ipsets
+        )
+    
+    def redirect_networks(self, strategy_params, resolve_hosts=None):
+        """Адреса назначения для набора в ядре
         
-        # Создаём iptables правила (требует root)
-        try:
-            # Разрешаем локальный трафик
-            subprocess.run(['iptables', '-A', 'OUTPUT', '-d', '127.0.0.1', '-j', 'ACCEPT'], 
-                          check=False)
-            
-            # Перенаправляем HTTP/HTTPS трафик
-            subprocess.run(['iptables', '-t', 'nat', '-A', 'OUTPUT', '-p', 'tcp', 
-                          '--dport', '80', '-j', 'REDIRECT', '--to-port', str(port)], 
-                          check=False)
-            subprocess.run(['iptables', '-t', 'nat', '-A', 'OUTPUT', '-p', 'tcp',
-                          '--dport', '443', '-j', 'REDIRECT', '--to-port', str(port)],
-                          check=False)
-            
-        except:
-            # Без root используем другой подход
-            pass
+        Подсети из ipset-all.txt и --ipset правил стратегии, а также адреса
+        доменов из их hostlist. Поддомены (rr1---sn-....googlevideo.com)
+        так не найти, поэтому фильтр по набору включается явно.
+        """
+        if resolve_hosts is None:
+            resolve_hosts = self.config.get('ipset_resolve_hosts', True)
+        rules = parse_strategy_params(strategy_params)
+        
+        ipset_files = {'lists/ipset-all.txt'}
+        hostlists = set()
+        domains = set()
+        for rule in rules:
+            ipset_files.update(rule.ipsets)
+            hostlists.update(rule.hostlists)
+            domains.update(rule.domains)
+        
+        networks = []
+        for ipset_file in sorted(ipset_files):
+            networks.extend(read_ipset(os.path.join(self.base_dir, ipset_file)))
+        if resolve_hosts:
+            for hostlist in sorted(hostlists):
+                domains.update(read_hostlist(os.path.join(self.base_dir, hostlist)))
+            networks.extend(resolve_ipv4(domains))
+        return networks
+    
+    def load_ipset(self, strategy_params):
+        """Загрузка адресов стратегии в набор ядра одним ipset restore"""
+        if not strategy_params:
+            return False
+        return self.ipset.load(self.redirect_networks(strategy_params))
     
     def set_dns(self, dns_server):
         """Установка DNS сервера"""
@@ -378,53 +823,68 @@ if __name__ == '__main__':
     
     def restore_network_settings(self):
         """Восстановление сетевых настроек"""
+        # Удаляем только свою цепочку, чужие правила iptables не трогаем
+        self.firewall.teardown()
+        if self.config.get('udp_relay'):
+            self.firewall.teardown_udp()
+        if self.config.get('packet_engine'):
+            self.firewall.teardown_nfqueue()
+        if self.config.get('ipset_filter'):
+            self.ipset.destroy()
+        
         try:
-            # Очищаем iptables правила
-            subprocess.run(['iptables', '-F'], check=False)
-            subprocess.run(['iptables', '-t', 'nat', '-F'], check=False)
-            
             # Восстанавливаем DNS
             subprocess.run(['settings', 'put', 'global', 'private_dns_mode', 'off'],
                           check=False)
         except:
             pass
     
+    def probe_hosts(self, strategy_params, port=443):
+        """Домены TCP-правил стратегии для port - кандидаты для проверки
+        
+        Порядок - как в правилах и файлах списков; правилу без hostlist
+        подходит любой хост, для него берётся www.google.com.
+        """
+        for rule in parse_strategy_params(strategy_params):
+            if rule.transport != TRANSPORT_TCP or not rule.matches_port(port):
+                continue
+            if rule.any_host:
+                yield 'www.google.com'
+            yield from sorted(rule.domains)
+            for hostlist in rule.hostlists:
+                yield from read_hostlist(os.path.join(self.base_dir, hostlist))
+    
     def test_strategy(self, strategy):
         """Тестирование стратегии"""
+        strategy_params = self.get_strategy_params(strategy)
+        dispatcher = self.create_dispatcher(strategy_params)
+        # Хост, для которого правила стратегии действительно выбирают обход:
+        # соединение к хосту вне списков прошло бы без стратегии
+        host = next((candidate for candidate in self.probe_hosts(strategy_params)
+                     if dispatcher.match(443, candidate) is not None), None)
+        if host is None:
+            return False
+        
+        # Временный прокси в процессе ядра с фиксированной целью
+        proxy = DPIBypass().create_proxy_server(0, host, 443, DPIStrategy.AUTO,
+                                                dispatcher=dispatcher)
+        thread = threading.Thread(target=proxy.start, args=(0, host, 443), daemon=True)
+        thread.start()
         try:
-            # Тестируем подключение к тестовому сайту
-            test_url = 'https://www.google.com'
-            
-            # Запускаем прокси с тестовой стратегией
-            test_proxy = self.create_local_proxy(
-                self.get_strategy_params(strategy),
-                '8.8.8.8',
-                9999
-            )
+            if not proxy.ready.wait(5):
+                return False
             
-            # Запускаем временный прокси
-            process = subprocess.Popen(['python3', test_proxy],
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
-            
-            time.sleep(2)  # Даём время на запуск
-            
-            # Пытаемся подключиться через прокси
-            import urllib.request
-            proxy_handler = urllib.request.ProxyHandler({'https': '127.0.0.1:9999'})
-            opener = urllib.request.build_opener(proxy_handler)
-            
-            try:
-                response = opener.open(test_url, timeout=10)
-                success = response.getcode() == 200
-            except:
-                success = False
-            
-            # Останавливаем прокси
-            process.terminate()
-            process.wait()
-            
-            return success
+            # TLS через прокси: любой HTTP-ответ значит, что ClientHello прошёл DPI
+            import ssl
+            context = ssl.create_default_context()
+            with socket.create_connection(('127.0.0.1', proxy.listen_port), timeout=10) as sock:
+                with context.wrap_socket(sock, server_hostname=host) as tls:
+                    tls.sendall(b'HEAD / HTTP/1.1\r\nHost: ' + host.encode('idna') +
+                                b'\r\nConnection: close\r\n\r\n')
+                    return tls.recv(64).startswith(b'HTTP/1.')
             
         except:
-            return False
\ No newline at end of file
+            return False
+        finally:
+            proxy.stop()
+            thread.join(5)